@@ -42,6 +42,7 @@ from audit.models import (AuditServerModel, AuditSysModel, AuditTaskModel,
                           RuleAtomModel, ServerInfo, SysProjectModel,
                           UserRoleDataModel, UserSupplementInfo)
 from audit.rule_handler import PeriodProxyHandler
+from audit.utils import logs_namespace, model_namespace, task_namespace
 from bombus.libs import permission_required
 from bombus.libs.enums import ReviewTypeEnum, RuleTypeEnum, ServerKindEnum
 from bombus.libs.exception import FastResponse
@@ -49,7 +50,7 @@ from bombus.services.message import EmailMessage
 from bombus.services.mysql_service import (get_db_name_by_dept,
                                            get_db_node_by_host)
 from bombus.services.user_service import UserService
-from core.redis_conn import has_log_cache
+from core.redis_conn import cache_version, has_log_cache
 from core.util import cache_util, time_util
 from core.util.time_util import date2datetime, dt2stamp, today
 
@@ -957,10 +958,24 @@ class TicketReview(NewReviewBaseView):
         return JsonResponse(data=resp)
 
 
+def has_logs_namespaces(log_type, task_id, origin_name):
+    """
+    上报队列积压时前几天的日志可能延迟写入, 日志写入、任务、审计范围及规则配置变更时缓存失效
+    """
+    config_models = ['AuditSysModel', 'AuditServerModel', 'TaskManagerModel',
+                     'RuleGroupModel', 'RuleAtomModel', 'RegexPatternModel']
+    return [logs_namespace(), task_namespace(task_id)] + [model_namespace(m) for m in config_models]
+
+
 log_cache_wrap = cache_util.CacheWrap(has_log_cache,
+                                      pre_fix='has_logs',
                                       expire=3600 * 24,
                                       time_range=0,
-                                      time_cache_key=partial(time_util.time2str, fmt=time_util.DT_FMT_002))
+                                      time_cache_key=partial(time_util.time2str, fmt=time_util.DT_FMT_002),
+                                      version_store=cache_version,
+                                      namespaces=has_logs_namespaces,
+                                      # 日志入库后各任务页面同时重算has_logs, 只由一个调用方查询
+                                      single_flight=True)
 
 
 @permission_required(settings.CA_REVIEW)
@@ -1124,7 +1139,7 @@ class NewUserReview(NewReviewBaseView):
         return JsonResponse(data=resp)
 
     @staticmethod
-    # @log_cache_wrap
+    @log_cache_wrap
     def has_logs(log_type, task_id, origin_name):
         result = True
         if ReviewTypeEnum[log_type] == ReviewTypeEnum.APP:
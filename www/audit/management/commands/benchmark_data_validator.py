@@ -0,0 +1,75 @@
+# -*- coding:utf-8 -*-
+"""
+    合规数据校验性能对比: cerberus vs 预编译校验
+"""
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+from cerberus import Validator
+from django.core.management.base import BaseCommand
+
+from audit.utils import get_data_check_schema, get_data_validator
+
+
+def build_sample(data_type, index):
+    ts = 1600000000 + index
+    samples = {
+        'BgAccessLog': {
+            'bg_name': 'ca_bg', 'user': f'user{index}', 'op_ts': ts, 'host': 'ca.com',
+            'url': '/api/user/', 'method': 'get', 'params': '{}', 'ip': '10.0.0.1', 'ua': 'Mozilla/5.0',
+        },
+        'UserRoleData': {
+            'bg_name': 'ca_bg', 'role': '管理员', 'date': '2020-10-01',
+            'user_details': [{'user': f'user{index}', 'create_ts': ts}, {'user': f'user{index}_1'}],
+        },
+        'UserAccountData': {
+            'bg_name': 'ca_bg', 'user_id': f'user{index}', 'accountid': str(10000 + index), 'date': '2020-10-01',
+        },
+    }
+    return samples[data_type]
+
+
+class Command(BaseCommand):
+    help = 'benchmark cerberus Validator against the compiled fast validator'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--count',
+            dest='count',
+            type=int,
+            default=10000,
+            help="records per data_type")
+
+    def run(self, validator, datas):
+        start = time.perf_counter()
+        for data in datas:
+            validator.validate(data)
+            assert not validator.errors, validator.errors
+        return time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        count = options['count']
+        for data_type in ('BgAccessLog', 'UserRoleData', 'UserAccountData'):
+            datas = [build_sample(data_type, i) for i in range(count)]
+            cerberus_cost = self.run(Validator(get_data_check_schema(data_type)), datas)
+            fast_cost = self.run(get_data_validator(data_type), datas)
+            self.stdout.write(
+                f'{data_type:<16} records={count} cerberus={cerberus_cost:.3f}s '
+                f'fast={fast_cost:.3f}s speedup={cerberus_cost / fast_cost:.1f}x')
@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+"""
+由应用后台日志全量回填用户最近访问时间, 上线汇总表时执行一次; 重复执行结果不变
+"""
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from audit.models import BgAccessLogModel, BgLastAccessModel
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--bg_name',
+            dest='bg_names',
+            action='append',
+            default=[],
+            help="only backfill given bg_name, can be repeated")
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=1000,
+            help="upsert batch size")
+
+    def iter_last_access(self, bg_names):
+        pipeline = []
+        if bg_names:
+            pipeline.append({'$match': {'bg_name': {'$in': bg_names}}})
+        pipeline.append({'$group': {
+            '_id': {'bg_name': '$bg_name', 'user': '$user'},
+            'last_access_dt': {'$max': '$access_dt'},
+        }})
+        cursor = BgAccessLogModel._get_collection().aggregate(pipeline, allowDiskUse=True)
+        for item in cursor:
+            yield item['_id']['bg_name'], item['_id']['user'], item['last_access_dt']
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        logger.info('[BG LAST ACCESS] backfill begin')
+        total = 0
+        batch = []
+        for access in self.iter_last_access(options['bg_names']):
+            batch.append(access)
+            if len(batch) >= batch_size:
+                BgLastAccessModel.bulk_touch(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            BgLastAccessModel.bulk_touch(batch)
+            total += len(batch)
+        logger.info(f'[BG LAST ACCESS] backfill finished, {total} (bg_name, user) updated')
@@ -22,66 +22,63 @@
 
 import json
 import logging
+import os
+import signal
 import time
+from collections import defaultdict
 from datetime import datetime
 
 from django.core.management.base import BaseCommand
-from mongoengine.queryset import DoesNotExist
 
-from audit.models import (BgAccessLogModel, EmployeePositionChangeDataModel,
-                          RolePermissionData, RolePermissionModifyLogModel,
-                          UserAccountDataModel, UserRoleDataModel,
-                          UserRoleModifyLogModel)
-from audit.utils import RedisDataProvider
+from audit.models import (BgAccessLogModel, BgLastAccessModel,
+                          EmployeePositionChangeDataModel, RolePermissionData,
+                          RolePermissionModifyLogModel, UserAccountDataModel,
+                          UserRoleDataModel, UserRoleModifyLogModel)
+from audit.utils import (MessageDeduplicator, bump_cache_versions,
+                         get_data_provider, logs_namespace)
+from bombus.services.user_service import UserService
+from core import mongo_conn
 from core.util import time_util
 
 logger = logging.getLogger(__name__)
 
 
-def handle_bg_access_log(data: dict):
+def build_bg_access_log(data: dict):
     op_ts = data.pop('op_ts')
     data['access_dt'] = datetime.fromtimestamp(op_ts)
     data['params'] = json.loads(data['params'])
-    BgAccessLogModel(**data).save()
+    return [BgAccessLogModel(**data)]
 
 
-def handle_user_role_modify_log(data: dict):
+def build_user_role_modify_log(data: dict):
     modify_ts = data.pop('modify_ts')
     data['modify_dt'] = datetime.fromtimestamp(modify_ts)
-    UserRoleModifyLogModel(**data).save()
+    return [UserRoleModifyLogModel(**data)]
 
 
-def handle_role_permission_modify_log(data: dict):
+def build_role_permission_modify_log(data: dict):
     modify_ts = data.pop('modify_ts')
     data['modify_dt'] = datetime.fromtimestamp(modify_ts)
-    RolePermissionModifyLogModel(**data).save()
+    return [RolePermissionModifyLogModel(**data)]
 
 
 def user2accountid(bg_name, user):
     return UserAccountDataModel.get_accountid_by_user(bg_name, user) or None
 
 
-def get_created_time(bg_name, user):
-    """
-    获取用户在对应后台的创建时间
-    """
-    queryset = UserRoleDataModel.objects.filter(user=user, bg_name=bg_name)
-    create_dt = queryset.filter(create_dt__ne=None).order_by('create_dt').values_list('create_dt').first()
-    if create_dt:
-        return create_dt
-    record_date = queryset.order_by('record_date').values_list('record_date').first()
-    if record_date:
-        return time_util.date2datetime(record_date)
-    return time_util.today()
-
-
-def handle_user_role_data(data: dict):
+def build_user_role_data(data: dict):
     user_details = data['user_details']
     bg_name = data['bg_name']
     role = data['role']
 
     record_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
 
+    # 未上报创建时间的用户一次性查询首次出现时间
+    first_seen_map = UserRoleDataModel.get_first_seen_map(
+        bg_name, [detail['user'] for detail in user_details if not detail.get('create_ts')])
+    default_create_dt = time_util.today()
+
+    result = []
     for detail in user_details:
         user = detail['user']
         create_ts = detail.get('create_ts')
@@ -94,17 +91,19 @@ def handle_user_role_data(data: dict):
         if create_ts:
             msg['create_dt'] = datetime.fromtimestamp(create_ts)
         else:
-            msg['create_dt'] = get_created_time(bg_name, user)
+            msg['create_dt'] = first_seen_map.get(user) or default_create_dt
 
-        UserRoleDataModel(**msg).save()
+        result.append(UserRoleDataModel(**msg))
+    return result
 
 
-def handle_role_permission_data(data: dict):
+def build_role_permission_data(data: dict):
     permission_details = data['permission_details']
     bg_name = data['bg_name']
     role = data['role']
     record_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
 
+    result = []
     for detail in permission_details:
         perm_name = detail['perm_name']
         create_ts = detail.get('create_ts')
@@ -118,10 +117,11 @@ def handle_role_permission_data(data: dict):
         if create_ts:
             msg['create_dt'] = datetime.fromtimestamp(create_ts)
 
-        RolePermissionData(**msg).save()
+        result.append(RolePermissionData(**msg))
+    return result
 
 
-def handle_employee_position_change_data(data: dict):
+def build_employee_position_change_data(data: dict):
     name_map = {
         'EMPLID': 'employee_id',
         'HPS_ACCOUNT_ID': 'accountid',
@@ -138,24 +138,67 @@ def handle_employee_position_change_data(data: dict):
     }
     for old_key, new_key in name_map.items():
         new_data[new_key] = data.get(old_key) or ''
-    EmployeePositionChangeDataModel(**new_data).save()
+    return new_data
+
+
+def bulk_insert(model, build_func):
+    """
+    将build函数包装为批量插入的handler
+    """
+    def handler(datas: list):
+        instances = []
+        for data in datas:
+            instances.extend(build_func(data))
+        if instances:
+            model.objects.insert(instances, load_bulk=False)
+        return instances
+    return handler
+
+
+def bulk_handle_employee_position_change_data(datas: list):
+    EmployeePositionChangeDataModel.bulk_upsert(
+        [build_employee_position_change_data(data) for data in datas])
+
 
+def bulk_handle_user_account_data(datas: list):
+    UserAccountDataModel.bulk_upsert(datas)
 
-def handle_user_account_data(data: dict):
-    data.pop('date', '')
-    today = datetime.now().date()
+
+insert_bg_access_log = bulk_insert(BgAccessLogModel, build_bg_access_log)
+
+
+def bulk_handle_bg_access_log(datas: list):
+    instances = insert_bg_access_log(datas)
+    # 同步汇总用户最近访问时间; 日志已写入, 汇总失败不能导致整批重试而重复插入日志,
+    # 遗漏的访问时间可由 bg_last_access_backfill 补齐
     try:
-        instance = UserAccountDataModel.objects.get(bg_name=data['bg_name'], user_id=data['user_id'])
-        instance.accountid = data['accountid']
-        instance.update_date = today
-        instance.save()
-    except DoesNotExist as e:
-        instance = UserAccountDataModel(**data)
-        instance.create_date = today
-        instance.update_date = today
-        instance.save()
-    except Exception as e:
-        logger.exception('handle user account error')
+        BgLastAccessModel.bulk_touch((log.bg_name, log.user, log.access_dt) for log in instances)
+    except Exception:
+        logger.exception(f'update bg last access of {len(instances)} logs fail')
+
+
+def single(bulk_handler):
+    """
+    将批量handler包装为处理单条数据的handler
+    """
+    def handler(data: dict):
+        bulk_handler([data])
+    return handler
+
+
+bulk_handle_user_role_modify_log = bulk_insert(UserRoleModifyLogModel, build_user_role_modify_log)
+bulk_handle_role_permission_modify_log = bulk_insert(RolePermissionModifyLogModel,
+                                                     build_role_permission_modify_log)
+bulk_handle_user_role_data = bulk_insert(UserRoleDataModel, build_user_role_data)
+bulk_handle_role_permission_data = bulk_insert(RolePermissionData, build_role_permission_data)
+
+handle_bg_access_log = single(bulk_handle_bg_access_log)
+handle_user_role_modify_log = single(bulk_handle_user_role_modify_log)
+handle_role_permission_modify_log = single(bulk_handle_role_permission_modify_log)
+handle_user_role_data = single(bulk_handle_user_role_data)
+handle_role_permission_data = single(bulk_handle_role_permission_data)
+handle_employee_position_change_data = single(bulk_handle_employee_position_change_data)
+handle_user_account_data = single(bulk_handle_user_account_data)
 
 
 class Command(BaseCommand):
@@ -169,9 +212,133 @@ class Command(BaseCommand):
         'UserAccountData': handle_user_account_data
     }
 
+    # 支持批量写入的数据类型, 未配置的类型在批量模式下逐条处理
+    type_bulk_dict = {
+        'BgAccessLog': bulk_handle_bg_access_log,
+        'UserRoleModifyLog': bulk_handle_user_role_modify_log,
+        'RolePermissionModifyLog': bulk_handle_role_permission_modify_log,
+        'UserRoleData': bulk_handle_user_role_data,
+        'RolePermissionData': bulk_handle_role_permission_data,
+        'EmployeePositionChangeData': bulk_handle_employee_position_change_data,
+        'UserAccountData': bulk_handle_user_account_data
+    }
+
+    # 数据类型写入后需要失效的缓存命名空间, 仅列出有缓存依赖其写入model的数据类型;
+    # 访问日志可能延迟数小时写入, 需使日志查询结果的缓存(如 has_logs)失效
+    type_cache_namespaces = {
+        'BgAccessLog': [logs_namespace()],
+    }
+    # 数据类型写入后每批次调用一次的失效函数;
+    # 岗位变更数据随员工信息同步上报, 写入后刷新用户信息缓存及员工目录快照
+    type_invalidate_dict = {
+        'EmployeePositionChangeData': UserService.invalidate_users,
+    }
+
+    # 无主私有队列回收间隔(秒)
+    reap_interval = 60
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=0,
+            help="batch consume size, 0 means one by one")
+        parser.add_argument(
+            '--workers',
+            dest='workers',
+            type=int,
+            default=0,
+            help="fork N worker processes under a supervisor")
+
     def handle(self, *args, **options):
-        provider = RedisDataProvider()
+        batch_size = options['batch_size']
+        workers = options['workers']
+        if workers and workers > 0:
+            self.supervise(workers, batch_size)
+        else:
+            self.run_worker(batch_size)
+
+    def run_worker(self, batch_size):
+        provider = get_data_provider()
+        self.deduplicator = MessageDeduplicator(provider.conn)
 
+        if batch_size and batch_size > 1:
+            self.batch_consume(provider, batch_size)
+        else:
+            self.consume(provider)
+
+    def spawn_worker(self, index, batch_size):
+        pid = os.fork()
+        if pid:
+            return pid
+
+        # 子进程: 使用固定序号的私有队列, 重启后优先消费前任遗留数据
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        os.environ['SPECIAL_KEY'] = f'{self.supervisor_key}_{index}'
+        exit_code = 1
+        try:
+            mongo_conn.reconnect_all()
+            self.run_worker(batch_size)
+            exit_code = 0
+        except Exception:
+            logger.exception(f'worker {index} exit unexpectedly')
+        finally:
+            os._exit(exit_code)
+
+    def supervise(self, workers, batch_size):
+        """
+        守护模式: fork多个消费进程, 进程退出后自动拉起, 并定期回收无主私有队列
+        """
+        self.supervisor_key = os.environ.get('SPECIAL_KEY') or os.getpid()
+        self.stopping = False
+
+        def stop(signum, frame):
+            self.stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        children = {}
+        for index in range(workers):
+            children[self.spawn_worker(index, batch_size)] = index
+
+        provider = get_data_provider()
+        last_reap_ts = 0
+        while not self.stopping:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid, status = 0, 0
+            if pid in children:
+                index = children.pop(pid)
+                logger.warning(f'worker {index} pid {pid} exited with status {status}, restarting')
+                children[self.spawn_worker(index, batch_size)] = index
+                continue
+
+            if hasattr(provider, 'reap_orphan_queues') and time.time() - last_reap_ts >= self.reap_interval:
+                last_reap_ts = time.time()
+                try:
+                    reaped = provider.reap_orphan_queues()
+                    if reaped:
+                        logger.info(f'reaped orphan queues: {reaped}')
+                except Exception:
+                    logger.exception('reap orphan queues fail')
+            time.sleep(1)
+
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+    def consume(self, provider):
         while True:
             try:
                 log_str = provider.get_log()
@@ -180,23 +347,99 @@ class Command(BaseCommand):
                 time.sleep(0.1)
                 continue
 
-            handle_success = False
-            err = None
-            for _ in range(2):
-                try:
-                    self.process_log(log_str)
-                    handle_success = True
-                    break
-                except Exception as e:
-                    err = e
-            if not handle_success:
-                logger.exception(f'process log |:{log_str}:| fail', exc_info=err)
+            if self.deduplicator.filter_processed([log_str]) and self.process_single(log_str):
+                self.deduplicator.mark_processed([log_str])
 
             try:
                 provider.ack()
             except Exception:
                 logger.exception(f'ack {provider.business_type} log |:{log_str}:| fail')
 
+    def batch_consume(self, provider, batch_size):
+        while True:
+            try:
+                log_strs = provider.get_logs(batch_size)
+            except Exception:
+                logger.exception(f'get {provider.business_type} logs fail.')
+                time.sleep(0.1)
+                continue
+
+            processed = self.process_batch(self.deduplicator.filter_processed(log_strs))
+            self.deduplicator.mark_processed(processed)
+
+            try:
+                provider.batch_ack(len(log_strs))
+            except Exception:
+                logger.exception(f'ack {provider.business_type} {len(log_strs)} logs fail')
+
+    def process_single(self, log_str, bump_version=True):
+        handle_success = False
+        err = None
+        for _ in range(2):
+            try:
+                data_type = self.process_log(log_str)
+                handle_success = True
+                break
+            except Exception as e:
+                err = e
+        if not handle_success:
+            logger.exception(f'process log |:{log_str}:| fail', exc_info=err)
+        elif bump_version:
+            self.bump_cache_versions([data_type])
+        return handle_success
+
+    def process_batch(self, log_strs):
+        """
+        按data_type分组批量写入, 批量写入失败时退化为逐条处理
+        :return: 处理成功的日志
+        """
+        processed = []
+        groups = defaultdict(list)
+        for log_str in log_strs:
+            try:
+                data_type = json.loads(log_str)['data_type']
+            except Exception:
+                logger.exception(f'parse log |:{log_str}:| fail')
+                continue
+            groups[data_type].append(log_str)
+
+        written_types = set()
+        for data_type, group in groups.items():
+            if data_type in self.type_bulk_dict:
+                try:
+                    self.bulk_process_logs(data_type, group)
+                    processed.extend(group)
+                    written_types.add(data_type)
+                    continue
+                except Exception:
+                    logger.exception(f'bulk process {len(group)} {data_type} logs fail, fallback to single')
+            for log_str in group:
+                if self.process_single(log_str, bump_version=False):
+                    processed.append(log_str)
+                    written_types.add(data_type)
+        self.bump_cache_versions(written_types)
+        return processed
+
+    def bump_cache_versions(self, data_types):
+        """每批次写入后, 对写入数据类型依赖的命名空间各递增一次缓存版本号, 并调用其失效函数"""
+        namespaces = set()
+        for data_type in data_types:
+            namespaces.update(self.type_cache_namespaces.get(data_type, ()))
+        if namespaces:
+            bump_cache_versions(*namespaces)
+        for data_type in data_types:
+            invalidate = self.type_invalidate_dict.get(data_type)
+            if invalidate is None:
+                continue
+            try:
+                invalidate()
+            except Exception:
+                logger.exception(f'invalidate caches of {data_type} fail')
+
+    def bulk_process_logs(self, data_type, log_strs):
+        bulk_handler = self.type_bulk_dict[data_type]
+        bulk_handler([json.loads(log_str)['data'] for log_str in log_strs])
+
     def process_log(self, log_str, retry_count=2):
         err = None
         for _ in range(retry_count):
@@ -207,7 +450,7 @@ class Command(BaseCommand):
 
                 handle_func = self.type_model_dict.get(data_type)
                 handle_func(data)
-                return
+                return data_type
             except Exception as e:
                 err = e
         if err:
@@ -26,6 +26,8 @@ import logging
 
 from django.core.management.base import BaseCommand
 
+from audit.utils import bump_cache_versions, logs_namespace
+
 logger = logging.getLogger(__name__)
 
 
@@ -66,3 +68,5 @@ class Command(BaseCommand):
             raise Exception('start_time must be earlier than end_time, please check !')
 
         MysqlLogSync(start_time, end_time).sync()
+        # 补写的日志可能落在已缓存的日期内
+        bump_cache_versions(logs_namespace())
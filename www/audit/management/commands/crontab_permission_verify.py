@@ -20,19 +20,107 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
 
-import datetime
 import logging
+import multiprocessing
+import time
+import traceback
+import unicodedata
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from audit.models import AuditSysModel
-from audit.rule_handler import (JobTransferHandler, LongTimeNoUseHandler,
-                                PermissionMatrixHandler, ResignUserHandler)
+from audit.rule_handler import (LongTimeNoUseHandler, PermissionMatrixState,
+                                ResignUserHandler)
+from core import mongo_conn
 
 logger = logging.getLogger(__name__)
 
+# 每个业务线依次执行的校验
+SYS_HANDLERS = (
+    ('离职信息', ResignUserHandler),
+    ('长期未使用', LongTimeNoUseHandler),
+)
+
+# 在职状态各业务线共享, 同一进程内同一用户只查询一次
+_staff_map = {}
+
+
+def init_worker():
+    """fork后的子进程重建mongo连接, 并使用独立的在职状态缓存"""
+    mongo_conn.reconnect_all()
+    _staff_map.clear()
+
+
+def display_width(text) -> int:
+    """终端显示宽度, 全角字符占两列"""
+    return sum(2 if unicodedata.east_asian_width(char) in ('F', 'W') else 1 for char in str(text))
+
+
+def ljust(text, width) -> str:
+    return f'{text}{" " * max(width - display_width(text), 0)}'
+
+
+def rjust(text, width) -> str:
+    return f'{" " * max(width - display_width(text), 0)}{text}'
+
+
+def timed_call(func, *args, **kwargs):
+    """
+    :return: (耗时秒数, 异常信息), 异常不向外抛出
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        error = traceback.format_exc()
+    return time.perf_counter() - start, error
+
+
+def verify_audit_sys(audit_sys_id, sys_name) -> dict:
+    """
+    依次执行单个业务线的各项校验, 某一项失败不影响后续校验
+    """
+    logger.info(f'[CRONTAB PERMISSION VERIFY] begin to verify perm of {sys_name}')
+    result = {'sys_name': sys_name, 'timings': {}, 'errors': {}}
+    for name, handler_class in SYS_HANDLERS:
+        logger.info(f'###### {name}校验 STRAT... ######')
+        kwargs = {'staff_map': _staff_map} if handler_class is ResignUserHandler else {}
+        cost, error = timed_call(lambda: handler_class(audit_sys_id, **kwargs).validate_sys())
+        result['timings'][name] = cost
+        if error:
+            logger.error(f'[CRONTAB PERMISSION VERIFY] {name} of {sys_name} fail: {error}')
+            result['errors'][name] = error
+    logger.info(f'[CRONTAB PERMISSION VERIFY] perm verified of {sys_name} finished !!!')
+    return result
+
 
 class Command(BaseCommand):
+    """
+    权限矩阵及各业务线校验; 某项校验失败时记录日志并继续执行其余校验,
+    全部执行完后输出汇总, 有失败时以CommandError退出(非0), 与原先遇到异常即中止的退出状态一致
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            dest='workers',
+            type=int,
+            default=0,
+            help="verify business lines in N worker processes")
+        parser.add_argument(
+            '--incremental',
+            dest='incremental',
+            action='store_true',
+            default=False,
+            help="only re-evaluate permission matrix of users changed since the previous snapshot, "
+                 "resign and long-time-no-use checks still scan every business line")
+        parser.add_argument(
+            '--full-interval',
+            dest='full_interval',
+            type=int,
+            default=7,
+            help="in incremental mode, run a full permission matrix every N days")
 
     def get_audit_sys(self):
         """
@@ -41,14 +129,57 @@ class Command(BaseCommand):
         audit_sys_list = AuditSysModel.objects.all()
         return audit_sys_list
 
+    def verify_matrix(self, audit_sys_list, incremental, full_interval):
+        logger.info('###### 权限矩阵校验 STRAT... ######')
+        self.matrix_full = True
+
+        def verify():
+            # 全部业务线一次聚合、一次批量写入
+            engine, self.matrix_full, config_tag = PermissionMatrixState.build_engine(
+                audit_sys_list, incremental=incremental, full_interval=full_interval)
+            engine.validate()
+            PermissionMatrixState.save(engine.record_date, config_tag, self.matrix_full)
+
+        cost, error = timed_call(verify)
+        if error:
+            logger.error(f'[CRONTAB PERMISSION VERIFY] permission matrix fail: {error}')
+        return cost, error
+
+    def verify_all(self, audit_sys_list, workers):
+        tasks = [(audit_sys.id, audit_sys.sys_name) for audit_sys in audit_sys_list]
+        _staff_map.clear()
+        if not workers or workers <= 1:
+            return [verify_audit_sys(*task) for task in tasks]
+        # 各子进程持有独立的mongo连接, 按业务线逐个分发
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(processes=min(workers, len(tasks)) or 1, initializer=init_worker) as pool:
+            return pool.starmap(verify_audit_sys, tasks, chunksize=1)
+
+    def print_summary(self, matrix_cost, matrix_error, results, total_cost):
+        handler_names = [name for name, _ in SYS_HANDLERS]
+        # 业务线名称多为中文, 按显示宽度对齐
+        name_width = max([display_width('业务线')] + [display_width(r['sys_name']) for r in results]) + 2
+        header = ljust('业务线', name_width) + ''.join(rjust(name, 12) for name in handler_names) + rjust('合计', 10)
+        self.stdout.write(header + '  状态')
+        for result in results:
+            timings = result['timings']
+            row = ljust(result['sys_name'], name_width)
+            row += ''.join(f'{timings.get(name, 0):>11.2f}s' for name in handler_names)
+            row += f'{sum(timings.values()):>9.2f}s  '
+            row += ('失败: ' + ','.join(result['errors'])) if result['errors'] else '成功'
+            self.stdout.write(row)
+        mode = '全量' if self.matrix_full else '增量'
+        self.stdout.write(f'权限矩阵(全部业务线, {mode}) {matrix_cost:.2f}s {"失败" if matrix_error else "成功"}')
+        self.stdout.write(f'总耗时 {total_cost:.2f}s')
+
     def handle(self, *args, **options):
-        audit_sys_list = self.get_audit_sys()
-        for audit_sys in audit_sys_list:
-            logger.info(f'[CRONTAB PERMISSION VERIFY] begin to verify perm of {audit_sys.sys_name}')
-            logger.info('###### 权限矩阵校验 STRAT... ######')
-            PermissionMatrixHandler(audit_sys.id).validate_sys()
-            logger.info('###### 离职信息校验 STRAT... ######')
-            ResignUserHandler(audit_sys.id).validate_sys()
-            logger.info('###### 长时间未使用 STRAT... ######')
-            LongTimeNoUseHandler(audit_sys.id).validate_sys()
-            logger.info(f'[CRONTAB PERMISSION VERIFY] perm verified of {audit_sys.sys_name} finished !!!')
+        start = time.perf_counter()
+        audit_sys_list = list(self.get_audit_sys())
+        matrix_cost, matrix_error = self.verify_matrix(
+            audit_sys_list, options['incremental'], options['full_interval'])
+        results = self.verify_all(audit_sys_list, options['workers'])
+        self.print_summary(matrix_cost, matrix_error, results, time.perf_counter() - start)
+
+        failed = [r['sys_name'] for r in results if r['errors']]
+        if matrix_error or failed:
+            raise CommandError(f'permission verify fail, matrix: {bool(matrix_error)}, business lines: {failed}')
@@ -0,0 +1,71 @@
+# -*- coding:utf-8 -*-
+"""
+岗位变更数据去重并创建(accountid, modify_dt, action)唯一索引, 上线批量写入前执行一次; 重复执行无副作用
+"""
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from audit.models import EmployeePositionChangeDataModel
+from core.utils import split_large_collection
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            dest='dry_run',
+            action='store_true',
+            default=False,
+            help="only count duplicates, do not delete or create index")
+
+    def find_duplicate_ids(self):
+        """
+        同一(accountid, modify_dt, action)保留最后写入的一条, 返回其余记录的_id
+        """
+        pipeline = [
+            {'$sort': {'_id': 1}},
+            {'$group': {
+                '_id': {'accountid': '$accountid', 'modify_dt': '$modify_dt', 'action': '$action'},
+                'ids': {'$push': '$_id'},
+                'count': {'$sum': 1},
+            }},
+            {'$match': {'count': {'$gt': 1}}},
+        ]
+        collection = EmployeePositionChangeDataModel._get_collection()
+        duplicate_ids = []
+        for item in collection.aggregate(pipeline, allowDiskUse=True):
+            duplicate_ids.extend(item['ids'][:-1])
+        return duplicate_ids
+
+    def handle(self, *args, **options):
+        duplicate_ids = self.find_duplicate_ids()
+        logger.info(f'[POSITION CHANGE INDEX] {len(duplicate_ids)} duplicate records found')
+        if options['dry_run']:
+            return
+        collection = EmployeePositionChangeDataModel._get_collection()
+        for ids in split_large_collection(duplicate_ids, 1000):
+            collection.delete_many({'_id': {'$in': ids}})
+        EmployeePositionChangeDataModel.ensure_indexes()
+        logger.info('[POSITION CHANGE INDEX] unique index ensured')
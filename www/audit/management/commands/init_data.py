@@ -37,6 +37,7 @@ from bombus.libs.enums import (AuditPeriodEnum, OnOfflineStatusEnum,
 from bombus.models import AppComplianceModel, FeatureModel, AppStandingBookModel, AppTodoModel, \
     ProjectStandingBookModel, ProjectTodoModel
 from bombus.services.user_model import Employee
+from bombus.services.user_service import UserService
 from core.util import time_util
 from knowledge.models import (RequireModel, TagModel, TagTypeModel,
                               TagTypePropertyModel, PolicyTraceModel, SupervisionModel)
@@ -271,6 +272,7 @@ class Command(BaseCommand):
             if 'status' not in ei:
                 ei['status'] = True
             Employee(**ei).save()
+        UserService.invalidate_users()
 
     def init_job_transfor_data(self):
         data = {
@@ -0,0 +1,37 @@
+# -*- coding:utf-8 -*-
+"""
+员工信息(employee_info、user_supplement_info)同步完成后执行, 使用户信息缓存失效并通知各进程刷新员工目录快照;
+未执行时各进程的员工目录快照每10分钟整体重建, 岗位变更数据入库时也会触发刷新
+"""
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from bombus.services.user_service import UserService
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **options):
+        UserService.invalidate_users()
+        logger.info('[USER DIRECTORY] user cache invalidated, directory version bumped')
@@ -26,17 +26,44 @@ from django.conf import settings
 from mongoengine import (BooleanField, DateField, DateTimeField, DictField,
                          Document, ListField, ReferenceField, StringField)
 from mongoengine.queryset import DoesNotExist
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
+from audit.utils import model_namespace
 from bombus.libs.enums import (AuditPeriodEnum, MessageBoardEnum,
                                OnOfflineStatusEnum, ReviewTypeEnum,
                                RuleTypeEnum, ServerKindEnum, TaskStatusEnum)
+from bombus.services.user_loader import (load_user_by_accountid,
+                                         load_user_by_email, load_user_name,
+                                         load_users_by_accountid)
 from bombus.services.user_service import UserService
+from core.invalidation import invalidated_lru_cache
+from core.redis_conn import cache_version, get_prefixed_client
 from core.util import time_util
+from core.util.cache_util import BatchCacheWrap
 from core.util.time_util import time2str
 from core.utils import get_email_prefix
 
 logger = logging.getLogger(__name__)
 
+# 非标准用户映射按用户缓存, 不同页面的重叠查询共享结果; 非标准用户变更后通过版本号失效
+non_normal_user_cache = BatchCacheWrap(get_prefixed_client('task_has_log'),
+                                       batch_arg='user_tags',
+                                       pre_fix='non_normal_user_map',
+                                       expire=300,
+                                       time_range=60,
+                                       version_store=cache_version,
+                                       namespaces=[model_namespace('NonNormalUserModel')])
+
+# 单记录审阅意见按记录缓存, 审阅意见写入后通过版本号失效
+single_review_cache = BatchCacheWrap(get_prefixed_client('task_has_log'),
+                                     batch_arg='single_ids',
+                                     pre_fix='single_review_content',
+                                     expire=3600,
+                                     time_range=300,
+                                     version_store=cache_version,
+                                     namespaces=[model_namespace('NewReviewCommentModel')])
+
 
 class LastUpdateBaseModel(Document):
     """
@@ -47,11 +74,13 @@ class LastUpdateBaseModel(Document):
     meta = {
         'abstract': True
     }
+    # 存放用户的字段, 列表序列化前批量预加载, 见 bombus.services.user_loader
+    render_user_fields = ('last_update_person',)
 
     @property
     def last_update_person_render(self):
         if self.last_update_person:
-            return (UserService.get_user_by_email(self.last_update_person) or {}).get('name')
+            return (load_user_by_email(self.last_update_person) or {}).get('name')
         return ''
 
     @property
@@ -82,6 +111,8 @@ class AuditSysModel(LastUpdateBaseModel):
         'collection': 'audit_sys',
         'verbose_name': '业务线审阅人'
     }
+    render_user_fields = ('last_update_person', 'leader', 'sa_auditor', 'dba_auditor',
+                          'app_auditor', 'sys_db_auditor', 'ticket_auditor')
 
     @classmethod
     def get_sys_id_by_online_ticket_dept(cls, dept_id):
@@ -105,12 +136,17 @@ class AuditSysModel(LastUpdateBaseModel):
 
     @classmethod
     def get_fmt_db_dept_tip(cls, id) -> list:
+        return list(cls._get_fmt_db_dept_tip(str(getattr(id, 'id', id))))
+
+    @classmethod
+    @invalidated_lru_cache([model_namespace('AuditSysModel')], max_size=256)
+    def _get_fmt_db_dept_tip(cls, id) -> tuple:
         try:
             instance = cls.objects.get(id=id)
             tip = instance.db_dept_tip or ''
-            return list(filter(None, tip.split(';')))
+            return tuple(filter(None, tip.split(';')))
         except:
-            return []
+            return ()
 
     @classmethod
     def get_sys_by_user_on_auditor(cls, user):
@@ -212,7 +248,7 @@ class AuditSysModel(LastUpdateBaseModel):
         user_names = []
         error_ids = []
         id_list = cls.split_auditor(auditors)
-        batch_user_info = UserService.batch_get_user_by_accountid(id_list)
+        batch_user_info = load_users_by_accountid(id_list)
         for accountid in id_list:
             name = (batch_user_info.get(accountid) or {}).get('name')
             if name:
@@ -324,10 +360,15 @@ class AuditServerModel(Document):
 
     @classmethod
     def get_server_name_list(cls, audit_sys, server_kind):
+        return list(cls._get_server_name_list(str(getattr(audit_sys, 'id', audit_sys)), server_kind))
+
+    @classmethod
+    @invalidated_lru_cache([model_namespace('AuditServerModel')], max_size=512)
+    def _get_server_name_list(cls, audit_sys, server_kind) -> tuple:
         if not server_kind == ServerKindEnum.APP.name:
-            return list(cls.objects.filter(
+            return tuple(cls.objects.filter(
                 audit_sys=audit_sys, server_kind=server_kind)
-                        .distinct('server_name'))
+                         .distinct('server_name'))
         else:
             bg_names = []
             bg_alias_list = list(cls.objects.filter(
@@ -335,7 +376,7 @@ class AuditServerModel(Document):
                                  .distinct('bg_alias'))
             for bg_alias in bg_alias_list:
                 bg_names.extend(bg_alias.split(','))
-            return list(filter(None, bg_names))
+            return tuple(filter(None, bg_names))
 
     @classmethod
     def get_assets(cls, audit_sys, server_kind=None):
@@ -537,6 +578,13 @@ class NonNormalUserModel(LastUpdateBaseModel):
             app:  account_id->normal_account_id
             sa/db: email->normal_email
         """
+        # 业务线统一为id字符串, 保证缓存key一致
+        audit_sys = str(getattr(audit_sys, 'id', audit_sys))
+        return defaultdict(set, cls._get_user_map(user_tags, audit_sys, server_kind, reverse=reverse))
+
+    @classmethod
+    @non_normal_user_cache
+    def _get_user_map(cls, user_tags: list, audit_sys: str, server_kind, reverse=False) -> dict:
         ori_user_column = 'name'
         normal_user_column = 'user' if server_kind == ServerKindEnum.APP.name else 'user_email'
         ret_res = defaultdict(set)
@@ -597,6 +645,7 @@ class TaskManagerModel(LastUpdateBaseModel):
         'collection': 'task_manager',
         'verbose_name': '任务配置'
     }
+    render_user_fields = ('last_update_person', 'follow_up_person')
 
     @classmethod
     def get_atoms_by_sys(cls, sys_id):
@@ -632,7 +681,7 @@ class TaskManagerModel(LastUpdateBaseModel):
 
     @property
     def follow_up_person_render(self):
-        return UserService.get_user_name(self.follow_up_person) or '-'
+        return load_user_name(self.follow_up_person) or '-'
 
     @property
     def sys_render(self):
@@ -887,6 +936,7 @@ class BgAccessLogModel(Document):
             'user', 'access_dt', 'bg_name'
         ]
     }
+    render_user_fields = ('user',)
 
     @property
     def access_dt_render(self):
@@ -895,12 +945,64 @@ class BgAccessLogModel(Document):
     @property
     def user_render(self):
         try:
-            ums_info = UserService.query_accountid(self.user)
+            ums_info = load_user_by_accountid(self.user, status=True)
             return (ums_info or {}).get('name') or self.user
         except:
             return self.user
 
 
+class BgLastAccessModel(Document):
+    """应用后台用户最近一次访问时间, 由后台日志汇总"""
+    bg_name = StringField(max_length=20, required=True, verbose_name='后台名称')
+    user = StringField(required=True, verbose_name='请求人')
+    last_access_dt = DateTimeField(required=True, verbose_name='最近请求时间')
+    meta = {
+        'collection': 'bg_last_access',
+        'verbose_name': '应用后台最近访问',
+        'indexes': [
+            {'fields': ('bg_name', 'user'), 'unique': True},
+            ('bg_name', 'last_access_dt'),
+        ]
+    }
+
+    @classmethod
+    def bulk_touch(cls, accesses):
+        """
+        按(bg_name, user)以$max更新最近访问时间, 重复或乱序写入不影响结果
+        :param accesses: [(bg_name, user, access_dt), ...]
+        """
+        latest = {}
+        for bg_name, user, access_dt in accesses:
+            key = (bg_name, user)
+            if key not in latest or access_dt > latest[key]:
+                latest[key] = access_dt
+        requests = [
+            UpdateOne({'bg_name': bg_name, 'user': user}, {'$max': {'last_access_dt': access_dt}}, upsert=True)
+            for (bg_name, user), access_dt in latest.items()
+        ]
+        if not requests:
+            return
+        try:
+            cls._get_collection().bulk_write(requests, ordered=False)
+        except BulkWriteError:
+            # 并发upsert同一用户时唯一索引冲突, 重试时已存在的记录走更新
+            cls._get_collection().bulk_write(requests, ordered=False)
+
+    @classmethod
+    def get_dormant_users(cls, bg_names: list, before_dt) -> set:
+        """
+        在bg_names中有过访问, 且最近一次访问不晚于before_dt的用户
+        """
+        if not bg_names:
+            return set()
+        pipeline = [
+            {'$match': {'bg_name': {'$in': list(bg_names)}}},
+            {'$group': {'_id': '$user', 'last_access_dt': {'$max': '$last_access_dt'}}},
+            {'$match': {'last_access_dt': {'$lte': before_dt}}},
+        ]
+        return {item['_id'] for item in cls._get_collection().aggregate(pipeline, allowDiskUse=True)}
+
+
 class UserRoleModifyLogModel(Document):
     bg_name = StringField(max_length=20, required=True, verbose_name='后台名称')
     user = StringField(max_length=9, required=True, verbose_name='请求人')
@@ -941,9 +1043,32 @@ class UserRoleDataModel(Document):
             'record_date',
             'create_dt',
             'dept_name',
+            ('bg_name', 'user'),
         ]
     }
 
+    @classmethod
+    def get_first_seen_map(cls, bg_name, users: list, chunk_size=1000) -> dict:
+        """
+        批量获取用户在对应后台最早的创建时间, 无创建时间时取最早统计日期
+        """
+        result = {}
+        users = list(set(users))
+        for i in range(0, len(users), chunk_size):
+            query_list = cls._get_collection().aggregate([
+                {'$match': {'bg_name': bg_name, 'user': {'$in': users[i:i + chunk_size]}}},
+                {'$group': {
+                    '_id': '$user',
+                    'create_dt': {'$min': '$create_dt'},
+                    'record_date': {'$min': '$record_date'}
+                }}
+            ])
+            for r in query_list:
+                first_seen = r['create_dt'] or r['record_date']
+                if first_seen:
+                    result[r['_id']] = first_seen
+        return result
+
 
 class UserSupplementInfo(Document):
     accountid = StringField(required=True, verbose_name='accountid', unique=True)
@@ -1014,6 +1139,33 @@ class EmployeePositionChangeDataModel(Document):
     department_after = StringField(required=True, verbose_name='变更后部门')
     modify_dt = DateTimeField(required=True, verbose_name='变更时间')
     action = StringField(required=False, verbose_name='变更类型')
+    meta = {
+        # 历史数据可能存在重复, 唯一索引由 ensure_position_change_index 命令去重后创建
+        'auto_create_index': False,
+        'indexes': [
+            {'fields': ('accountid', 'modify_dt', 'action'), 'unique': True}
+        ]
+    }
+
+    @classmethod
+    def bulk_upsert(cls, datas: list):
+        """
+        按(accountid, modify_dt, action)批量写入, 重复投递时覆盖而不新增
+        """
+        requests = {}
+        for data in datas:
+            instance = cls(**data)
+            instance.validate()
+            doc = instance.to_mongo().to_dict()
+            doc.pop('_id', None)
+            key = (doc['accountid'], doc['modify_dt'], doc.get('action'))
+            requests[key] = UpdateOne(
+                {'accountid': doc['accountid'], 'modify_dt': doc['modify_dt'], 'action': doc.get('action')},
+                {'$set': doc},
+                upsert=True
+            )
+        if requests:
+            cls._get_collection().bulk_write(list(requests.values()), ordered=False)
 
     @classmethod
     def get_accountid_by_time_range(cls, start_time, end_time):
@@ -1036,6 +1188,26 @@ class UserAccountDataModel(Document):
         ]
     }
 
+    @classmethod
+    def bulk_upsert(cls, datas: list):
+        """
+        按(bg_name, user_id)批量更新accountid, 不存在时创建
+        """
+        today = time_util.today()
+        requests = {}
+        for data in datas:
+            key = (data['bg_name'], data['user_id'])
+            requests[key] = UpdateOne(
+                {'bg_name': data['bg_name'], 'user_id': data['user_id']},
+                {
+                    '$set': {'accountid': data['accountid'], 'update_date': today},
+                    '$setOnInsert': {'create_date': today}
+                },
+                upsert=True
+            )
+        if requests:
+            cls._get_collection().bulk_write(list(requests.values()), ordered=False)
+
     @classmethod
     def get_accountid_by_user(cls, bg_name, user_id):
         if not user_id:
@@ -1081,6 +1253,7 @@ class ReviewCommentModel(Document):
             ('task', 'server_kind', 'review_type', 'user', 'record_id')
         ]
     }
+    render_user_fields = ('user',)
 
     @classmethod
     def get_review_content(cls, server_kind, review_type, record_ids, task=None, dept=None, period=None):
@@ -1112,7 +1285,7 @@ class ReviewCommentModel(Document):
 
     @property
     def user_render(self):
-        return UserService.get_user_name(self.user)
+        return load_user_name(self.user)
 
     @property
     def created_time_render(self):
@@ -1139,10 +1312,11 @@ class TaskMessageBoardModel(Document):
             ('task', 'server_kind', 'review_type')
         ]
     }
+    render_user_fields = ('user',)
 
     @property
     def user_render(self):
-        return UserService.get_user_name(self.user)
+        return load_user_name(self.user)
 
     @property
     def created_time_render(self):
@@ -1203,6 +1377,27 @@ class RiskUserModel(Document):
             risk_user.update(risk_params)
             cls(**risk_user).save()
 
+    @classmethod
+    def bulk_update_risk_users(cls, risk_users: list):
+        """
+        批量更新用户异常信息, 与 update_risk_user 等价
+        :param risk_users: [(user, audit_sys, risk_params), ...]
+        """
+        risk_day = time_util.yesterday()
+        audit_sys_field = cls._fields['audit_sys']
+        risk_map = defaultdict(dict)
+        for user, audit_sys, risk_params in risk_users:
+            risk_params = {k: v for k, v in (risk_params or {}).items() if v}
+            if risk_params:
+                risk_map[(user, audit_sys_field.to_mongo(audit_sys))].update(risk_params)
+        requests = [
+            UpdateOne({'user': user, 'audit_sys': audit_sys, 'record_date': risk_day},
+                      {'$set': risk_params}, upsert=True)
+            for (user, audit_sys), risk_params in risk_map.items()
+        ]
+        if requests:
+            cls._get_collection().bulk_write(requests, ordered=False)
+
     @classmethod
     def update_no_risk_users(cls, users, audit_sys):
         try:
@@ -1285,6 +1480,7 @@ class MysqlLogModel(Document):
             'time'
         ]
     }
+    render_user_fields = ('user',)
 
     @property
     def user_render(self):
@@ -1292,9 +1488,9 @@ class MysqlLogModel(Document):
         try:
             if user_id.isdigit():
                 account_id = user_id
-                user_info = UserService.query_accountid(account_id)
+                user_info = load_user_by_accountid(account_id, status=True)
             else:
-                user_info = UserService.get_user_by_email(user_id)
+                user_info = load_user_by_email(user_id)
             return (user_info or {}).get('name')
         except Exception as e:
             return user_id
@@ -1478,6 +1674,7 @@ class NewReviewCommentModel(Document):
             ('task', 'review_type', 'created_time', 'user', 'single_id')
         ]
     }
+    render_user_fields = ('user',)
 
     @classmethod
     def expand_task_info(cls, task_id, review_type):
@@ -1497,6 +1694,7 @@ class NewReviewCommentModel(Document):
             return result
 
     @classmethod
+    @single_review_cache
     def get_single_review_content(cls, task_id, review_type, single_ids):
         """
         获取个人审阅意见
@@ -1565,7 +1763,7 @@ class NewReviewCommentModel(Document):
 
     @property
     def user_render(self):
-        return UserService.get_user_name(self.user)
+        return load_user_name(self.user)
 
     @property
     def created_time_render(self):
@@ -1627,10 +1825,11 @@ class NewMessageBoardModel(Document):
             {'fields': ('dept', 'period')}
         ]
     }
+    render_user_fields = ('user',)
 
     @property
     def user_render(self):
-        return UserService.get_user_name(self.user)
+        return load_user_name(self.user)
 
     @property
     def created_time_render(self):
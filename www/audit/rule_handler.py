@@ -23,45 +23,56 @@ concrete logic of audit_rule
 
 import abc
 import datetime
+import json
 import logging
 import re
+from collections import defaultdict
 
 import arrow
 from django.conf import settings
 from django.utils.functional import cached_property
 from mongoengine.queryset.visitor import Q
+from pymongo import UpdateMany
 
 from audit.models import (AuditServerModel, AuditSysModel, AuditTaskModel,
-                          BgAccessLogModel, DbUserRoleModel,
+                          BgLastAccessModel, DbUserRoleModel,
                           EmployeePositionChangeDataModel,
                           JobTransferRiskModel, NonNormalUserModel,
                           RiskUserModel, ServerInfo, TaskManagerModel,
                           UserRoleDataModel)
+from audit.utils import (audit_sys_namespace, bump_cache_versions,
+                         model_namespace, task_namespace)
 from bombus.libs.enums import AuditPeriodEnum, RuleTypeEnum, ServerKindEnum
 from bombus.libs.exception import FastResponse
 from bombus.services.mysql_service import (get_db_name_by_dept,
                                            get_db_node_by_host)
 from bombus.services.user_service import UserService
+from core.invalidation import invalidated_cached_property
+from core.redis_conn import cache_version, get_prefixed_client
 from core.util import time_util
+from core.util.hash_util import md5
 from core.utils import date2datetime, get_email_prefix, split_large_collection
 
 logger = logging.getLogger(__name__)
 
 
-class BaseHandler:
+class BaseHandler(abc.ABC):
 
-    def __init__(self, audit_sys):
+    def __init__(self, audit_sys, sys_instance=None):
         self.audit_sys = audit_sys
-        self.sys_instance = AuditSysModel.objects.get(id=audit_sys)
+        self.sys_instance = sys_instance or AuditSysModel.objects.get(id=audit_sys)
 
     def convert_user_to_id(self, users: list):
+        users = [str(user) for user in users]
+        # 非accountid的用户统一批量查询
+        emails = {user: UserService.get_email_prefix(user) for user in users if not user.isdigit()}
+        ums_map = UserService.batch_get_user_by_email(list(set(emails.values()))) if emails else {}
         user_account_ids = []
         self.id2user = {}
         for user in users:
-            user = str(user)
             accountid = user
             if not user.isdigit():
-                ums_info = UserService.get_user_by_email(user) or {}
+                ums_info = ums_map.get(emails[user]) or {}
                 accountid = ums_info.get('accountid') or None
                 if accountid:
                     self.id2user[accountid] = user
@@ -83,7 +94,7 @@ class BaseHandler:
                 users.append(accountid)
         return users
 
-    @cached_property
+    @invalidated_cached_property([model_namespace('AuditServerModel')])
     def all_server_names(self):
         return AuditServerModel.get_server_name_list(self.audit_sys, self.server_kind)
 
@@ -115,12 +126,39 @@ class BaseHandler:
         return users
 
     def update_risk_tag(self, users, validated):
+        self._update_risk_tag(self.original_users(users), validated)
+
+    def original_users(self, users):
+        """accountid转换为各数据表中存储的原始用户名"""
         cus_users = self.convert_id_to_user(users)
-        ori_users = self.convert_normal_users(cus_users, reverse=True)
-        self._update_risk_tag(ori_users, validated)
+        return self.convert_normal_users(cus_users, reverse=True)
+
+    @abc.abstractmethod
+    def risk_tag_filter(self, users):
+        """昨日数据中属于本业务线资产且用户在users中的记录"""
+
+    def candidate_users(self, accountids, id2email: dict):
+        """
+        不经 fmt_users 时无法还原原始用户名, 以accountid、邮箱前缀及其非标准用户名作为候选
+        """
+        users = set(accountids) | {id2email[_id] for _id in accountids if id2email.get(_id)}
+        return list(users | set(self.convert_normal_users(list(users), reverse=True)))
+
+    def risk_tag_update(self, users, validated):
+        return self.risk_tag_request(self.original_users(users), validated)
+
+    def risk_tag_request(self, ori_users, validated):
+        """构造批量更新risk_tag的请求, 与 _update_risk_tag 等价"""
+        query = self.model.objects.filter(self.risk_tag_filter(ori_users))._query
+        return UpdateMany(query, {
+            '$set': {'risk_tag': not validated},
+            '$addToSet': {'risk_sys': self.sys_instance.pk},
+        })
 
     def _update_risk_tag(self, ori_user, validated):
-        pass
+        self.model.objects.filter(
+            self.risk_tag_filter(ori_user)
+        ).update(risk_tag=(not validated), add_to_set__risk_sys=self.sys_instance)
 
 
 class AppPermHandler(BaseHandler):
@@ -149,12 +187,8 @@ class AppPermHandler(BaseHandler):
                 users.extend(bg_users)
         return list(set(users))
 
-    def _update_risk_tag(self, users, validated):
-        self.model.objects.filter(
-            bg_name__in=self.all_server_names,
-            user__in=users,
-            record_date=self.yesterday_date
-        ).update(risk_tag=(not validated), add_to_set__risk_sys=self.sys_instance)
+    def risk_tag_filter(self, users):
+        return Q(bg_name__in=self.all_server_names, user__in=users, record_date=self.yesterday_date)
 
 
 class SysPermHandler(BaseHandler):
@@ -169,7 +203,7 @@ class SysPermHandler(BaseHandler):
             record_date=self.yesterday_date
         ).values_list('root_user').distinct('root_user')
 
-    @cached_property
+    @invalidated_cached_property([model_namespace('AuditServerModel')])
     def clear_server_names(self):
         clear_server_names = self.all_server_names
         re_pattern = '|'.join(self.SELF_OPERATE_TAG)
@@ -183,12 +217,8 @@ class SysPermHandler(BaseHandler):
             record_date=self.yesterday_date
         ).values_list('root_user').distinct('root_user')
 
-    def _update_risk_tag(self, users, validated):
-        self.model.objects.filter(
-            server_name__in=self.all_server_names,
-            record_date=self.yesterday_date,
-            root_user__in=users
-        ).update(risk_tag=(not validated), add_to_set__risk_sys=self.sys_instance)
+    def risk_tag_filter(self, users):
+        return Q(server_name__in=self.all_server_names, record_date=self.yesterday_date, root_user__in=users)
 
 
 class DbPermHandler(BaseHandler):
@@ -222,16 +252,18 @@ class DbPermHandler(BaseHandler):
         record_date_filter = Q(**{'record_date': self.yesterday_date})
         return self.model.objects.filter(asset_filter & record_date_filter).values_list('user').distinct('user')
 
+    def asset_query(self) -> dict:
+        """业务线资产范围的原始查询条件"""
+        return self.model.objects.filter(self.get_asset_filter())._query
+
     def get_admin_users(self):
         return settings.DBA
 
-    def _update_risk_tag(self, users, validated):
+    def risk_tag_filter(self, users):
         asset_filter = self.get_asset_filter()
         record_date_filter = Q(**{'record_date': self.yesterday_date})
         user_filter = Q(**{'user__in': users})
-        self.model.objects.filter(
-            asset_filter & record_date_filter & user_filter
-        ).update(risk_tag=(not validated), add_to_set__risk_sys=self.sys_instance)
+        return asset_filter & record_date_filter & user_filter
 
 
 class AuditRuleHandler(metaclass=abc.ABCMeta):
@@ -246,14 +278,20 @@ class AuditRuleHandler(metaclass=abc.ABCMeta):
             'configurable': cls.configurable
         }
 
+    def bump_cache_versions(self, *models, extra_namespaces=()):
+        """写入风险数据后, 使业务线及相关model的缓存失效"""
+        bump_cache_versions(audit_sys_namespace(self.audit_sys),
+                            *map(model_namespace, models), *extra_namespaces)
+
 
 class PermRuleHandler(AuditRuleHandler):
 
-    def __init__(self, audit_sys):
+    def __init__(self, audit_sys, sys_instance=None):
         self.audit_sys = audit_sys
-        self.app_handler = AppPermHandler(audit_sys)
-        self.sys_handler = SysPermHandler(audit_sys)
-        self.db_handler = DbPermHandler(audit_sys)
+        self.sys_instance = sys_instance or AuditSysModel.objects.get(id=audit_sys)
+        self.app_handler = AppPermHandler(audit_sys, self.sys_instance)
+        self.sys_handler = SysPermHandler(audit_sys, self.sys_instance)
+        self.db_handler = DbPermHandler(audit_sys, self.sys_instance)
 
     def get_audit_sys_users(self):
         """
@@ -282,20 +320,12 @@ class PermissionMatrixHandler(PermRuleHandler):
         """
         验证业务线内权限相容情况
         """
-        # 下面的所有user都是accountid
-        app_admin_list = self.app_handler.admin_users()
-        sa_list = self.sys_handler.admin_users()
-        dba_list = self.db_handler.admin_users()
-        set_app_list = set(app_admin_list)
-        set_sa_list = set(sa_list)
-        set_dba_list = set(dba_list)
-        all_admin_users = (set_app_list & set_dba_list) | (set_app_list & set_sa_list) | (set_dba_list & set_sa_list)
-        for user in all_admin_users:
-            self.update_risk_user(user, user in app_admin_list, user in sa_list, user in dba_list)
+        PermissionMatrixEngine([self]).validate()
 
-    def update_risk_user(self, user, is_app_admin, is_sa, is_dba):
+    @classmethod
+    def check_admin(cls, is_app_admin, is_sa, is_dba):
         """
-        更新用户风险记录
+        :return: (是否相容, 异常说明)
         """
         admin_value = is_app_admin + is_dba + is_sa
         validated = False
@@ -312,8 +342,385 @@ class PermissionMatrixHandler(PermRuleHandler):
                 (is_sa and '系统管理员' or ''),
                 (is_dba and '数据库管理员' or '')]))
             admin_desc = '兼具' + admin_desc
-        RiskUserModel.update_risk_user(user, self.audit_sys, {'matrix_risk': admin_desc})
-        self.callback_risk_tag([user], validated)
+        return validated, admin_desc
+
+
+class PermissionMatrixEngine(object):
+    """
+    多个业务线的权限矩阵一次校验:
+    按日期聚合取出全部业务线涉及的应用管理员及主机root用户, 各业务线内用集合运算求兼任关系,
+    异常用户及各数据表的risk_tag分别按集合一次bulk_write
+    """
+
+    def __init__(self, handlers: list):
+        self.handlers = handlers
+        self.record_date = time_util.yesterday()
+
+    def get_bg_admins(self) -> dict:
+        """
+        :return: 应用后台 -> 管理员角色的用户集合
+        """
+        role_map = {}
+        for handler in self.handlers:
+            app_handler = handler.app_handler
+            for bg_name in app_handler.all_server_names:
+                admin_role = app_handler.get_admin_role_by_bg(bg_name)
+                if admin_role:
+                    role_map[bg_name] = admin_role
+        if not role_map:
+            return {}
+        pipeline = [
+            {'$match': {
+                'record_date': self.record_date,
+                'bg_name': {'$in': list(role_map)},
+                'role': {'$in': list(set(role_map.values()))},
+            }},
+            {'$group': {'_id': {'bg_name': '$bg_name', 'role': '$role'}, 'users': {'$addToSet': '$user'}}},
+        ]
+        bg_admins = defaultdict(set)
+        for item in UserRoleDataModel._get_collection().aggregate(pipeline, allowDiskUse=True):
+            bg_name, role = item['_id']['bg_name'], item['_id']['role']
+            if role_map.get(bg_name) == role:
+                bg_admins[bg_name].update(item['users'])
+        return bg_admins
+
+    def get_server_roots(self) -> dict:
+        """
+        :return: 主机 -> root用户集合, 不含自运维主机
+        """
+        server_names = set()
+        for handler in self.handlers:
+            server_names.update(handler.sys_handler.clear_server_names)
+        if not server_names:
+            return {}
+        pipeline = [
+            {'$match': {'record_date': self.record_date, 'server_name': {'$in': list(server_names)}}},
+            {'$group': {'_id': '$server_name', 'users': {'$addToSet': '$root_user'}}},
+        ]
+        return {
+            item['_id']: set(item['users'])
+            for item in ServerInfo._get_collection().aggregate(pipeline, allowDiskUse=True)
+        }
+
+    def validate(self):
+        bg_admins = self.get_bg_admins()
+        server_roots = self.get_server_roots()
+        risk_users = []
+        tag_updates = defaultdict(list)
+        results = {}
+        for handler in self.handlers:
+            # 下面的所有user都是accountid
+            app_users = set().union(*(bg_admins.get(bg, ()) for bg in handler.app_handler.all_server_names))
+            sa_users = set().union(*(server_roots.get(name, ()) for name in handler.sys_handler.clear_server_names))
+            set_app_list = set(handler.app_handler.fmt_users(list(app_users)))
+            set_sa_list = set(handler.sys_handler.fmt_users(list(sa_users)))
+            set_dba_list = set(handler.db_handler.admin_users())
+            all_admin_users = ((set_app_list & set_dba_list) | (set_app_list & set_sa_list)
+                               | (set_dba_list & set_sa_list))
+
+            grouped = defaultdict(list)
+            result = results[str(handler.audit_sys)] = {}
+            for user in all_admin_users:
+                validated, admin_desc = handler.check_admin(
+                    user in set_app_list, user in set_sa_list, user in set_dba_list)
+                risk_users.append((user, handler.audit_sys, {'matrix_risk': admin_desc}))
+                grouped[validated].append(user)
+                result[user] = admin_desc
+            for validated, users in grouped.items():
+                for perm_handler in (handler.app_handler, handler.sys_handler, handler.db_handler):
+                    tag_updates[perm_handler.model].append(perm_handler.risk_tag_update(users, validated))
+        self.save_result(risk_users, tag_updates, results)
+
+    def save_result(self, risk_users, tag_updates, results):
+        """
+        results: 业务线id -> {兼任多个管理员的用户: 异常说明(相容时为空)}, 供次日增量校验沿用
+        """
+        RiskUserModel.bulk_update_risk_users(risk_users)
+        for model, requests in tag_updates.items():
+            # 保持业务线顺序, 同一记录以后处理的业务线为准
+            model._get_collection().bulk_write(requests, ordered=True)
+        PermissionMatrixState.save_results(self.record_date, results)
+
+        namespaces = [audit_sys_namespace(handler.audit_sys) for handler in self.handlers]
+        bump_cache_versions(*namespaces, *map(model_namespace, (RiskUserModel, UserRoleDataModel,
+                                                                 ServerInfo, DbUserRoleModel)))
+
+
+class SnapshotDelta(object):
+    """
+    相邻两天快照的差异, 只比较决定权限的字段
+    filters: model -> 附加的查询条件, 按业务线资产过滤, 避免一次载入全部快照
+    """
+    snapshot_fields = (
+        (UserRoleDataModel, ('bg_name', 'user', 'role')),
+        (ServerInfo, ('server_name', 'root_user')),
+        (DbUserRoleModel, ('user', 'role')),
+    )
+
+    def __init__(self, prev_date, record_date, filters=None):
+        self.prev_date = prev_date
+        self.record_date = record_date
+        self.filters = filters or {}
+        self.added = {}
+        self.removed = {}
+        # 任一天快照缺失时差异不可信
+        self.complete = True
+
+    @staticmethod
+    def load_tuples(model, fields, record_date, query=None) -> set:
+        projection = dict.fromkeys(fields, 1)
+        projection['_id'] = 0
+        cursor = model._get_collection().find(dict(query or {}, record_date=record_date), projection)
+        return {tuple(item.get(field) for field in fields) for item in cursor}
+
+    def compute(self):
+        for model, fields in self.snapshot_fields:
+            query = self.filters.get(model)
+            prev_tuples = self.load_tuples(model, fields, self.prev_date, query)
+            cur_tuples = self.load_tuples(model, fields, self.record_date, query)
+            if bool(prev_tuples) != bool(cur_tuples):
+                self.complete = False
+            self.added[model] = cur_tuples - prev_tuples
+            self.removed[model] = prev_tuples - cur_tuples
+        return self
+
+    def changed(self, model) -> set:
+        return self.added[model] | self.removed[model]
+
+    def app_users(self, bg_names) -> set:
+        return {user for bg_name, user, role in self.changed(UserRoleDataModel) if bg_name in bg_names}
+
+    def sys_users(self, server_names) -> set:
+        return {user for server_name, user in self.changed(ServerInfo) if server_name in server_names}
+
+    def db_users(self) -> set:
+        return {user for user, role in self.changed(DbUserRoleModel)}
+
+
+class IncrementalPermissionMatrixEngine(PermissionMatrixEngine):
+    """
+    增量校验: 逐个业务线比较相邻两天的快照, 只重新计算有变化的用户,
+    其余用户(包括相容的用户)沿用上一天的权限矩阵结果, 同样写入本次的risk_sys/risk_tag;
+    业务线快照缺失时该业务线按全量计算.
+    前提是上一天已完成校验并保存了结果, 且业务线资产、非标准用户、管理员配置均未变化, 由调用方判断.
+    只覆盖权限矩阵, 离职信息、长期未使用仍为逐业务线全量校验
+    """
+
+    def __init__(self, handlers: list, prev_date, prev_results: dict):
+        """
+        prev_results: 上一天 save_result 保存的各业务线结果
+        """
+        super().__init__(handlers)
+        self.prev_date = prev_date
+        self.prev_results = prev_results
+
+    def handler_delta(self, handler) -> SnapshotDelta:
+        """只载入该业务线资产范围内的两天快照"""
+        filters = {
+            UserRoleDataModel: {'bg_name': {'$in': list(handler.app_handler.all_server_names)}},
+            ServerInfo: {'server_name': {'$in': list(handler.sys_handler.all_server_names)}},
+            DbUserRoleModel: handler.db_handler.asset_query(),
+        }
+        return SnapshotDelta(self.prev_date, self.record_date, filters).compute()
+
+    def affected_users(self, handler, delta: SnapshotDelta) -> set:
+        if not delta.complete:
+            return set(handler.get_audit_sys_users())
+        app_handler, sys_handler, db_handler = handler.app_handler, handler.sys_handler, handler.db_handler
+        users = set(app_handler.fmt_users(list(delta.app_users(set(app_handler.all_server_names)))))
+        users |= set(sys_handler.fmt_users(list(delta.sys_users(set(sys_handler.all_server_names)))))
+        users |= set(db_handler.fmt_users(list(delta.db_users())))
+        return users
+
+    def carried_users(self, handler, delta: SnapshotDelta, affected: set) -> dict:
+        """
+        :return: 上一天兼任多个管理员且本次不受影响的用户 -> 异常说明(相容时为空)
+        """
+        if not delta.complete:
+            return {}
+        prev_result = self.prev_results.get(str(handler.audit_sys)) or {}
+        return {user: admin_desc for user, admin_desc in prev_result.items() if user not in affected}
+
+    def get_app_admins(self, app_handler, candidates: list) -> set:
+        role_map = {}
+        for bg_name in app_handler.all_server_names:
+            admin_role = app_handler.get_admin_role_by_bg(bg_name)
+            if admin_role:
+                role_map[bg_name] = admin_role
+        if not role_map or not candidates:
+            return set()
+        cursor = UserRoleDataModel._get_collection().find({
+            'record_date': self.record_date,
+            'bg_name': {'$in': list(role_map)},
+            'user': {'$in': candidates},
+        }, {'bg_name': 1, 'user': 1, 'role': 1, '_id': 0})
+        raw_users = {item['user'] for item in cursor if role_map.get(item['bg_name']) == item['role']}
+        return set(app_handler.fmt_users(list(raw_users)))
+
+    def get_sa_admins(self, sys_handler, candidates: list) -> set:
+        if not sys_handler.clear_server_names or not candidates:
+            return set()
+        raw_users = ServerInfo._get_collection().distinct('root_user', {
+            'record_date': self.record_date,
+            'server_name': {'$in': list(sys_handler.clear_server_names)},
+            'root_user': {'$in': candidates},
+        })
+        return set(sys_handler.fmt_users(raw_users))
+
+    def validate(self):
+        risk_users = []
+        tag_updates = defaultdict(list)
+        results = {}
+        for handler in self.handlers:
+            app_handler, sys_handler, db_handler = handler.app_handler, handler.sys_handler, handler.db_handler
+            # 下面的所有user都是accountid
+            delta = self.handler_delta(handler)
+            affected = self.affected_users(handler, delta)
+            carried = self.carried_users(handler, delta, affected)
+            result = results[str(handler.audit_sys)] = dict(carried)
+            if not affected and not carried:
+                continue
+            id2email = UserService.batch_id_to_email(list(affected | set(carried)))
+
+            grouped = defaultdict(list)
+            if affected:
+                set_app_list = self.get_app_admins(app_handler, app_handler.candidate_users(affected, id2email))
+                set_sa_list = self.get_sa_admins(sys_handler, sys_handler.candidate_users(affected, id2email))
+                set_dba_list = set(db_handler.admin_users())
+                set_app_list &= affected
+                set_sa_list &= affected
+                set_dba_list &= affected
+                all_admin_users = ((set_app_list & set_dba_list) | (set_app_list & set_sa_list)
+                                   | (set_dba_list & set_sa_list))
+                for user in all_admin_users:
+                    validated, admin_desc = handler.check_admin(
+                        user in set_app_list, user in set_sa_list, user in set_dba_list)
+                    risk_users.append((user, handler.audit_sys, {'matrix_risk': admin_desc}))
+                    grouped[validated].append(user)
+                    result[user] = admin_desc
+            for user, admin_desc in carried.items():
+                risk_users.append((user, handler.audit_sys, {'matrix_risk': admin_desc}))
+                grouped[not admin_desc].append(user)
+
+            for validated, users in grouped.items():
+                for perm_handler in (app_handler, sys_handler, db_handler):
+                    ori_users = perm_handler.candidate_users(users, id2email)
+                    tag_updates[perm_handler.model].append(perm_handler.risk_tag_request(ori_users, validated))
+        self.save_result(risk_users, tag_updates, results)
+
+
+class PermissionMatrixState(object):
+    """
+    权限矩阵定时校验的状态: 上次校验日期、上次全量校验日期及当时的配置版本, 用于判断能否增量校验
+    """
+    redis_name = 'task_has_log'
+    key = 'perm_matrix:state'
+    # 各业务线权限矩阵结果, 按校验日期保存
+    result_key = 'perm_matrix:result:{date}'
+    result_expire = 3 * 86400
+    config_models = ('AuditSysModel', 'AuditServerModel', 'NonNormalUserModel')
+
+    @classmethod
+    def conn(cls):
+        return get_prefixed_client(cls.redis_name)
+
+    @classmethod
+    def config_tag(cls):
+        """
+        业务线资产、非标准用户的缓存版本号及管理员配置的摘要, 获取失败返回None
+        """
+        versions = cache_version.get_tag([model_namespace(model) for model in cls.config_models])
+        if versions is None:
+            return None
+        conf = json.dumps({'bg_admin_role': settings.BG_ADMIN_ROLE_MAP, 'dba': settings.DBA},
+                          sort_keys=True, default=str)
+        return f'{versions}:{md5(conf)}'
+
+    @classmethod
+    def load(cls) -> dict:
+        try:
+            return cls.conn().hgetall(cls.key) or {}
+        except Exception:
+            logger.exception('load permission matrix state fail')
+            return {}
+
+    @classmethod
+    def save(cls, record_date, config_tag, full):
+        state = {'last_date': record_date.strftime('%Y-%m-%d'), 'config_tag': config_tag or ''}
+        if full:
+            state['last_full_date'] = state['last_date']
+        try:
+            cls.conn().hset(cls.key, mapping=state)
+        except Exception:
+            logger.exception('save permission matrix state fail')
+
+    @classmethod
+    def save_results(cls, record_date, results: dict):
+        """保存失败时次日回退为全量校验"""
+        if not results:
+            return
+        key = cls.result_key.format(date=record_date.strftime('%Y-%m-%d'))
+        try:
+            pipe = cls.conn().pipeline(transaction=False)
+            pipe.hset(key, mapping={audit_sys: json.dumps(result) for audit_sys, result in results.items()})
+            pipe.expire(key, cls.result_expire)
+            pipe.execute()
+        except Exception:
+            logger.exception('save permission matrix result fail')
+
+    @classmethod
+    def load_results(cls, record_date, audit_sys_ids: list):
+        """
+        :return: 业务线id -> 结果, 任一业务线缺失或读取失败时返回None
+        """
+        audit_sys_ids = [str(audit_sys) for audit_sys in audit_sys_ids]
+        if not audit_sys_ids:
+            return {}
+        key = cls.result_key.format(date=record_date.strftime('%Y-%m-%d'))
+        try:
+            values = cls.conn().hmget(key, audit_sys_ids)
+        except Exception:
+            logger.exception('load permission matrix result fail')
+            return None
+        if any(value is None for value in values):
+            return None
+        return {audit_sys: json.loads(value) for audit_sys, value in zip(audit_sys_ids, values)}
+
+    @classmethod
+    def full_reason(cls, state: dict, record_date, config_tag, full_interval) -> str:
+        """
+        :return: 需要全量校验的原因, 可以增量校验时返回空字符串
+        """
+        prev_date = record_date - datetime.timedelta(days=1)
+        if not config_tag or state.get('config_tag') != config_tag:
+            return 'config changed'
+        if state.get('last_date') != prev_date.strftime('%Y-%m-%d'):
+            return 'previous day not verified'
+        last_full_date = state.get('last_full_date')
+        if not last_full_date:
+            return 'no full run'
+        if (record_date - datetime.datetime.strptime(last_full_date, '%Y-%m-%d')).days >= full_interval:
+            return 'periodic full run'
+        return ''
+
+    @classmethod
+    def build_engine(cls, audit_sys_list, incremental=False, full_interval=7):
+        """
+        :return: (engine, 是否全量, 配置版本)
+        """
+        handlers = [PermissionMatrixHandler(sys.id, sys_instance=sys) for sys in audit_sys_list]
+        record_date = time_util.yesterday()
+        config_tag = cls.config_tag()
+        if incremental:
+            reason = cls.full_reason(cls.load(), record_date, config_tag, full_interval)
+            if not reason:
+                prev_date = record_date - datetime.timedelta(days=1)
+                prev_results = cls.load_results(prev_date, [sys.id for sys in audit_sys_list])
+                if prev_results is not None:
+                    return IncrementalPermissionMatrixEngine(handlers, prev_date, prev_results), False, config_tag
+                reason = 'previous result missing'
+            logger.info(f'[PERMISSION MATRIX] fall back to full run: {reason}')
+        return PermissionMatrixEngine(handlers), True, config_tag
 
 
 class ResignUserHandler(PermRuleHandler):
@@ -323,23 +730,30 @@ class ResignUserHandler(PermRuleHandler):
     name = '离职信息检测'
     configurable = False
 
+    def __init__(self, audit_sys, staff_map=None):
+        """
+        staff_map: accountid -> 是否在职, 多个业务线传入同一个dict, 同一用户一次任务只查询一次
+        """
+        super().__init__(audit_sys)
+        self.staff_map = staff_map if staff_map is not None else {}
+
     def validate_sys(self):
         """
         验证业务线所有人员离职情况
         """
         # 下面的所有user都是accountid
-        all_users = self.get_audit_sys_users()
-        not_staff_users = []
-        for user in all_users:
-            is_staff = UserService.is_staff(user)
-            if not is_staff:
-                not_staff_users.append(user)
+        all_users = [str(user) for user in self.get_audit_sys_users() if user]
+        unknown_users = [user for user in all_users if user not in self.staff_map]
+        if unknown_users:
+            # 与逐个查询 is_staff 一致, 查询失败或未返回的用户按非在职处理
+            self.staff_map.update(UserService.is_staff_many(unknown_users, default=False))
+        not_staff_users = [user for user in all_users if not self.staff_map.get(user, False)]
         self.update_risk_users(not_staff_users)
 
     def update_risk_users(self, users):
         self.callback_risk_tag(users, False)
-        for user in users:
-            RiskUserModel.update_risk_user(user, self.audit_sys, {'staff_risk': '已离职'})
+        RiskUserModel.bulk_update_risk_users([(user, self.audit_sys, {'staff_risk': '已离职'}) for user in users])
+        self.bump_cache_versions(RiskUserModel, UserRoleDataModel, ServerInfo, DbUserRoleModel)
 
 
 class JobTransferHandler(PermRuleHandler):
@@ -377,6 +791,7 @@ class JobTransferHandler(PermRuleHandler):
         user_ids += nonnormal_user_names
         clear_emails += nonnormal_user_names
         JobTransferRiskModel.save_risk(task, user_ids, clear_emails)
+        self.bump_cache_versions(JobTransferRiskModel, extra_namespaces=[task_namespace(task)])
 
     def get_nonnormal_names(self, user_ids):
         """
@@ -413,16 +828,12 @@ class LongTimeNoUseHandler(AuditRuleHandler):
     def server_names(self):
         return AuditServerModel.get_server_name_list(self.audit_sys, ServerKindEnum.APP.name)
 
-    def hit_rule(self, user):
-        last_log = BgAccessLogModel.objects.filter(user=user,
-                                                    bg_name__in=self.server_names).order_by('-access_dt').first()
-
-        if not last_log:
-            return False
-        now = time_util.today()
-        last_req_time = last_log.access_dt
-        no_use_days = (now - last_req_time).days
-        return no_use_days >= 45
+    def get_dormant_users(self) -> set:
+        """
+        业务线各应用后台中, 有访问记录且最近一次访问距今不少于days天的用户
+        """
+        before_dt = time_util.today() - datetime.timedelta(days=self.days)
+        return BgLastAccessModel.get_dormant_users(self.server_names, before_dt)
 
     def _update_risk_tag(self, users, validated):
         UserRoleDataModel.objects.filter(
@@ -434,18 +845,14 @@ class LongTimeNoUseHandler(AuditRuleHandler):
     def validate_sys(self):
         if not self.rule_configed():
             return
-        app_handler = AppPermHandler(self.audit_sys)
-        users = app_handler.get_all_users()
-        users = list(set(users) - set(self.white_users))
-        risk_users = set()
-        for user in users:
-            _is_hit = self.hit_rule(user)
-            if _is_hit:
-                risk_users.add(user)
-                RiskUserModel.update_risk_user(user, self.audit_sys, {'no_use_risk': self.risk_reason})
+        users = set(self.app_handler.get_all_users()) - set(self.white_users)
+        risk_users = users & self.get_dormant_users()
+        RiskUserModel.bulk_update_risk_users(
+            [(user, self.audit_sys, {'no_use_risk': self.risk_reason}) for user in risk_users])
 
         if risk_users:
             self._update_risk_tag(risk_users, False)
+            self.bump_cache_versions(RiskUserModel, UserRoleDataModel)
 
 
 class RegexMatchHandler(AuditRuleHandler):
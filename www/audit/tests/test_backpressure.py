@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+上报限流的积压及内存高低水位, 按类型限流
+"""
+
+import unittest
+from unittest import mock
+
+from audit.utils import Backpressure
+
+
+class FakeProvider(object):
+
+    def __init__(self, backlog=0, used_memory=0):
+        self.backlog_value = backlog
+        self.backlog_calls = 0
+        self.conn = mock.MagicMock()
+        self.conn.info.side_effect = lambda section: {'used_memory': self.used_memory}
+        self.used_memory = used_memory
+
+    def backlog(self):
+        self.backlog_calls += 1
+        return self.backlog_value
+
+
+class BackpressureTest(unittest.TestCase):
+
+    def build(self, **conf):
+        conf = dict({'high_watermark': 100, 'low_watermark': 50, 'retry_after': 30,
+                     'shed_data_types': ['UserRoleData'], 'check_interval': 0}, **conf)
+        return Backpressure(conf)
+
+    def test_shed_above_high_watermark(self):
+        backpressure = self.build()
+        self.assertFalse(backpressure.should_shed(FakeProvider(99), 'UserRoleData'))
+        self.assertTrue(backpressure.should_shed(FakeProvider(100), 'UserRoleData'))
+
+    def test_only_configured_types(self):
+        backpressure = self.build()
+        provider = FakeProvider(1000)
+        self.assertTrue(backpressure.should_shed(provider, 'UserRoleData'))
+        self.assertFalse(backpressure.should_shed(provider, 'BgAccessLog'))
+        self.assertFalse(backpressure.should_shed(provider, None))
+
+    def test_all_types_without_shed_types(self):
+        backpressure = self.build(shed_data_types=[])
+        provider = FakeProvider(1000)
+        self.assertTrue(backpressure.should_shed(provider, 'BgAccessLog'))
+        self.assertTrue(backpressure.should_shed(provider, None))
+
+    def test_recover_below_low_watermark(self):
+        backpressure = self.build()
+        provider = FakeProvider(150)
+        self.assertTrue(backpressure.should_shed(provider, 'UserRoleData'))
+        # 回落到高低水位之间时保持限流
+        provider.backlog_value = 80
+        self.assertTrue(backpressure.should_shed(provider, 'UserRoleData'))
+        provider.backlog_value = 50
+        self.assertFalse(backpressure.should_shed(provider, 'UserRoleData'))
+        provider.backlog_value = 80
+        self.assertFalse(backpressure.should_shed(provider, 'UserRoleData'))
+
+    def test_memory_watermark(self):
+        # 内存包含去重标记, 积压不高但内存超过高水位同样限流
+        backpressure = self.build(memory_high_watermark=1000, memory_low_watermark=800)
+        provider = FakeProvider(backlog=10, used_memory=1000)
+        self.assertTrue(backpressure.should_shed(provider, 'UserRoleData'))
+        provider.used_memory = 900
+        self.assertTrue(backpressure.should_shed(provider, 'UserRoleData'))
+        provider.used_memory = 800
+        self.assertFalse(backpressure.should_shed(provider, 'UserRoleData'))
+        provider.conn.info.assert_called_with('memory')
+
+    def test_memory_disabled(self):
+        backpressure = self.build()
+        provider = FakeProvider(backlog=10, used_memory=10 ** 12)
+        self.assertFalse(backpressure.should_shed(provider, 'UserRoleData'))
+        provider.conn.info.assert_not_called()
+
+    def test_check_interval(self):
+        backpressure = self.build(check_interval=10)
+        provider = FakeProvider(150)
+        with mock.patch('audit.utils.time.time', side_effect=[1000, 1005, 1010]):
+            self.assertTrue(backpressure.should_shed(provider, 'UserRoleData'))
+            provider.backlog_value = 0
+            # 检查间隔内沿用上次结果
+            self.assertTrue(backpressure.should_shed(provider, 'UserRoleData'))
+            self.assertFalse(backpressure.should_shed(provider, 'UserRoleData'))
+        self.assertEqual(provider.backlog_calls, 2)
+
+    def test_backlog_error(self):
+        backpressure = self.build()
+        provider = FakeProvider()
+        provider.backlog = mock.Mock(side_effect=ConnectionError('redis down'))
+        self.assertFalse(backpressure.should_shed(provider, 'UserRoleData'))
+
+    def test_disabled(self):
+        backpressure = Backpressure(None)
+        self.assertFalse(backpressure.should_shed(FakeProvider(10 ** 9), 'UserRoleData'))
+
+    def test_record_shed(self):
+        provider = FakeProvider()
+        self.build().record_shed(provider, 'UserRoleData')
+        provider.conn.hincrby.assert_called_once_with(Backpressure.shed_counter_key, 'UserRoleData', 1)
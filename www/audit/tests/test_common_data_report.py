@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+CommonDataReport 上报限流及NDJSON/gzip流式上报
+"""
+
+import gzip
+import io
+import json
+import unittest
+from unittest import mock
+
+from audit.utils import Backpressure
+from audit.views import CommonDataReport
+
+
+class FakeRequest(object):
+    """只包含 CommonDataReport 用到的属性"""
+
+    def __init__(self, content_type='application/json', data=None, query_params=None, body=b'', encoding=''):
+        self.content_type = content_type
+        self.data = data
+        self.query_params = query_params or {}
+        self.META = {'HTTP_CONTENT_ENCODING': encoding} if encoding else {}
+        self._request = io.BytesIO(body)
+
+
+class ReportBackpressureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = mock.MagicMock()
+        self.provider.backlog.return_value = 1000
+        self.backpressure = Backpressure({'high_watermark': 100, 'low_watermark': 50, 'retry_after': 120,
+                                          'shed_data_types': ['UserRoleData'], 'check_interval': 0})
+        patches = [
+            mock.patch('audit.views.get_data_provider', return_value=self.provider),
+            mock.patch('audit.views.backpressure', self.backpressure),
+            mock.patch.object(CommonDataReport, 'handle', return_value={'message': 'OK', 'result': True}),
+            mock.patch.object(CommonDataReport, 'handle_stream', return_value={'message': 'OK', 'result': True}),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, request):
+        return CommonDataReport().post(request)
+
+    def test_429_with_retry_after(self):
+        response = self.post(FakeRequest(data={'data_type': 'UserRoleData', 'data': [{}]}))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '120')
+        self.assertFalse(json.loads(response.content)['result'])
+        CommonDataReport.handle.assert_not_called()
+        self.provider.conn.hincrby.assert_called_once_with(Backpressure.shed_counter_key, 'UserRoleData', 1)
+
+    def test_stream_429(self):
+        # 流式上报的data_type通过query参数指定
+        response = self.post(FakeRequest(content_type='application/x-ndjson; charset=utf-8',
+                                         query_params={'data_type': 'UserRoleData'}))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '120')
+        CommonDataReport.handle_stream.assert_not_called()
+
+    def test_not_shed_other_types(self):
+        response = self.post(FakeRequest(data={'data_type': 'BgAccessLog', 'data': [{}]}))
+        self.assertEqual(response.status_code, 200)
+        CommonDataReport.handle.assert_called_once_with({'data_type': 'BgAccessLog', 'data': [{}]})
+
+    def test_accept_below_high_watermark(self):
+        self.provider.backlog.return_value = 99
+        response = self.post(FakeRequest(data={'data_type': 'UserRoleData', 'data': [{}]}))
+        self.assertEqual(response.status_code, 200)
+        CommonDataReport.handle.assert_called_once()
+
+
+def account(accountid='10001', **extra):
+    return dict({'bg_name': 'bg1', 'user_id': 'alice', 'accountid': accountid, 'date': '2020-10-01'}, **extra)
+
+
+def ndjson(*items) -> bytes:
+    return b''.join((item if isinstance(item, bytes) else json.dumps(item).encode()) + b'\n' for item in items)
+
+
+class StreamReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = mock.MagicMock()
+        self.provider.batch_write.return_value = True
+        patcher = mock.patch('audit.views.get_data_provider', return_value=self.provider)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def report(self, body, encoding='', data_type='UserAccountData'):
+        request = FakeRequest(content_type='application/x-ndjson', query_params={'data_type': data_type},
+                              body=body, encoding=encoding)
+        return CommonDataReport().handle_stream(request)
+
+    def written(self):
+        return [item['data'] for call in self.provider.batch_write.call_args_list for item in call[0][0]]
+
+    def test_malformed_lines(self):
+        result = self.report(ndjson(
+            account('10001'),
+            b'{"bg_name": "bg1",',
+            b'[1, 2]',
+            account('abc'),
+            b'',
+            account('10002'),
+        ))
+        self.assertFalse(result['result'])
+        self.assertEqual(result['message'], 'partial rejected')
+        self.assertEqual(result['accepted'], 2)
+        self.assertEqual(result['rejected_count'], 3)
+        self.assertEqual([item['line'] for item in result['rejected']], [2, 3, 4])
+        self.assertEqual(result['rejected'][0]['message'], 'invalid json object')
+        self.assertIn('accountid', result['rejected'][2]['message'])
+        self.assertEqual([data['accountid'] for data in self.written()], ['10001', '10002'])
+
+    def test_rejected_details_limit(self):
+        with mock.patch.object(CommonDataReport, 'max_rejected_details', 2):
+            result = self.report(ndjson(*[b'not json'] * 5))
+        self.assertEqual(result['rejected_count'], 5)
+        self.assertEqual(len(result['rejected']), 2)
+        self.provider.batch_write.assert_not_called()
+
+    def test_gzip_in_chunks(self):
+        body = gzip.compress(ndjson(*[account(str(10000 + i)) for i in range(5)]))
+        with mock.patch.object(CommonDataReport, 'stream_chunk_size', 2):
+            result = self.report(body, encoding='gzip')
+        self.assertTrue(result['result'])
+        self.assertEqual(result['accepted'], 5)
+        self.assertEqual([len(call[0][0]) for call in self.provider.batch_write.call_args_list], [2, 2, 1])
+
+    def test_not_gzip(self):
+        result = self.report(ndjson(account()), encoding='gzip')
+        self.assertFalse(result['result'])
+        self.assertEqual(result['accepted'], 0)
+        self.provider.batch_write.assert_not_called()
+
+    def test_truncated_gzip(self):
+        # 损坏前已分批写入的数据计入accepted, 其余不写入
+        body = gzip.compress(ndjson(*[account(str(10000 + i), user_id=f'user{i}') for i in range(200)]))
+        with mock.patch.object(CommonDataReport, 'stream_chunk_size', 10):
+            result = self.report(body[:len(body) // 2], encoding='gzip')
+        self.assertFalse(result['result'])
+        self.assertTrue(result['message'])
+        self.assertGreater(result['accepted'], 0)
+        self.assertLess(result['accepted'], 200)
+        self.assertEqual(result['accepted'], len(self.written()))
+
+    def test_corrupt_gzip_body(self):
+        body = bytearray(gzip.compress(ndjson(*[account(str(10000 + i)) for i in range(50)])))
+        body[20:40] = b'\xff' * 20
+        result = self.report(bytes(body), encoding='gzip')
+        self.assertFalse(result['result'])
+        self.assertEqual(result['accepted'], len(self.written()))
+
+    def test_persistence_error(self):
+        self.provider.batch_write.return_value = False
+        result = self.report(ndjson(account()))
+        self.assertFalse(result['result'])
+        self.assertEqual(result['accepted'], 0)
+
+    def test_invalid_data_type(self):
+        result = self.report(ndjson(account()), data_type='Unknown')
+        self.assertFalse(result['result'])
+        self.provider.batch_write.assert_not_called()
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+合规数据通道: 私有队列重新投递, 无主私有队列回收, Stream消费组认领失效消费者的消息
+"""
+
+import json
+import unittest
+from collections import defaultdict, deque
+from unittest import mock
+
+from audit.utils import RedisDataProvider, RedisStreamDataProvider
+
+
+class FakeRedis(object):
+    """仅实现数据通道用到的命令, 不处理过期, 删除data中的心跳即视为过期"""
+
+    def __init__(self):
+        self.lists = defaultdict(deque)
+        self.hashes = defaultdict(dict)
+        self.data = {}
+
+    def rpush(self, name, *values):
+        self.lists[name].extend(values)
+        return len(self.lists[name])
+
+    def rpoplpush(self, src, dst):
+        if not self.lists[src]:
+            return None
+        value = self.lists[src].pop()
+        self.lists[dst].appendleft(value)
+        return value
+
+    def lindex(self, name, index):
+        try:
+            return self.lists[name][index]
+        except IndexError:
+            return None
+
+    def lrange(self, name, start, end):
+        values = list(self.lists[name])
+        return values[start:] if end == -1 else values[start:end + 1]
+
+    def lpop(self, name):
+        return self.lists[name].popleft() if self.lists[name] else None
+
+    def ltrim(self, name, start, end):
+        self.lists[name] = deque(self.lrange(name, start, end))
+
+    def llen(self, name):
+        return len(self.lists[name])
+
+    def setex(self, key, expire, value):
+        self.data[key] = value
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def hset(self, name, key, value):
+        self.hashes[name][key] = str(value)
+
+    def hgetall(self, name):
+        return dict(self.hashes[name])
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        assert script == RedisDataProvider.reap_script
+        return self.reap
+
+    def reap(self, keys, args):
+        """与 reap_script 语义一致"""
+        queue_name, origin_queue_name, heartbeat_key, registry_key = keys
+        if self.exists(heartbeat_key):
+            return 0
+        count = 0
+        while self.lists[queue_name]:
+            self.lists[origin_queue_name].append(self.lists[queue_name].pop())
+            count += 1
+        self.hashes[registry_key].pop(args[0], None)
+        return count
+
+
+class FakePipeline(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [getattr(self.conn, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+
+def loads_n(log_strs):
+    return [json.loads(log_str)['n'] for log_str in log_strs]
+
+
+class RedisDataProviderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeRedis()
+        # 不启动心跳续期线程
+        patcher = mock.patch.object(RedisDataProvider, 'run_heartbeat')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def new_provider(self):
+        """同一进程内私有队列名称相同, 用新实例模拟进程崩溃后以相同名称重启"""
+        with mock.patch('audit.utils.get_redis_client', return_value=self.conn):
+            provider = RedisDataProvider()
+        provider.queue_weights = {}
+        return provider
+
+    def test_redeliver_unacked_batch(self):
+        provider = self.new_provider()
+        provider.batch_write([{'data_type': 'UserRoleData', 'n': i} for i in range(5)])
+        first = provider.get_logs(3)
+        self.assertEqual(len(first), 3)
+
+        # 取数后未ack即崩溃, 重启后重新投递同一批数据
+        restarted = self.new_provider()
+        self.assertEqual(restarted.get_logs(3), first)
+        restarted.batch_ack(len(first))
+        rest = restarted.get_logs(3)
+        self.assertEqual(sorted(loads_n(first + rest)), list(range(5)))
+
+    def test_redeliver_with_smaller_batch(self):
+        # 重启后单批条数变小, 私有队列中的数据分多批重新投递, 不丢失不重复
+        provider = self.new_provider()
+        provider.batch_write([{'data_type': 'UserRoleData', 'n': i} for i in range(4)])
+        first = provider.get_logs(4)
+
+        restarted = self.new_provider()
+        redelivered = []
+        for _ in range(2):
+            log_strs = restarted.get_logs(2)
+            redelivered.extend(log_strs)
+            restarted.batch_ack(len(log_strs))
+        self.assertEqual(sorted(redelivered), sorted(first))
+        self.assertFalse(self.conn.lists[restarted.private_queue_name])
+
+    def test_redeliver_unacked_single(self):
+        provider = self.new_provider()
+        for i in range(2):
+            provider.write({'data_type': 'UserRoleData', 'n': i})
+        first = provider.get_log()
+
+        restarted = self.new_provider()
+        self.assertEqual(restarted.get_log(), first)
+        restarted.ack()
+        self.assertEqual(sorted(loads_n([first, restarted.get_log()])), [0, 1])
+
+
+class ReapOrphanQueuesTest(unittest.TestCase):
+    now = 1600000000
+
+    def setUp(self):
+        self.conn = FakeRedis()
+        with mock.patch('audit.utils.get_redis_client', return_value=self.conn):
+            self.reaper = RedisDataProvider()
+        self.reaper.private_queue_name = 'third_bg_log|host0|0'
+        self.origin = self.reaper.origin_queue_name
+        self.registry = self.reaper.consumer_registry_key
+
+    def add_worker(self, queue_name, heartbeat_ago, alive, count=2):
+        """私有队列中留有count条数据, heartbeat_ago秒前最后一次心跳"""
+        self.conn.rpush(queue_name, *[f'{queue_name}-{i}' for i in range(count)])
+        with mock.patch('audit.utils.get_redis_client', return_value=self.conn):
+            worker = RedisDataProvider()
+        worker.private_queue_name = queue_name
+        with mock.patch('audit.utils.time.time', return_value=self.now - heartbeat_ago):
+            worker.heartbeat()
+        if not alive:
+            del self.conn.data[RedisDataProvider.build_heartbeat_key(queue_name)]
+
+    def reap(self):
+        with mock.patch('audit.utils.time.time', return_value=self.now):
+            return self.reaper.reap_orphan_queues()
+
+    def test_skip_live_queue(self):
+        self.add_worker('third_bg_log|host1|1', heartbeat_ago=10, alive=True)
+        self.assertEqual(self.reap(), {})
+        self.assertEqual(len(self.conn.lists['third_bg_log|host1|1']), 2)
+        self.assertFalse(self.conn.lists[self.origin])
+
+    def test_skip_live_queue_with_stale_registry(self):
+        # 登记时间已超过宽限期但心跳仍在(如刚续期), 由脚本原子地检查心跳后跳过
+        self.add_worker('third_bg_log|host1|1', heartbeat_ago=self.reaper.reap_grace + 1, alive=True)
+        self.assertEqual(self.reap(), {})
+        self.assertEqual(len(self.conn.lists['third_bg_log|host1|1']), 2)
+        self.assertIn('third_bg_log|host1|1', self.conn.hashes[self.registry])
+
+    def test_reap_dead_queue(self):
+        self.add_worker('third_bg_log|host1|1', heartbeat_ago=10, alive=True)
+        self.add_worker('third_bg_log|host2|2', heartbeat_ago=self.reaper.reap_grace + 1, alive=False, count=3)
+        self.assertEqual(self.reap(), {'third_bg_log|host2|2': 3})
+        self.assertFalse(self.conn.lists['third_bg_log|host2|2'])
+        self.assertEqual(sorted(self.conn.lists[self.origin]), [f'third_bg_log|host2|2-{i}' for i in range(3)])
+        self.assertEqual(list(self.conn.hashes[self.registry]), ['third_bg_log|host1|1'])
+
+    def test_skip_within_grace(self):
+        # 心跳已过期但未超过宽限期, 如发布过程中进程尚未重启完成
+        self.add_worker('third_bg_log|host1|1', heartbeat_ago=self.reaper.heartbeat_ttl + 1, alive=False)
+        self.assertEqual(self.reap(), {})
+        self.assertEqual(len(self.conn.lists['third_bg_log|host1|1']), 2)
+
+    def test_skip_unregistered_queue(self):
+        # 未登记的私有队列(旧版本进程)不回收
+        self.conn.rpush('third_bg_log|host3|3', 'old-0', 'old-1')
+        self.assertEqual(self.reap(), {})
+        self.assertEqual(len(self.conn.lists['third_bg_log|host3|3']), 2)
+
+    def test_skip_own_queue(self):
+        self.add_worker(self.reaper.private_queue_name, heartbeat_ago=self.reaper.reap_grace + 1, alive=False)
+        self.assertEqual(self.reap(), {})
+
+
+class RedisStreamDataProviderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = mock.MagicMock()
+        # 本消费者没有待处理消息, 也没有新消息
+        self.conn.xreadgroup.return_value = []
+        with mock.patch('audit.utils.get_redis_client', return_value=self.conn):
+            self.provider = RedisStreamDataProvider()
+        self.provider.consumer_name = 'consumer-1'
+        self.pipe = self.conn.pipeline.return_value
+
+    def claim_calls(self):
+        return [c for c in self.conn.execute_command.call_args_list if c[0][0] == 'XAUTOCLAIM']
+
+    def test_claim_idle_entries(self):
+        self.conn.execute_command.return_value = [
+            '0-0', [('1-0', ['log', 'a']), ('2-0', None), ('3-0', ['log', 'b'])]]
+        self.assertEqual(self.provider.get_logs(10), ['a', 'b'])
+        self.assertEqual(self.provider.pending_ids, ['1-0', '3-0'])
+
+        provider = self.provider
+        self.conn.execute_command.assert_called_once_with(
+            'XAUTOCLAIM', provider.stream_name, provider.group_name, 'consumer-1',
+            provider.claim_idle_ms, '0-0', 'COUNT', 10)
+        # 已被删除的消息直接ack
+        self.pipe.xack.assert_called_once_with(provider.stream_name, provider.group_name, '2-0')
+        self.pipe.xdel.assert_called_once_with(provider.stream_name, '2-0')
+
+        self.pipe.reset_mock()
+        provider.ack()
+        self.pipe.xack.assert_called_once_with(provider.stream_name, provider.group_name, '1-0', '3-0')
+        self.assertEqual(provider.pending_ids, [])
+
+    def test_pending_before_claim(self):
+        # 本消费者重启后先处理自己的待处理消息, 不认领其他消费者的消息
+        self.conn.xreadgroup.side_effect = lambda group, consumer, streams, **kwargs: (
+            [(self.provider.stream_name, [('5-0', {'log': 'mine'})])]
+            if list(streams.values()) == ['0'] else [])
+        self.assertEqual(self.provider.get_logs(10), ['mine'])
+        self.assertEqual(self.claim_calls(), [])
+
+    def test_claim_interval(self):
+        self.conn.execute_command.return_value = ['0-0', []]
+        # 依次为: 第一轮待处理、新消息, 第二轮待处理、新消息
+        self.conn.xreadgroup.side_effect = [
+            [], [],
+            [], [(self.provider.stream_name, [('7-0', {'log': 'new'})])],
+        ]
+        with mock.patch('audit.utils.time.time', side_effect=[1000, 1000 + self.provider.claim_interval - 1]):
+            # 第一轮认领为空且无新消息, 第二轮未到认领间隔, 只读取新消息
+            self.assertEqual(self.provider.get_logs(10), ['new'])
+        self.assertEqual(len(self.claim_calls()), 1)
+        self.assertEqual(self.conn.xreadgroup.call_args[0][2], {self.provider.stream_name: '>'})
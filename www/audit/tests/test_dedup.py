@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+消费端去重及上报消息序列化
+"""
+
+import json
+import unittest
+from collections import defaultdict
+from unittest import mock
+
+from audit.utils import MessageDeduplicator, dump_message
+
+NOW = 1600000000
+TTL = 6 * 3600
+
+
+class FakeRedis(object):
+    """仅实现去重用到的set命令, 记录过期时长但不处理过期"""
+
+    def __init__(self):
+        self.sets = defaultdict(set)
+        self.expires = {}
+        self.counters = defaultdict(int)
+        self.fail = False
+
+    def sadd(self, key, *members):
+        self.sets[key].update(members)
+
+    def sismember(self, key, member):
+        return member in self.sets.get(key, ())
+
+    def expire(self, key, seconds):
+        self.expires[key] = seconds
+
+    def incrby(self, key, amount):
+        self.counters[key] += amount
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.commands.append((name, args))
+        return command
+
+    def execute(self):
+        if self.conn.fail:
+            raise ConnectionError('redis down')
+        commands, self.commands = self.commands, []
+        return [getattr(self.conn, name)(*args) for name, args in commands]
+
+
+class MessageDeduplicatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeRedis()
+        self.deduplicator = MessageDeduplicator(self.conn, ttl=TTL)
+
+    def at(self, ts, func, *args):
+        with mock.patch('audit.utils.time.time', return_value=ts):
+            return func(*args)
+
+    def test_drop_within_ttl(self):
+        self.at(NOW, self.deduplicator.mark_processed, ['a', 'b'])
+        for ts in (NOW, NOW + 1, NOW + TTL):
+            self.assertEqual(self.at(ts, self.deduplicator.filter_processed, ['a', 'c', 'b']), ['c'])
+        self.assertEqual(self.conn.counters[MessageDeduplicator.dup_counter_key], 6)
+
+    def test_keep_after_ttl(self):
+        self.at(NOW, self.deduplicator.mark_processed, ['a'])
+        later = NOW + TTL + 2 * MessageDeduplicator.bucket_seconds
+        self.assertEqual(self.at(later, self.deduplicator.filter_processed, ['a']), ['a'])
+
+    def test_one_set_per_bucket(self):
+        # 同一时间桶内的标记写入同一个集合, 集合保留时长不短于TTL
+        for i in range(3):
+            self.at(NOW + i, self.deduplicator.mark_processed, [f'log-{i}-{j}' for j in range(100)])
+        self.assertEqual(len(self.conn.sets), 1)
+        key, members = next(iter(self.conn.sets.items()))
+        self.assertEqual(len(members), 300)
+        self.assertGreaterEqual(self.conn.expires[key], TTL)
+
+    def test_redis_error(self):
+        # 查询失败时全部按未处理返回, 不丢数据
+        self.conn.fail = True
+        self.assertEqual(self.at(NOW, self.deduplicator.filter_processed, ['a', 'b']), ['a', 'b'])
+        self.at(NOW, self.deduplicator.mark_processed, ['a'])
+
+    def test_disabled(self):
+        deduplicator = MessageDeduplicator(self.conn, ttl=0)
+        deduplicator.mark_processed(['a'])
+        self.assertEqual(deduplicator.filter_processed(['a']), ['a'])
+        self.assertFalse(self.conn.sets)
+
+
+class DumpMessageTest(unittest.TestCase):
+
+    def test_not_modify_input(self):
+        data = {'data_type': 'UserRoleData', 'data': {'user': 'alice'}}
+        log_str = dump_message(data)
+        self.assertNotIn('msg_id', data)
+        self.assertEqual(json.loads(log_str)['data'], {'user': 'alice'})
+
+    def test_distinct_msg_id(self):
+        # 相同内容的两次上报可区分, 不会被当作重复投递
+        data = {'data_type': 'UserRoleData', 'data': {'user': 'alice'}}
+        self.assertNotEqual(dump_message(data), dump_message(data))
+
+    def test_keep_msg_id(self):
+        self.assertEqual(json.loads(dump_message({'msg_id': 'm1'}))['msg_id'], 'm1')
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+权限矩阵增量校验与全量校验在同一输入上的结果一致
+"""
+
+import datetime
+import unittest
+from collections import defaultdict
+from unittest import mock
+
+from audit.models import DbUserRoleModel, ServerInfo, UserRoleDataModel
+from audit.rule_handler import (IncrementalPermissionMatrixEngine,
+                                PermissionMatrixEngine,
+                                PermissionMatrixHandler)
+
+PREV_DATE = datetime.datetime(2020, 10, 1)
+RECORD_DATE = datetime.datetime(2020, 10, 2)
+ADMIN_ROLE = 'admin'
+DBA = ['dba1', 'alice', 'hank']
+
+
+def match(doc, query) -> bool:
+    for key, cond in query.items():
+        if isinstance(cond, dict):
+            if doc.get(key) not in cond['$in']:
+                return False
+        elif doc.get(key) != cond:
+            return False
+    return True
+
+
+class FakeCollection(object):
+    """模拟权限矩阵用到的 find / distinct / aggregate"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection):
+        fields = [field for field, included in projection.items() if included]
+        for doc in self.docs:
+            if match(doc, query):
+                yield {field: doc[field] for field in fields if field in doc}
+
+    def distinct(self, field, query):
+        return sorted({doc[field] for doc in self.docs if match(doc, query)})
+
+    def aggregate(self, pipeline, allowDiskUse=False):
+        query, group = pipeline[0]['$match'], pipeline[1]['$group']
+        value_field = group['users']['$addToSet'][1:]
+        groups = defaultdict(set)
+        for doc in self.docs:
+            if not match(doc, query):
+                continue
+            if isinstance(group['_id'], dict):
+                key = tuple((name, doc[field[1:]]) for name, field in group['_id'].items())
+            else:
+                key = doc[group['_id'][1:]]
+            groups[key].add(doc[value_field])
+        for key, users in groups.items():
+            yield {'_id': dict(key) if isinstance(key, tuple) else key, 'users': list(users)}
+
+
+class FakePermHandler(object):
+    """用户名即accountid, risk_tag请求记录为 (资产字段, 资产, 用户字段, 用户, 是否相容, 业务线)"""
+
+    def __init__(self, model, asset_field, user_field, server_names, audit_sys, admins=()):
+        self.model = model
+        self.asset_field = asset_field
+        self.user_field = user_field
+        self.all_server_names = self.clear_server_names = list(server_names)
+        self.audit_sys = audit_sys
+        self.admins = list(admins)
+
+    def get_admin_role_by_bg(self, bg_name):
+        return ADMIN_ROLE
+
+    def fmt_users(self, users):
+        return [str(user) for user in users]
+
+    def admin_users(self):
+        return self.admins
+
+    def candidate_users(self, accountids, id2email):
+        return list(accountids)
+
+    def asset_query(self):
+        return {self.asset_field: {'$in': self.all_server_names}}
+
+    def risk_tag_update(self, users, validated):
+        return self.risk_tag_request(users, validated)
+
+    def risk_tag_request(self, ori_users, validated):
+        return (self.asset_field, frozenset(self.all_server_names),
+                self.user_field, frozenset(ori_users), validated, self.audit_sys)
+
+
+class FakeMatrixHandler(object):
+    check_admin = PermissionMatrixHandler.check_admin
+
+    def __init__(self, audit_sys, bg_names, hosts, db_servers, snapshots):
+        self.audit_sys = audit_sys
+        self.app_handler = FakePermHandler(UserRoleDataModel, 'bg_name', 'user', bg_names, audit_sys)
+        self.sys_handler = FakePermHandler(ServerInfo, 'server_name', 'root_user', hosts, audit_sys)
+        self.db_handler = FakePermHandler(DbUserRoleModel, 'server_name', 'user', db_servers, audit_sys, DBA)
+        self.snapshots = snapshots
+
+    def get_audit_sys_users(self):
+        users = set()
+        for perm_handler in (self.app_handler, self.sys_handler, self.db_handler):
+            users |= {doc[perm_handler.user_field] for doc in self.snapshots[perm_handler.model]
+                      if doc['record_date'] == RECORD_DATE
+                      and doc[perm_handler.asset_field] in perm_handler.all_server_names}
+        return list(users)
+
+
+def role(bg_name, user, record_date, role_name=ADMIN_ROLE):
+    return dict(bg_name=bg_name, user=user, role=role_name, record_date=record_date)
+
+
+def root(server_name, user, record_date):
+    return dict(server_name=server_name, root_user=user, record_date=record_date)
+
+
+def db_role(server_name, user, record_date):
+    return dict(server_name=server_name, user=user, role='dba', record_date=record_date)
+
+
+def both_days(make, *args):
+    return [make(*args, PREV_DATE), make(*args, RECORD_DATE)]
+
+
+SNAPSHOTS = {
+    UserRoleDataModel: [
+        *both_days(role, 'bg1', 'alice'),
+        role('bg1', 'bob', PREV_DATE),
+        role('bg1', 'bob', RECORD_DATE, 'viewer'),
+        role('bg1', 'carol', PREV_DATE, 'viewer'),
+        role('bg1', 'carol', RECORD_DATE),
+        *both_days(role, 'bg2', 'dave'),
+        *both_days(role, 'bg3', 'erin'),
+        role('bg3', 'frank', RECORD_DATE),
+        # bg4当天快照缺失
+        role('bg4', 'gina', PREV_DATE),
+        role('bg4', 'hank', PREV_DATE),
+    ],
+    ServerInfo: [
+        *both_days(root, 'h1', 'bob'),
+        *both_days(root, 'h1', 'root'),
+        root('h1', 'carol', RECORD_DATE),
+        *both_days(root, 'h2', 'frank'),
+        *both_days(root, 'h2', 'dba1'),
+        *both_days(root, 'h3', 'erin'),
+        *both_days(root, 'h3', 'dave'),
+        *both_days(root, 'h4', 'gina'),
+    ],
+    DbUserRoleModel: [
+        *both_days(db_role, 'd1', 'dba1'),
+        *both_days(db_role, 'd2', 'dba1'),
+    ],
+}
+
+
+class IncrementalMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handlers = [
+            FakeMatrixHandler('sys1', ['bg1', 'bg2'], ['h1', 'h2'], ['d1'], SNAPSHOTS),
+            FakeMatrixHandler('sys2', ['bg2', 'bg3'], ['h3'], ['d2'], SNAPSHOTS),
+            FakeMatrixHandler('sys3', ['bg4'], ['h4'], [], SNAPSHOTS),
+        ]
+        patches = [
+            mock.patch.object(model, '_get_collection', return_value=FakeCollection(docs))
+            for model, docs in SNAPSHOTS.items()
+        ]
+        patches.append(mock.patch('audit.rule_handler.UserService.batch_id_to_email', return_value={}))
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_engine(self, record_date, make_engine):
+        """
+        :return: save_result 的参数 (risk_users, tag_updates, results)
+        """
+        with mock.patch('audit.rule_handler.time_util.yesterday', return_value=record_date):
+            engine = make_engine()
+        saved = []
+        engine.save_result = lambda *args: saved.append(args)
+        engine.validate()
+        return saved[0]
+
+    @staticmethod
+    def apply_tags(tag_updates) -> dict:
+        """按顺序回放risk_tag请求, :return: 当天记录 -> (risk_tag, risk_sys)"""
+        records = {}
+        for model, requests in tag_updates.items():
+            for asset_field, assets, user_field, users, validated, audit_sys in requests:
+                for index, doc in enumerate(SNAPSHOTS[model]):
+                    if (doc['record_date'] == RECORD_DATE and doc[asset_field] in assets
+                            and doc[user_field] in users):
+                        _, risk_sys = records.get((model, index), (None, frozenset()))
+                        records[(model, index)] = (not validated, risk_sys | {audit_sys})
+        return records
+
+    def test_incremental_equals_full(self):
+        _, _, prev_results = self.run_engine(PREV_DATE, lambda: PermissionMatrixEngine(self.handlers))
+        full = self.run_engine(RECORD_DATE, lambda: PermissionMatrixEngine(self.handlers))
+        incremental = self.run_engine(RECORD_DATE, lambda: IncrementalPermissionMatrixEngine(
+            self.handlers, PREV_DATE, prev_results))
+
+        self.assertEqual(sorted(map(repr, incremental[0])), sorted(map(repr, full[0])))
+        self.assertEqual(self.apply_tags(incremental[1]), self.apply_tags(full[1]))
+        self.assertEqual(incremental[2], full[2])
+
+        # 未变化的相容用户同样写入当天的risk_tag/risk_sys
+        self.assertEqual(full[2]['sys1'], {'alice': '兼具应用管理员、数据库管理员', 'carol': '兼具应用管理员、系统管理员',
+                                           'dba1': ''})
+        dba1_root = SNAPSHOTS[ServerInfo].index(root('h2', 'dba1', RECORD_DATE))
+        self.assertEqual(self.apply_tags(incremental[1])[(ServerInfo, dba1_root)], (False, {'sys1'}))
+        # 当天快照缺失的业务线按全量计算, 不沿用上一天的结果
+        self.assertIn('hank', prev_results['sys3'])
+        self.assertEqual(incremental[2]['sys3'], {})
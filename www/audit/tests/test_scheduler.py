@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+加权轮询调度, 按data_type分区写入及按权重批量取数
+"""
+
+import json
+import unittest
+from collections import Counter, defaultdict, deque
+from unittest import mock
+
+from audit.utils import RedisDataProvider, WeightedScheduler
+
+
+class FakeListRedis(object):
+    """仅实现 RedisDataProvider 批量取数用到的 list 命令"""
+
+    def __init__(self):
+        self.lists = defaultdict(deque)
+
+    def rpush(self, name, *values):
+        self.lists[name].extend(values)
+
+    def rpoplpush(self, src, dst):
+        if not self.lists[src]:
+            return None
+        value = self.lists[src].pop()
+        self.lists[dst].appendleft(value)
+        return value
+
+    def llen(self, name):
+        return len(self.lists[name])
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.commands.append((name, args))
+        return command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [getattr(self.conn, name)(*args) for name, args in commands]
+
+
+class WeightedSchedulerTest(unittest.TestCase):
+
+    def test_allocate_by_weight(self):
+        scheduler = WeightedScheduler({'a': 5, 'b': 3, 'c': 2, 'zero': 0})
+        self.assertEqual(dict(scheduler.allocate(100)), {'a': 50, 'b': 30, 'c': 20})
+
+    def test_smooth(self):
+        scheduler = WeightedScheduler({'a': 5, 'b': 1, 'c': 1})
+        self.assertEqual([scheduler.next() for _ in range(7)], ['a', 'a', 'b', 'a', 'c', 'a', 'a'])
+
+    def test_allocate_in_candidates(self):
+        scheduler = WeightedScheduler({'a': 5, 'b': 3, 'c': 2})
+        self.assertEqual(dict(scheduler.allocate(50, {'b', 'c'})), {'b': 30, 'c': 20})
+        self.assertEqual(dict(scheduler.allocate(10, set())), {})
+
+    def test_order(self):
+        scheduler = WeightedScheduler({'a': 2, 'b': 1, 'c': 1})
+        orders = [scheduler.order() for _ in range(4)]
+        self.assertEqual(Counter(order[0] for order in orders), {'a': 2, 'b': 1, 'c': 1})
+        for order in orders:
+            self.assertEqual(sorted(order), ['a', 'b', 'c'])
+
+
+class PopByWeightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeListRedis()
+        with mock.patch('audit.utils.get_redis_client', return_value=self.conn):
+            self.provider = RedisDataProvider()
+        self.provider.queue_weights = {'A': 3, 'B': 2}
+        self.provider.private_queue_name = 'private'
+        self.origin = self.provider.origin_queue_name
+        self.queue_a = self.provider.route_queue('A')
+        self.queue_b = self.provider.route_queue('B')
+
+    def fill(self, queue_name, count):
+        self.conn.rpush(queue_name, *[f'{queue_name}-{i}' for i in range(count)])
+
+    def count_by_queue(self, log_strs):
+        return Counter(log_str.rsplit('-', 1)[0] for log_str in log_strs)
+
+    def test_all_queues_full(self):
+        for queue_name in (self.origin, self.queue_a, self.queue_b):
+            self.fill(queue_name, 100)
+        log_strs = self.provider._pop_by_weight(50)
+        self.assertEqual(self.count_by_queue(log_strs), {self.queue_a: 25, self.queue_b: 17, self.origin: 8})
+
+    def test_fill_from_next_queues(self):
+        # 首选队列只有少量数据, 剩余额度需由其他队列依次补足
+        self.fill(self.queue_a, 2)
+        self.fill(self.queue_b, 20)
+        self.fill(self.origin, 100)
+        log_strs = self.provider._pop_by_weight(50)
+        self.assertEqual(len(log_strs), 50)
+        self.assertEqual(self.count_by_queue(log_strs), {self.queue_a: 2, self.queue_b: 20, self.origin: 28})
+
+    def test_all_queues_short(self):
+        self.fill(self.queue_a, 3)
+        self.fill(self.queue_b, 4)
+        self.fill(self.origin, 5)
+        log_strs = self.provider._pop_by_weight(50)
+        self.assertEqual(len(log_strs), 12)
+        self.assertFalse(any(self.conn.lists[q] for q in (self.origin, self.queue_a, self.queue_b)))
+
+    def test_private_queue_order(self):
+        # 私有队列自右向左即为返回顺序, 与 get_logs 读取私有队列的顺序一致
+        self.fill(self.queue_a, 1)
+        self.fill(self.queue_b, 10)
+        log_strs = self.provider._pop_by_weight(8)
+        self.assertEqual(list(reversed(self.conn.lists['private'])), log_strs)
+
+    def test_empty(self):
+        self.assertEqual(self.provider._pop_by_weight(10), [])
+
+    def test_write_by_data_type(self):
+        # 配置了权重的类型写入独立队列, 其余写入原始队列
+        self.assertTrue(self.provider.batch_write([
+            {'data_type': 'A', 'n': 0}, {'data_type': 'B', 'n': 1}, {'data_type': 'C', 'n': 2}, {'n': 3}]))
+        self.assertTrue(self.provider.write({'data_type': 'A', 'n': 4}))
+
+        def queued(queue_name):
+            return [json.loads(log_str)['n'] for log_str in self.conn.lists[queue_name]]
+        self.assertEqual(queued(self.queue_a), [0, 4])
+        self.assertEqual(queued(self.queue_b), [1])
+        self.assertEqual(queued(self.origin), [2, 3])
+        self.assertEqual(self.provider.backlog(), 5)
+
+    def test_drain_all_partitions(self):
+        self.fill(self.queue_a, 6)
+        self.fill(self.queue_b, 4)
+        self.fill(self.origin, 3)
+        drained = []
+        for _ in range(3):
+            log_strs = self.provider._pop_by_weight(5)
+            drained.extend(log_strs)
+            self.conn.lists['private'].clear()
+        self.assertEqual(self.count_by_queue(drained), {self.queue_a: 6, self.queue_b: 4, self.origin: 3})
+        self.assertEqual(self.provider.backlog(), 0)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+SnapshotDelta 相邻两天快照的差异计算
+"""
+
+import datetime
+import unittest
+from unittest import mock
+
+from audit.models import DbUserRoleModel, ServerInfo, UserRoleDataModel
+from audit.rule_handler import SnapshotDelta
+
+PREV_DATE = datetime.datetime(2020, 10, 1)
+RECORD_DATE = datetime.datetime(2020, 10, 2)
+
+
+def match(doc, query) -> bool:
+    """支持等值及 $in 条件"""
+    for key, cond in query.items():
+        if isinstance(cond, dict):
+            if doc.get(key) not in cond['$in']:
+                return False
+        elif doc.get(key) != cond:
+            return False
+    return True
+
+
+class FakeCollection(object):
+    """按查询条件过滤并投影, 模拟 find 的返回"""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def find(self, query, projection):
+        self.queries.append(query)
+        fields = [field for field, included in projection.items() if included]
+        for doc in self.docs:
+            if match(doc, query):
+                yield {field: doc[field] for field in fields if field in doc}
+
+
+class SnapshotDeltaTest(unittest.TestCase):
+
+    def compute(self, snapshots: dict, filters=None) -> SnapshotDelta:
+        """snapshots: {model: [文档, ...]}, 未给出的model两天均为空"""
+        with mock.patch.object(UserRoleDataModel, '_get_collection',
+                               return_value=FakeCollection(snapshots.get(UserRoleDataModel, []))), \
+                mock.patch.object(ServerInfo, '_get_collection',
+                                  return_value=FakeCollection(snapshots.get(ServerInfo, []))), \
+                mock.patch.object(DbUserRoleModel, '_get_collection',
+                                  return_value=FakeCollection(snapshots.get(DbUserRoleModel, []))):
+            return SnapshotDelta(PREV_DATE, RECORD_DATE, filters).compute()
+
+    @staticmethod
+    def user_role(bg_name, user, role, record_date, **extra):
+        return dict(bg_name=bg_name, user=user, role=role, record_date=record_date, **extra)
+
+    def test_added_and_removed(self):
+        delta = self.compute({
+            UserRoleDataModel: [
+                self.user_role('bg1', 'alice', 'admin', PREV_DATE),
+                self.user_role('bg1', 'bob', 'viewer', PREV_DATE),
+                self.user_role('bg2', 'carol', 'admin', PREV_DATE),
+                self.user_role('bg1', 'alice', 'admin', RECORD_DATE),
+                self.user_role('bg1', 'bob', 'admin', RECORD_DATE),
+                self.user_role('bg2', 'dave', 'admin', RECORD_DATE),
+            ],
+            ServerInfo: [
+                dict(server_name='host1', root_user='root1', record_date=PREV_DATE),
+                dict(server_name='host1', root_user='root1', record_date=RECORD_DATE),
+                dict(server_name='host2', root_user='root2', record_date=RECORD_DATE),
+            ],
+            DbUserRoleModel: [
+                dict(user='eve', role='dba', record_date=PREV_DATE),
+                dict(user='eve', role='dba', record_date=RECORD_DATE),
+            ],
+        })
+        self.assertTrue(delta.complete)
+        self.assertEqual(delta.added[UserRoleDataModel], {('bg1', 'bob', 'admin'), ('bg2', 'dave', 'admin')})
+        self.assertEqual(delta.removed[UserRoleDataModel], {('bg1', 'bob', 'viewer'), ('bg2', 'carol', 'admin')})
+        self.assertEqual(delta.added[ServerInfo], {('host2', 'root2')})
+        self.assertEqual(delta.removed[ServerInfo], set())
+        self.assertEqual(delta.changed(DbUserRoleModel), set())
+
+        self.assertEqual(delta.app_users({'bg1'}), {'bob'})
+        self.assertEqual(delta.app_users({'bg1', 'bg2'}), {'bob', 'carol', 'dave'})
+        self.assertEqual(delta.app_users({'bg3'}), set())
+        self.assertEqual(delta.sys_users({'host1', 'host2'}), {'root2'})
+        self.assertEqual(delta.db_users(), set())
+
+    def test_ignore_unrelated_fields(self):
+        # 只比较决定权限的字段, 其余字段变化不算差异
+        delta = self.compute({
+            UserRoleDataModel: [
+                self.user_role('bg1', 'alice', 'admin', PREV_DATE, _id=1, dept='a'),
+                self.user_role('bg1', 'alice', 'admin', RECORD_DATE, _id=2, dept='b'),
+            ],
+            DbUserRoleModel: [
+                dict(user='eve', role='dba', server_name='db1', record_date=PREV_DATE),
+                dict(user='eve', role='dba', server_name='db2', record_date=RECORD_DATE),
+                dict(user='frank', role=None, record_date=RECORD_DATE),
+            ],
+        })
+        self.assertEqual(delta.changed(UserRoleDataModel), set())
+        self.assertEqual(delta.added[DbUserRoleModel], {('frank', None)})
+        self.assertEqual(delta.db_users(), {'frank'})
+
+    def test_incomplete_snapshot(self):
+        # 任一天快照为空而另一天不为空, 差异不可信
+        delta = self.compute({
+            ServerInfo: [dict(server_name='host1', root_user='root1', record_date=PREV_DATE)],
+        })
+        self.assertFalse(delta.complete)
+        self.assertEqual(delta.removed[ServerInfo], {('host1', 'root1')})
+
+    def test_both_days_empty(self):
+        delta = self.compute({})
+        self.assertTrue(delta.complete)
+        for model, _ in SnapshotDelta.snapshot_fields:
+            self.assertEqual(delta.changed(model), set())
+
+    def test_filter_by_business_line(self):
+        # 只载入业务线资产范围内的快照, 其他业务线的变化及缺失不影响
+        delta = self.compute({
+            UserRoleDataModel: [
+                self.user_role('bg1', 'alice', 'admin', PREV_DATE),
+                self.user_role('bg1', 'alice', 'admin', RECORD_DATE),
+                self.user_role('bg1', 'bob', 'admin', RECORD_DATE),
+                self.user_role('bg2', 'carol', 'admin', PREV_DATE),
+            ],
+            ServerInfo: [
+                dict(server_name='host1', root_user='root1', record_date=PREV_DATE),
+                dict(server_name='host1', root_user='root1', record_date=RECORD_DATE),
+            ],
+        }, filters={
+            UserRoleDataModel: {'bg_name': {'$in': ['bg1']}},
+            ServerInfo: {'server_name': {'$in': ['host1']}},
+        })
+        self.assertTrue(delta.complete)
+        self.assertEqual(delta.changed(UserRoleDataModel), {('bg1', 'bob', 'admin')})
+        self.assertEqual(delta.app_users({'bg1', 'bg2'}), {'bob'})
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+FastValidator 与 cerberus 对同一输入的判定必须一致
+"""
+
+import random
+import unittest
+
+from cerberus import Validator
+
+from audit.utils import data_type_schema_map, get_data_validator
+
+VALID_TS = 1600000000
+
+# 各类规则的候选值, 包含合法值及边界非法值
+CANDIDATE_VALUES = [
+    '', ' ', 'a', 'abc', 'GET', 'get', 'post', 'PATCH', 'add', 'delete', 'create',
+    '12345', '123456789', '012345', '1234567890123456', '12345\n',
+    '1.2.3.4', '255.255.255.255', '256.1.1.1', '01.2.3.4', '1.2.3.4\n', '1.2.3', '::1', 'fe80::1%eth0',
+    '2020-10-01', '2020-10-01\n', '2020-02-29', '2020-02-30', '2021-02-29', '2020-13-01', '2020-1-1',
+    ' 2020-10-01', '20201001',
+    0, 1, -1, True, False, VALID_TS, VALID_TS * 1000, 10 ** 20, 1.5, None,
+    [], {}, ['a'], {'user': 'a'},
+]
+
+
+def sample_value(rule, rng):
+    if rule.get('type') == 'list' and rng.random() < 0.8:
+        item_rule = rule.get('schema', {})
+        return [sample_value(item_rule, rng) for _ in range(rng.randint(0, 3))]
+    if rule.get('type') == 'dict' and 'schema' in rule and rng.random() < 0.8:
+        return sample_document(rule['schema'], rng)
+    return rng.choice(CANDIDATE_VALUES)
+
+
+def sample_document(schema, rng):
+    document = {}
+    for field, rule in schema.items():
+        if rng.random() < 0.05:
+            continue
+        document[field] = sample_value(rule, rng)
+    if rng.random() < 0.05:
+        document['unknown'] = 'x'
+    return document
+
+
+def valid_value(rule):
+    """规则对应的一个合法值"""
+    if rule.get('type') == 'list':
+        return [valid_value(rule['schema'])]
+    if rule.get('type') == 'dict':
+        return {field: valid_value(sub_rule) for field, sub_rule in rule['schema'].items()}
+    if rule.get('type') == 'integer':
+        return VALID_TS
+    if 'allowed' in rule:
+        return rule['allowed'][0]
+    if 'regex' in rule:
+        return '12345'
+    check_with = getattr(rule.get('check_with'), '__name__', '')
+    if check_with == 'check_ip':
+        return '1.2.3.4'
+    if check_with == 'check_date_str':
+        return '2020-10-01'
+    return 'abc'
+
+
+class FastValidatorEquivalenceTest(unittest.TestCase):
+
+    def assert_same(self, data_type, document):
+        expected = Validator(data_type_schema_map[data_type])
+        expected_valid = expected.validate(document)
+        fast = get_data_validator(data_type)
+        fast_valid = fast.validate(document)
+        self.assertEqual(expected_valid, fast_valid, f'{data_type} {document!r}')
+        self.assertEqual(expected.errors, fast.errors, f'{data_type} {document!r}')
+        if expected_valid:
+            self.assertEqual(expected.document, fast.document, f'{data_type} {document!r}')
+
+    def test_valid_documents(self):
+        for data_type, schema in data_type_schema_map.items():
+            document = {field: valid_value(rule) for field, rule in schema.items()}
+            self.assert_same(data_type, document)
+            self.assertTrue(get_data_validator(data_type).validate(document), data_type)
+
+    def test_single_field_mutations(self):
+        for data_type, schema in data_type_schema_map.items():
+            base = {field: valid_value(rule) for field, rule in schema.items()}
+            for field in schema:
+                for value in CANDIDATE_VALUES:
+                    self.assert_same(data_type, dict(base, **{field: value}))
+
+    def test_known_mismatches(self):
+        base = {field: valid_value(rule) for field, rule in data_type_schema_map['UserRoleData'].items()}
+        for date in ('2020-02-30', '2021-02-29', '2020-10-01\n'):
+            document = dict(base, date=date)
+            self.assertFalse(get_data_validator('UserRoleData').validate(document), date)
+            self.assert_same('UserRoleData', document)
+
+        base = {field: valid_value(rule) for field, rule in data_type_schema_map['BgAccessLog'].items()}
+        document = dict(base, ip='1.2.3.4\n')
+        self.assertFalse(get_data_validator('BgAccessLog').validate(document))
+        self.assert_same('BgAccessLog', document)
+
+    def test_random_documents(self):
+        rng = random.Random(20201001)
+        for data_type, schema in data_type_schema_map.items():
+            for _ in range(300):
+                self.assert_same(data_type, sample_document(schema, rng))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,11 +19,24 @@ import ipaddress
 import json
 import logging
 import os
+import re
 import socket
+import threading
 import time
+import uuid
+from collections import defaultdict
+from collections.abc import Sized
 from datetime import datetime
+from functools import lru_cache
+
+import redis
+from cerberus import Validator
+from django.conf import settings
 
 from core import get_redis_client
+from core.invalidation import invalidation_bus
+from core.redis_conn import cache_version
+from core.util.hash_util import md5
 
 logger = logging.getLogger(__name__)
 
@@ -153,6 +166,226 @@ def get_data_check_schema(data_type):
         return None
 
 
+##################
+# FAST VALIDATOR #
+##################
+
+_left_ts = _left_dt.timestamp()
+_right_ts = _right_dt.timestamp()
+_ipv4_pattern = re.compile(r'((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)')
+
+# check_with函数的快速判定, 只能对原函数同样判定合法的值返回True, 判定不通过时再调用原函数;
+# 日期需校验闰年、月份天数等, 直接由原函数(strptime)判定
+fast_check_with_map = {
+    check_timestamp: lambda value: _left_ts < value < _right_ts,
+    check_ip: lambda value: value == '' or _ipv4_pattern.fullmatch(value) is not None,
+}
+
+_type_check_map = {
+    'string': lambda value: isinstance(value, str),
+    'integer': lambda value: isinstance(value, int) and not isinstance(value, bool),
+    'list': lambda value: isinstance(value, list),
+    'dict': lambda value: isinstance(value, dict),
+}
+
+_compiled_rule_keys = {'type', 'required', 'coerce', 'allowed', 'minlength', 'regex', 'check_with', 'schema'}
+
+# 快速校验无法确定结果, 交由cerberus处理
+UNDECIDED = object()
+
+
+def _compile_check_with(func, field):
+    fast_check = fast_check_with_map.get(func)
+
+    def check(value):
+        if fast_check and fast_check(value):
+            return True
+        errors = []
+        func(field, value, lambda *args: errors.append(args))
+        return not errors
+    return check
+
+
+def _compile_list_schema(field, item_rule):
+    item_check = _compile_rule(field, item_rule)
+
+    def check(value):
+        result = []
+        for item in value:
+            item = item_check(item)
+            if item is UNDECIDED:
+                return UNDECIDED
+            result.append(item)
+        return result
+    return check
+
+
+def _compile_rule(field, rule):
+    """
+        将单个字段的cerberus规则编译为校验函数, 返回规范化后的值或UNDECIDED
+    """
+    if not rule.keys() <= _compiled_rule_keys or rule.get('type') not in _type_check_map:
+        return lambda value: UNDECIDED
+
+    coerce = rule.get('coerce')
+    checks = [_type_check_map[rule['type']]]
+    if 'allowed' in rule:
+        allowed = frozenset(rule['allowed'])
+        checks.append(lambda value: value in allowed)
+    if 'minlength' in rule:
+        minlength = rule['minlength']
+        checks.append(lambda value: len(value) >= minlength)
+    if 'regex' in rule:
+        # 与cerberus一致, 未以$结尾的正则自动补全
+        pattern = rule['regex'] if rule['regex'].endswith('$') else rule['regex'] + '$'
+        regex = re.compile(pattern)
+        checks.append(lambda value: bool(regex.match(value)))
+    if 'check_with' in rule:
+        checks.append(_compile_check_with(rule['check_with'], field))
+    checks = tuple(checks)
+
+    sub_check = None
+    if 'schema' in rule:
+        if rule['type'] == 'list':
+            sub_check = _compile_list_schema(field, rule['schema'])
+        else:
+            sub_check = compile_schema(rule['schema'])
+
+    def check(value):
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except Exception:
+                return UNDECIDED
+        # cerberus对空值跳过minlength/regex/check_with等规则, 交由其判定
+        if isinstance(value, Sized) and len(value) == 0:
+            return UNDECIDED
+        for check_func in checks:
+            if not check_func(value):
+                return UNDECIDED
+        if sub_check is not None:
+            return sub_check(value)
+        return value
+    return check
+
+
+def compile_schema(schema):
+    """
+        将cerberus schema编译为校验函数, 仅对确定合法的数据返回规范化后的文档,
+        其余情况返回UNDECIDED
+    """
+    field_checks = tuple((field, rule.get('required', False), _compile_rule(field, rule))
+                         for field, rule in schema.items())
+    known_fields = frozenset(schema)
+
+    def check(document):
+        if not isinstance(document, dict) or not document.keys() <= known_fields:
+            return UNDECIDED
+        result = {}
+        for field, required, field_check in field_checks:
+            if field not in document:
+                if required:
+                    return UNDECIDED
+                continue
+            value = field_check(document[field])
+            if value is UNDECIDED:
+                return UNDECIDED
+            result[field] = value
+        return result
+    return check
+
+
+@lru_cache(maxsize=None)
+def get_compiled_schema(data_type):
+    return compile_schema(data_type_schema_map[data_type])
+
+
+class FastValidator(object):
+    """
+        预编译schema的快速校验, 接口与cerberus Validator一致;
+        快速校验无法确定的数据由cerberus校验, 保证错误信息格式不变
+    """
+
+    def __init__(self, data_type):
+        self.schema = data_type_schema_map[data_type]
+        self.fast_check = get_compiled_schema(data_type)
+        self.validator = None
+        self.errors = {}
+        self.document = None
+
+    def validate(self, document):
+        result = self.fast_check(document)
+        if result is not UNDECIDED:
+            self.errors = {}
+            self.document = result
+            return True
+
+        if self.validator is None:
+            self.validator = Validator(self.schema)
+        self.validator.validate(document)
+        self.errors = self.validator.errors
+        self.document = self.validator.document
+        return not self.errors
+
+
+def get_data_validator(data_type):
+    if data_type not in data_type_schema_map:
+        return None
+    return FastValidator(data_type)
+
+
+#################
+# CACHE VERSION #
+#################
+
+def model_namespace(model) -> str:
+    name = model if isinstance(model, str) else model.__name__
+    return cache_version.namespace('model', name)
+
+
+def audit_sys_namespace(audit_sys) -> str:
+    return cache_version.namespace('audit_sys', str(getattr(audit_sys, 'id', audit_sys)))
+
+
+def task_namespace(task) -> str:
+    return cache_version.namespace('task', str(getattr(task, 'id', task)))
+
+
+def logs_namespace() -> str:
+    """
+    日志数据(应用访问日志、数据库日志等), 上报队列积压时前几天的日志可能延迟写入
+    """
+    return cache_version.namespace('logs')
+
+
+def instance_namespaces(instance) -> list:
+    """
+    单条数据变更影响的命名空间: 所属model, 以及所属业务线、任务(含自身)
+    """
+    model = type(instance)
+    namespaces = [model_namespace(model)]
+    if model.__name__ == 'AuditSysModel':
+        namespaces.append(audit_sys_namespace(instance.id))
+    elif model.__name__ == 'AuditTaskModel':
+        namespaces.append(task_namespace(instance.id))
+    data = getattr(instance, '_data', {})
+    # 直接取引用字段的原始值, 避免解引用查询
+    for field, build_namespace in (('audit_sys', audit_sys_namespace),
+                                   ('sys', audit_sys_namespace),
+                                   ('task', task_namespace)):
+        if field in getattr(model, '_fields', {}) and data.get(field):
+            namespaces.append(build_namespace(data[field]))
+    return namespaces
+
+
+def bump_cache_versions(*namespaces):
+    """
+    redis缓存按版本号失效, 各进程的本地缓存通过失效总线清空
+    """
+    cache_version.bump(*namespaces)
+    invalidation_bus.publish(*namespaces)
+
+
 def build_private_queue_name(business_type: str) -> str:
     """
         构造一个本进程持有的私有名称
@@ -165,39 +398,310 @@ def build_private_queue_name(business_type: str) -> str:
     return '{}|{}|{}'.format(business_type, hostname.replace('.', '_'), special_key)
 
 
+def dump_message(data: dict) -> str:
+    """
+        序列化上报数据, 附带msg_id使相同内容的不同上报可区分, 用于消费端去重
+    """
+    if 'msg_id' not in data:
+        data = dict(data, msg_id=uuid.uuid4().hex)
+    return json.dumps(data, separators=(',', ':'))
+
+
+class MessageDeduplicator(object):
+    """
+        消费端去重: 写入成功的消息摘要按处理时间每小时记入一个集合, 集合整体过期, 不为每条消息单独建key;
+        判断时检查最近TTL内的各时间桶, 重复投递时跳过
+    """
+    key_prefix = 'bombus:business_bg:processed:'
+    dup_counter_key = 'bombus:business_bg:dup_count'
+    bucket_seconds = 3600
+
+    def __init__(self, conn, ttl=None):
+        self.conn = conn
+        self.ttl = getattr(settings, 'AUDIT_DEDUP_TTL', 0) if ttl is None else ttl
+
+    def bucket_keys(self) -> list:
+        """
+            当前时间桶在前, 覆盖TTL内写入过标记的全部时间桶
+        """
+        bucket = int(time.time()) // self.bucket_seconds
+        count = -(-self.ttl // self.bucket_seconds) + 1
+        return [f'{self.key_prefix}{bucket - i}' for i in range(count)]
+
+    def filter_processed(self, log_strs: list) -> list:
+        """
+            过滤已处理的消息, 返回未处理的消息
+        """
+        if not self.ttl or not log_strs:
+            return log_strs
+        keys = self.bucket_keys()
+        try:
+            pipe = self.conn.pipeline(transaction=False)
+            for log_str in log_strs:
+                digest = md5(log_str)
+                for key in keys:
+                    pipe.sismember(key, digest)
+            marks = pipe.execute()
+        except Exception:
+            logger.exception('check processed logs fail')
+            return log_strs
+        width = len(keys)
+        result = [log_str for i, log_str in enumerate(log_strs) if not any(marks[i * width:(i + 1) * width])]
+        dup_count = len(log_strs) - len(result)
+        if dup_count:
+            logger.info(f'drop {dup_count} duplicate logs')
+            try:
+                self.conn.incrby(self.dup_counter_key, dup_count)
+            except Exception:
+                logger.exception('record duplicate count fail')
+        return result
+
+    def mark_processed(self, log_strs: list):
+        if not self.ttl or not log_strs:
+            return
+        key = self.bucket_keys()[0]
+        try:
+            pipe = self.conn.pipeline(transaction=False)
+            pipe.sadd(key, *[md5(log_str) for log_str in log_strs])
+            # 时间桶内最后写入的标记同样保留TTL
+            pipe.expire(key, self.ttl + self.bucket_seconds)
+            pipe.execute()
+        except Exception:
+            logger.exception('mark processed logs fail')
+
+
+class WeightedScheduler(object):
+    """
+        平滑加权轮询, 按权重在多个队列间分配消费额度
+    """
+
+    def __init__(self, weights: dict):
+        self.weights = {k: w for k, w in weights.items() if w > 0}
+        self.total_weight = sum(self.weights.values())
+        self.current_weights = {k: 0 for k in self.weights}
+        self.priority = sorted(self.weights, key=self.weights.get, reverse=True)
+
+    def next(self, candidates=None):
+        """
+            candidates: 仅在这些队列间轮询, 默认全部队列
+        """
+        if candidates is None:
+            candidates = self.weights
+        candidates = [k for k in self.weights if k in candidates]
+        for k in candidates:
+            self.current_weights[k] += self.weights[k]
+        selected = max(candidates, key=self.current_weights.get)
+        self.current_weights[selected] -= sum(self.weights[k] for k in candidates)
+        return selected
+
+    def order(self):
+        """
+            本轮首选队列在前, 其余按权重降序
+        """
+        selected = self.next()
+        return [selected] + [k for k in self.priority if k != selected]
+
+    def allocate(self, count, candidates=None):
+        quotas = defaultdict(int)
+        if candidates is not None and not candidates:
+            return quotas
+        for _ in range(count):
+            quotas[self.next(candidates)] += 1
+        return quotas
+
+
 class RedisDataProvider(object):
     business_type = 'third_bg_log'
     redis_name = 'audit_redis'
     origin_queue_name = 'bombus:business_bg:log:list'
 
+    # 私有队列心跳, 由后台线程定期续期, 单批次处理耗时超过TTL时也不会被回收;
+    # 续期同时在登记表中记录最近心跳时间, 只有登记过的私有队列才会被回收
+    heartbeat_ttl = 5 * 60
+    heartbeat_interval = 30
+    consumer_registry_key = 'bombus:business_bg:consumers'
+    # 心跳停止超过该时长才回收, 不小于一次发布窗口
+    reap_grace = 30 * 60
+    # 心跳不存在时将私有队列数据原子性地放回原始队列, 并注销登记
+    reap_script = """
+        if redis.call('exists', KEYS[3]) == 1 then
+            return 0
+        end
+        local count = 0
+        local log_str = redis.call('rpop', KEYS[1])
+        while log_str do
+            redis.call('rpush', KEYS[2], log_str)
+            count = count + 1
+            log_str = redis.call('rpop', KEYS[1])
+        end
+        redis.call('hdel', KEYS[4], ARGV[1])
+        return count
+    """
+
     def __init__(self):
         super(RedisDataProvider, self).__init__()
         self.conn = get_redis_client(self.redis_name)
         self.private_queue_name = None
+        self.heartbeat_pid = None
+        self.queue_weights = getattr(settings, 'AUDIT_QUEUE_WEIGHTS', {})
+        self.scheduler = None
+
+    def route_queue(self, data_type):
+        """
+            配置了权重的data_type写入独立队列, 其余写入原始队列
+        """
+        if data_type in self.queue_weights:
+            return f'{self.origin_queue_name}:{data_type}'
+        return self.origin_queue_name
+
+    def get_scheduler(self):
+        if not self.scheduler:
+            # 原始队列兼容未分区的历史数据及回收的私有队列数据
+            weights = {self.origin_queue_name: 1}
+            for data_type, weight in self.queue_weights.items():
+                weights[self.route_queue(data_type)] = weight
+            self.scheduler = WeightedScheduler(weights)
+        return self.scheduler
+
+    @staticmethod
+    def build_heartbeat_key(queue_name):
+        return f'heartbeat:{queue_name}'
+
+    def heartbeat(self):
+        now = int(time.time())
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.setex(self.build_heartbeat_key(self.private_queue_name), self.heartbeat_ttl, now)
+        pipe.hset(self.consumer_registry_key, self.private_queue_name, now)
+        pipe.execute()
+
+    def ensure_heartbeat(self):
+        """
+            首次取数前同步写入心跳并启动续期线程; 按pid判断, fork出的子进程首次调用时重新启动
+        """
+        pid = os.getpid()
+        if self.heartbeat_pid == pid:
+            return
+        self.heartbeat()
+        threading.Thread(target=self.run_heartbeat, name='queue-heartbeat', daemon=True).start()
+        self.heartbeat_pid = pid
+
+    def run_heartbeat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.exception(f'refresh heartbeat of {self.private_queue_name} fail')
+
+    def reap_orphan_queues(self):
+        """
+            将已失效进程遗留在私有队列中的数据放回原始队列;
+            只处理登记过心跳且心跳停止超过reap_grace的队列, 未登记的私有队列(如滚动发布中的旧版本进程)不处理
+        :return: {私有队列名称: 放回条数}
+        """
+        result = {}
+        now = int(time.time())
+        reap = self.conn.register_script(self.reap_script)
+        for queue_name, last_ts in self.conn.hgetall(self.consumer_registry_key).items():
+            if queue_name == self.private_queue_name or now - int(last_ts) < self.reap_grace:
+                continue
+            try:
+                count = reap(keys=[queue_name, self.origin_queue_name, self.build_heartbeat_key(queue_name),
+                                   self.consumer_registry_key], args=[queue_name])
+            except Exception:
+                logger.exception(f'reap orphan queue {queue_name} fail')
+                continue
+            if count:
+                result[queue_name] = count
+        return result
 
     def get_log(self):
         if not self.private_queue_name:
             self.private_queue_name = build_private_queue_name(self.business_type)
         conn = self.conn
+        self.ensure_heartbeat()
         while True:
             log_str = conn.lindex(self.private_queue_name, -1)
 
             if not log_str:
-                log_str = conn.rpoplpush(self.origin_queue_name,
-                                         self.private_queue_name)
+                for queue_name in self.get_scheduler().order():
+                    log_str = conn.rpoplpush(queue_name, self.private_queue_name)
+                    if log_str:
+                        break
 
             if log_str:
                 return log_str
             else:
                 time.sleep(0.1)
 
+    def get_logs(self, batch_size):
+        """
+            批量获取日志, 未ack的私有队列数据优先返回
+        :param batch_size: 单批最大条数
+        :return: 按入队顺序排列的日志列表
+        """
+        if not self.private_queue_name:
+            self.private_queue_name = build_private_queue_name(self.business_type)
+        conn = self.conn
+        self.ensure_heartbeat()
+        while True:
+            # 私有队列左端为最新数据, ack时从左端裁剪
+            log_strs = conn.lrange(self.private_queue_name, 0, batch_size - 1)
+            log_strs.reverse()
+
+            if not log_strs:
+                log_strs = self._pop_by_weight(batch_size)
+
+            if log_strs:
+                return log_strs
+            else:
+                time.sleep(0.1)
+
+    def _pop_by_weight(self, batch_size):
+        """
+            按权重分配各队列额度并批量转移到私有队列;
+            取不满额度的队列视为已空, 剩余额度在仍有数据的队列间按权重继续分配,
+            直到取满batch_size或全部队列为空
+        """
+        scheduler = self.get_scheduler()
+        candidates = set(scheduler.weights)
+        log_strs = []
+        while len(log_strs) < batch_size and candidates:
+            quotas = scheduler.allocate(batch_size - len(log_strs), candidates)
+
+            pipe = self.conn.pipeline(transaction=False)
+            for queue_name, quota in quotas.items():
+                for _ in range(quota):
+                    pipe.rpoplpush(queue_name, self.private_queue_name)
+            results = iter(pipe.execute())
+
+            for queue_name, quota in quotas.items():
+                popped = [log_str for log_str in (next(results) for _ in range(quota)) if log_str]
+                if len(popped) < quota:
+                    candidates.discard(queue_name)
+                log_strs.extend(popped)
+        return log_strs
+
+    def backlog(self):
+        """
+            待消费数据总量
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        for queue_name in self.get_scheduler().weights:
+            pipe.llen(queue_name)
+        return sum(pipe.execute())
+
     def ack(self):
         self.conn.lpop(self.private_queue_name)
 
+    def batch_ack(self, count):
+        self.conn.ltrim(self.private_queue_name, count, -1)
+
     def write(self, data):
         try:
-            data = json.dumps(data, separators=(',', ':'))
-            self.conn.rpush(self.origin_queue_name, data)
+            queue_name = self.route_queue(data.get('data_type'))
+            data = dump_message(data)
+            self.conn.rpush(queue_name, data)
             return True
         except Exception:
             logger.exception(f'persistence {data} error')
@@ -205,9 +709,211 @@ class RedisDataProvider(object):
 
     def batch_write(self, datas):
         try:
-            datas = [json.dumps(data, separators=(',', ':')) for data in datas]
-            self.conn.rpush(self.origin_queue_name, *datas)
+            queue_datas = defaultdict(list)
+            for data in datas:
+                queue_datas[self.route_queue(data.get('data_type'))].append(
+                    dump_message(data))
+            pipe = self.conn.pipeline(transaction=False)
+            for queue_name, items in queue_datas.items():
+                pipe.rpush(queue_name, *items)
+            pipe.execute()
             return True
         except Exception:
             logger.exception(f'persistence {datas} error')
             return False
+
+
+class RedisStreamDataProvider(object):
+    """
+        基于Redis Stream消费组的数据通道, 接口与RedisDataProvider保持一致
+    """
+    business_type = 'third_bg_log'
+    redis_name = 'audit_redis'
+    stream_name = 'bombus:business_bg:log:stream'
+    group_name = 'bombus:business_bg:persistence'
+    # 阻塞读取时长需小于连接的socket_timeout
+    block_ms = 500
+    # 超过该时长未ack的消息视为消费者已失效, 由其他消费者认领
+    claim_idle_ms = 5 * 60 * 1000
+    claim_interval = 60
+
+    def __init__(self):
+        super(RedisStreamDataProvider, self).__init__()
+        self.conn = get_redis_client(self.redis_name)
+        self.consumer_name = None
+        self.pending_ids = []
+        self.last_claim_ts = 0
+
+    def ensure_group(self):
+        try:
+            self.conn.xgroup_create(self.stream_name, self.group_name, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def _read_pending(self, count):
+        """
+            读取本消费者已投递未ack的消息, 进程以相同名称重启后优先处理
+        """
+        result = self.conn.xreadgroup(self.group_name, self.consumer_name,
+                                      {self.stream_name: '0'}, count=count)
+        return result[0][1] if result else []
+
+    def _claim_idle(self, count):
+        """
+            通过XAUTOCLAIM认领其他失效消费者的待处理消息
+        """
+        now = time.time()
+        if now - self.last_claim_ts < self.claim_interval:
+            return []
+        self.last_claim_ts = now
+        # redis-py 3.x 未封装XAUTOCLAIM, 直接执行命令并自行解析结果
+        result = self.conn.execute_command('XAUTOCLAIM', self.stream_name, self.group_name,
+                                           self.consumer_name, self.claim_idle_ms, '0-0',
+                                           'COUNT', count)
+        entries = []
+        for entry_id, fields in result[1]:
+            if fields:
+                fields = dict(zip(fields[::2], fields[1::2]))
+            entries.append((entry_id, fields))
+        return entries
+
+    def _read_new(self, count):
+        result = self.conn.xreadgroup(self.group_name, self.consumer_name,
+                                      {self.stream_name: '>'}, count=count,
+                                      block=self.block_ms)
+        return result[0][1] if result else []
+
+    def get_logs(self, batch_size):
+        if not self.consumer_name:
+            self.consumer_name = build_private_queue_name(self.business_type)
+            self.ensure_group()
+        while True:
+            entries = self._read_pending(batch_size) or self._claim_idle(batch_size) or \
+                self._read_new(batch_size)
+
+            # 已被删除的消息fields为空, 直接ack
+            deleted_ids = [entry_id for entry_id, fields in entries if not fields]
+            if deleted_ids:
+                self._ack_ids(deleted_ids)
+            entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+
+            if entries:
+                self.pending_ids = [entry_id for entry_id, _ in entries]
+                return [fields['log'] for _, fields in entries]
+
+    def get_log(self):
+        return self.get_logs(1)[0]
+
+    def backlog(self):
+        """
+            已ack的消息会被删除, stream长度即未投递及未ack的消息数
+        """
+        return self.conn.xlen(self.stream_name)
+
+    def _ack_ids(self, ids):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.xack(self.stream_name, self.group_name, *ids)
+        pipe.xdel(self.stream_name, *ids)
+        pipe.execute()
+
+    def ack(self):
+        self.batch_ack(len(self.pending_ids))
+
+    def batch_ack(self, count):
+        ids, self.pending_ids = self.pending_ids[:count], self.pending_ids[count:]
+        if ids:
+            self._ack_ids(ids)
+
+    def write(self, data):
+        try:
+            data = dump_message(data)
+            self.conn.xadd(self.stream_name, {'log': data})
+            return True
+        except Exception:
+            logger.exception(f'persistence {data} error')
+            return False
+
+    def batch_write(self, datas):
+        try:
+            datas = [dump_message(data) for data in datas]
+            pipe = self.conn.pipeline(transaction=False)
+            for data in datas:
+                pipe.xadd(self.stream_name, {'log': data})
+            pipe.execute()
+            return True
+        except Exception:
+            logger.exception(f'persistence {datas} error')
+            return False
+
+
+class Backpressure(object):
+    """
+        上报限流: 积压量或redis内存超过高水位后拒绝上报, 均回落到低水位以下再恢复;
+        内存包含待消费数据及消费端去重标记
+    """
+    shed_counter_key = 'bombus:business_bg:shed_count'
+
+    def __init__(self, conf: dict):
+        conf = conf or {}
+        self.enabled = bool(conf)
+        self.high_watermark = conf.get('high_watermark', 0)
+        self.low_watermark = conf.get('low_watermark', self.high_watermark)
+        self.retry_after = conf.get('retry_after', 60)
+        self.shed_data_types = set(conf.get('shed_data_types') or [])
+        self.check_interval = conf.get('check_interval', 1)
+        # 为0时不按内存限流
+        self.memory_high_watermark = conf.get('memory_high_watermark', 0)
+        self.memory_low_watermark = conf.get('memory_low_watermark', self.memory_high_watermark)
+        self.shedding = False
+        self.last_check_ts = 0
+
+    def should_shed(self, provider, data_type):
+        if not self.enabled:
+            return False
+        if self.shed_data_types and data_type not in self.shed_data_types:
+            return False
+
+        now = time.time()
+        if now - self.last_check_ts >= self.check_interval:
+            self.last_check_ts = now
+            try:
+                backlog = provider.backlog()
+                used_memory = self.used_memory(provider)
+            except Exception:
+                logger.exception('get backlog fail')
+                return False
+            if backlog >= self.high_watermark or (
+                    self.memory_high_watermark and used_memory >= self.memory_high_watermark):
+                self.shedding = True
+            elif backlog <= self.low_watermark and used_memory <= self.memory_low_watermark:
+                self.shedding = False
+        return self.shedding
+
+    def used_memory(self, provider):
+        if not self.memory_high_watermark:
+            return 0
+        return provider.conn.info('memory')['used_memory']
+
+    def record_shed(self, provider, data_type):
+        try:
+            provider.conn.hincrby(self.shed_counter_key, data_type or '', 1)
+        except Exception:
+            logger.exception(f'record shed {data_type} fail')
+
+
+backpressure = Backpressure(getattr(settings, 'AUDIT_QUEUE_BACKPRESSURE', None))
+
+
+data_provider_map = {
+    'list': RedisDataProvider,
+    'stream': RedisStreamDataProvider,
+}
+
+
+def get_data_provider():
+    """
+        根据AUDIT_DATA_PROVIDER配置选择数据通道
+    """
+    provider_type = getattr(settings, 'AUDIT_DATA_PROVIDER', 'list')
+    return data_provider_map[provider_type]()
@@ -18,10 +18,11 @@
 #  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
+import gzip
 import json
 import logging
+import zlib
 
-from cerberus import Validator
 from django.conf import settings
 from django.http import JsonResponse
 from django.views import View
@@ -48,7 +49,8 @@ from audit.serializers import (AuditServerSerializer, AuditSysSerializer,
                                TaskManagerSerializer,
                                TaskMessageBoardSerializer)
 from audit.statuschange import StatusChange
-from audit.utils import RedisDataProvider, get_data_check_schema
+from audit.utils import (backpressure, bump_cache_versions, get_data_provider,
+                         get_data_validator, instance_namespaces)
 from bombus.libs import permission_required
 from bombus.libs.baseview import GetViewSet, UpdateViewSet
 from bombus.libs.enums import (AuditPeriodEnum, OnOfflineStatusEnum,
@@ -62,7 +64,25 @@ from core.utils import get_email_prefix
 logger = logging.getLogger(__name__)
 
 
-class BaseViewSet(GetViewSet, UpdateViewSet):
+class CacheVersionMixin:
+    """
+    数据写入后递增所属model、业务线、任务的缓存版本号, 使相关缓存失效
+    """
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        bump_cache_versions(*instance_namespaces(serializer.instance))
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        bump_cache_versions(*instance_namespaces(serializer.instance))
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        bump_cache_versions(*instance_namespaces(instance))
+
+
+class BaseViewSet(CacheVersionMixin, GetViewSet, UpdateViewSet):
     """
     基础ViewSet
     """
@@ -112,7 +132,7 @@ class AuditSysViewSet(BaseViewSet):
 
 
 @permission_required(settings.CA_ASSET)
-class AuditServerViewSet(ModelViewSet):
+class AuditServerViewSet(CacheVersionMixin, ModelViewSet):
     """ 审计资产 """
 
     serializer_class = AuditServerSerializer
@@ -382,10 +402,116 @@ class CommonDataReport(APIView):
     permission_classes = [CommonDataAPIPermission]
     authentication_classes = [APIAuthentication]
 
+    ndjson_content_type = 'application/x-ndjson'
+    # 流式上报每批写入条数及返回的错误明细上限
+    stream_chunk_size = 500
+    max_rejected_details = 1000
+
     def post(self, request, **kwargs):
-        data = self.handle(request.data)
+        content_type = (request.content_type or '').split(';')[0].strip()
+        is_stream = content_type == self.ndjson_content_type
+        if is_stream:
+            data_type = request.query_params.get('data_type')
+        else:
+            origin_data = request.data
+            data_type = origin_data.get('data_type') if isinstance(origin_data, dict) else None
+
+        provider = get_data_provider()
+        if backpressure.should_shed(provider, data_type):
+            backpressure.record_shed(provider, data_type)
+            response = JsonResponse({
+                "message": "too many requests, retry later",
+                "result": False
+            }, status=429)
+            response['Retry-After'] = str(backpressure.retry_after)
+            return response
+
+        if is_stream:
+            data = self.handle_stream(request)
+        else:
+            data = self.handle(origin_data)
         return JsonResponse(data)
 
+    @staticmethod
+    def iter_lines(request):
+        stream = request._request
+        if request.META.get('HTTP_CONTENT_ENCODING', '').lower() == 'gzip':
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+        for line in stream:
+            yield line
+
+    def handle_stream(self, request):
+        """
+        NDJSON流式上报, 每行一条数据, data_type通过query参数指定;
+        逐行校验, 合法数据分批写入, 返回被拒绝的行号
+        """
+        data_type = request.query_params.get('data_type')
+        v = get_data_validator(data_type)
+        if v is None:
+            return {
+                "message": f"invalid data_type {data_type}",
+                "result": False
+            }
+
+        provider = get_data_provider()
+        chunk = []
+        accepted = 0
+        rejected = []
+        rejected_count = 0
+        line_no = 0
+        try:
+            for line_no, line in enumerate(self.iter_lines(request), 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    data = None
+                if not isinstance(data, dict):
+                    errors = 'invalid json object'
+                else:
+                    v.validate(data)
+                    errors = v.errors
+                if errors:
+                    rejected_count += 1
+                    if len(rejected) < self.max_rejected_details:
+                        rejected.append({'line': line_no, 'message': errors})
+                    continue
+
+                chunk.append({
+                    'data_type': data_type,
+                    'source': 'http',
+                    'data': v.document
+                })
+                if len(chunk) >= self.stream_chunk_size:
+                    if not provider.batch_write(chunk):
+                        raise IOError('persistence error')
+                    accepted += len(chunk)
+                    chunk = []
+            if chunk:
+                if not provider.batch_write(chunk):
+                    raise IOError('persistence error')
+                accepted += len(chunk)
+        except (OSError, EOFError, zlib.error) as e:
+            # gzip数据损坏时抛出zlib.error, 同样返回已接收的数量
+            logger.exception(f'stream report {data_type} fail at line {line_no}')
+            return {
+                "message": str(e) or 'invalid stream',
+                "result": False,
+                "accepted": accepted,
+                "rejected_count": rejected_count,
+                "rejected": rejected
+            }
+
+        return {
+            "message": 'OK' if not rejected_count else 'partial rejected',
+            "result": not rejected_count,
+            "accepted": accepted,
+            "rejected_count": rejected_count,
+            "rejected": rejected
+        }
+
     def handle(self, origin_data):
         data_type = origin_data.get('data_type')
         datas = origin_data.get('data')
@@ -395,13 +521,12 @@ class CommonDataReport(APIView):
                 "result": False
             }
 
-        schema = get_data_check_schema(data_type)
-        if schema is None:
+        v = get_data_validator(data_type)
+        if v is None:
             return {
                 "message": f"invalid data_type {data_type}",
                 "result": False
             }
-        v = Validator(schema)
         result_datas = []
         for data in datas:
             v.validate(data)
@@ -418,7 +543,7 @@ class CommonDataReport(APIView):
                 'data': v.document
             }
             result_datas.append(tmp)
-        if RedisDataProvider().batch_write(result_datas):
+        if get_data_provider().batch_write(result_datas):
             return {
                 "message": 'OK',
                 "result": True
@@ -23,9 +23,25 @@ self-defined serializer
 
 from rest_framework_mongoengine.serializers import DocumentSerializer
 
+from bombus.services.user_loader import get_user_loader, prime_users
+
 
 class BaseDocumentSerializer(DocumentSerializer):
     """ 自定义 """
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        """
+        列表序列化前, 批量预加载整页 *_render 需要的用户信息
+        """
+        if get_user_loader() is not None:
+            if args and args[0] is not None:
+                args = (list(args[0]),) + args[1:]
+                prime_users(args[0])
+            elif kwargs.get('instance') is not None:
+                kwargs['instance'] = list(kwargs['instance'])
+                prime_users(kwargs['instance'])
+        return super().many_init(*args, **kwargs)
+
     def to_representation(self, instance):
         """
         数据外显 下发额外字段
@@ -45,7 +61,9 @@ class BaseDocumentSerializer(DocumentSerializer):
             return result
         for _f in self.Meta.model._fields:
             field_render = _f + '_render'
-            if field_render in instance:
-                result[field_render] = getattr(instance, field_render)
+            # 与 `field_render in instance` 等价, 但只计算一次属性值
+            value = getattr(instance, field_render, None)
+            if value is not None:
+                result[field_render] = value
 
         return result
@@ -29,6 +29,7 @@ from django.utils.deprecation import MiddlewareMixin
 
 from bombus.libs.exception import FastResponse
 from bombus.models import ProjectAuditLogEntry
+from bombus.services.user_loader import user_loader_scope
 
 logger = logging.getLogger(__name__)
 
@@ -57,14 +58,13 @@ class ProjectAuditLogMiddleware:
         if path == self.LOGOUT_PATH:
             extra_params['req_user'] = request.user
 
+        # 白名单请求不记录日志, 也不读取body, 以支持流式上报
+        if self.in_white_list(path):
+            return self.get_response(request)
+
         request.body_copy = request.body
         response = self.get_response(request)
         try:
-            if path in self.URI_WHITH_LIST:
-                return response
-            for re_path in self.RE_URI_WHITE_LIST:
-                if re.match(re_path, path):
-                    return response
             self.save_log(request, response, **extra_params)
         except Exception:
             logger.exception(
@@ -78,6 +78,15 @@ class ProjectAuditLogMiddleware:
             )
         return response
 
+    @classmethod
+    def in_white_list(cls, path):
+        if path in cls.URI_WHITH_LIST:
+            return True
+        for re_path in cls.RE_URI_WHITE_LIST:
+            if re.match(re_path, path):
+                return True
+        return False
+
     @classmethod
     def save_log(cls, request, response, **kwargs):
         """持久化审计日志"""
@@ -126,3 +135,14 @@ class FastResponseMiddleware(MiddlewareMixin):
             return json_resp
 
         return None
+
+
+class UserLoaderMiddleware:
+    """为每个请求激活独立的用户信息加载器, 请求结束即释放"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with user_loader_scope():
+            return self.get_response(request)
@@ -26,7 +26,7 @@ from mongoengine import (BooleanField, DateTimeField, DictField, Document,
 from mongoengine.queryset import DoesNotExist
 
 from bombus.libs.enums import PriorityEnum, ProcessStatusEnum
-from bombus.services.user_service import UserService
+from bombus.services.user_loader import load_users_by_email
 from core.util.time_util import time2str
 
 logger = logging.getLogger(__name__)
@@ -132,6 +132,7 @@ class FeatureModel(BaseModel):
             'created_time',
         ]
     }
+    render_user_fields = ('submitter',)
 
     @property
     def status_render(self):
@@ -155,7 +156,7 @@ class FeatureModel(BaseModel):
     def submitter_render(self):
         if not self.submitter:
             return '-'
-        user_info = UserService.batch_get_user_by_email(self.submitter)
+        user_info = load_users_by_email(self.submitter)
         names = []
         for email in self.submitter:
             name = (user_info.get(email) or {}).get('name')
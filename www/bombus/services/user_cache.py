@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import logging
+import time
+
+from core.invalidation import invalidation_bus
+from core.lru import LRUCacheDict
+from core.redis_conn import get_prefixed_client
+
+logger = logging.getLogger(__name__)
+
+_missing = object()
+
+
+class UserDirectoryCache(object):
+    """
+    按单个用户缓存的两级缓存: 进程内LRU(L1) + 共享redis(L2);
+    查询不到的用户以空字典缓存, 避免重复查询.
+    L2的key带有代数(generation), 员工信息变更后递增代数, 旧代数的L2缓存不再被读取;
+    L1条目同样记录写入时的代数, 每generation_check_interval秒重新读取一次代数,
+    即使没有收到失效通知, 代数变化后L1旧条目也不再返回
+    """
+    redis_name = 'ums_cache_ca'
+    generation_check_interval = 5
+
+    def __init__(self, namespace, l1_size=20000, l1_expiration=5 * 60,
+                 l2_expiration=60 * 60, negative_expiration=10 * 60):
+        self.namespace = namespace
+        self.l1 = LRUCacheDict(max_size=l1_size, expiration=l1_expiration, concurrent=True)
+        self.l2_expiration = l2_expiration
+        self.negative_expiration = negative_expiration
+        self.generation = None
+        self.generation_checked_ts = 0
+
+    @property
+    def conn(self):
+        return get_prefixed_client(self.redis_name)
+
+    @property
+    def generation_key(self):
+        return f'user:{self.namespace}:generation'
+
+    def get_generation(self):
+        """本地缓存代数, 定期或收到失效通知后重新读取"""
+        now = time.time()
+        if self.generation is None or now - self.generation_checked_ts >= self.generation_check_interval:
+            try:
+                self.generation = self.conn.get(self.generation_key) or '0'
+            except Exception:
+                logger.exception(f'get {self.namespace} user cache generation fail')
+                self.generation = self.generation or '0'
+            self.generation_checked_ts = now
+        return self.generation
+
+    def build_key(self, key, generation=None):
+        return f'user:{self.namespace}:{generation or self.get_generation()}:{key}'
+
+    def bump_generation(self):
+        """员工信息变更后由写入方调用一次, 使全部L2缓存失效"""
+        self.conn.incr(self.generation_key)
+
+    def invalidate(self, namespace=None):
+        """收到失效通知时清空本进程L1, 并在下次访问时重新读取L2代数"""
+        self.l1.clear()
+        self.generation = None
+
+    def get_many(self, keys: list):
+        """
+        :return: (命中的{key: 用户信息}, 未命中的key列表)
+        """
+        # fork出的子进程首次使用时启动本进程的订阅线程
+        invalidation_bus.ensure_started()
+        result = {}
+        l1_misses = []
+        generation = self.get_generation()
+        for key in keys:
+            entry = self.l1.get(key, _missing)
+            if entry is _missing or entry[0] != generation:
+                l1_misses.append(key)
+            else:
+                result[key] = entry[1]
+        if not l1_misses:
+            return result, []
+
+        try:
+            values = self.conn.mget([self.build_key(key, generation) for key in l1_misses])
+        except Exception:
+            logger.exception(f'mget {self.namespace} user cache fail')
+            return result, l1_misses
+
+        misses = []
+        for key, value in zip(l1_misses, values):
+            if value is None:
+                misses.append(key)
+                continue
+            value = json.loads(value)
+            self.l1[key] = (generation, value)
+            result[key] = value
+        return result, misses
+
+    def set_many(self, mapping: dict):
+        if not mapping:
+            return
+        generation = self.get_generation()
+        for key, value in mapping.items():
+            self.l1[key] = (generation, value)
+        try:
+            pipe = self.conn.pipeline(transaction=False)
+            for key, value in mapping.items():
+                expiration = self.l2_expiration if value else self.negative_expiration
+                pipe.setex(self.build_key(key, generation), expiration, json.dumps(value, separators=(',', ':')))
+            pipe.execute()
+        except Exception:
+            logger.exception(f'set {self.namespace} user cache fail')
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+
+from core.invalidation import invalidation_bus
+from core.redis_conn import get_prefixed_client
+
+from .user_model import Employee
+
+logger = logging.getLogger(__name__)
+
+EMPLOYEE_NAMESPACE = 'model:Employee'
+
+
+class EmployeeSearchIndex(object):
+    """
+    员工姓名、邮箱前缀的子串索引: 单字及二元组(bigram)倒排表,
+    查询时取关键字各二元组倒排表的交集作为候选, 再校验子串并排序
+    排序: 完全匹配 > 前缀匹配 > 子串匹配, 同级按匹配文本长度、accountid
+    索引构建后不再修改, 查询结果按关键字缓存(单字等短关键字候选集较大)
+    """
+    cache_size = 2048
+
+    def __init__(self, users=()):
+        self.users = []
+        self.terms = []
+        self.postings = defaultdict(set)
+        self._cached_search = lru_cache(maxsize=self.cache_size)(self._search)
+        for user in users:
+            self.add(user)
+
+    @staticmethod
+    def grams(text):
+        if len(text) < 2:
+            return set(text)
+        return {text[i:i + 2] for i in range(len(text) - 1)}
+
+    def add(self, user):
+        idx = len(self.users)
+        terms = tuple(filter(None, {
+            str(user.get('name') or '').lower(),
+            EmployeeDirectory.email_prefix(user.get('email') or '').lower(),
+        }))
+        self.users.append(user)
+        self.terms.append(terms)
+        for term in terms:
+            for gram in set(term) | self.grams(term):
+                self.postings[gram].add(idx)
+
+    def candidates(self, keyword):
+        grams = sorted(self.grams(keyword), key=lambda g: len(self.postings.get(g, ())))
+        if not grams:
+            return set()
+        result = set(self.postings.get(grams[0], ()))
+        for gram in grams[1:]:
+            if not result:
+                break
+            result &= self.postings.get(gram, set())
+        return result
+
+    def search(self, keyword, limit=10) -> list:
+        keyword = str(keyword or '').strip().lower()
+        if not keyword:
+            return []
+        return list(self._cached_search(keyword, limit))
+
+    def _search(self, keyword, limit):
+        ranked = []
+        for idx in self.candidates(keyword):
+            rank = None
+            matched = ''
+            for term in self.terms[idx]:
+                if term == keyword:
+                    term_rank = 0
+                elif term.startswith(keyword):
+                    term_rank = 1
+                elif keyword in term:
+                    term_rank = 2
+                else:
+                    continue
+                if rank is None or (term_rank, len(term)) < (rank, len(matched)):
+                    rank, matched = term_rank, term
+            if rank is not None:
+                ranked.append((rank, len(matched), self.users[idx]['accountid'], idx))
+        ranked.sort()
+        return tuple(self.users[idx] for *_, idx in ranked[:limit])
+
+
+class EmployeeDirectory(object):
+    """
+    员工目录快照: 一次性加载employee_info及user_supplement_info到内存,
+    按accountid和邮箱前缀建立索引.
+    刷新: 每refresh_interval秒整体重建; 版本号(version_key)变化时在version_check_interval秒内重建.
+    版本号由 UserService.invalidate_users 递增, 调用方为: 岗位变更数据入库(每批次一次)、
+    员工信息同步任务完成后执行的 refresh_user_directory 命令、init_data
+    """
+    redis_name = 'ums_cache_ca'
+    version_key = 'user:directory_version'
+    supplement_collection = 'user_supplement_info'
+    refresh_interval = 10 * 60
+    version_check_interval = 30
+
+    def __init__(self):
+        self.by_accountid = {}
+        self.by_email = {}
+        self.staff_ids = frozenset()
+        self.search_index = EmployeeSearchIndex()
+        self.version = None
+        self.loaded_ts = 0
+        self.version_checked_ts = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def email_prefix(email):
+        return str(email).strip().replace(' ', '').replace(settings.EMAIL_SUFFIX, '')
+
+    @staticmethod
+    def build_supplement_user(item) -> dict:
+        """补充用户信息转为与员工信息相同的结构"""
+        return {
+            'id': item['accountid'],
+            'accountid': item['accountid'],
+            'name': item.get('name'),
+            'email': item.get('email'),
+            'dept_name': '',
+        }
+
+    @classmethod
+    def query_supplement_users(cls, field, values: list) -> list:
+        """
+        按accountid(field='ids')或邮箱前缀(field='emails')查询补充用户信息, 供非快照模式补全员工表中不存在的用户
+        """
+        if field == 'ids':
+            query = {'accountid': {'$in': values}}
+        else:
+            query = {'email': {'$in': values + [f'{v}{settings.EMAIL_SUFFIX}' for v in values]}}
+        projection = {'accountid': 1, 'name': 1, 'email': 1, '_id': 0}
+        cursor = Employee._get_db()[cls.supplement_collection].find(query, projection)
+        return [cls.build_supplement_user(item) for item in cursor]
+
+    @classmethod
+    def bump_version(cls):
+        """
+        员工信息同步后调用, 通知所有进程刷新快照
+        """
+        get_prefixed_client(cls.redis_name).incr(cls.version_key)
+        invalidation_bus.publish(EMPLOYEE_NAMESPACE)
+
+    def invalidate(self, namespace=None):
+        """收到失效通知后, 下次访问立即检查版本号"""
+        self.version_checked_ts = 0
+
+    def get_remote_version(self):
+        try:
+            return get_prefixed_client(self.redis_name).get(self.version_key)
+        except Exception:
+            logger.exception('get directory version fail')
+            return self.version
+
+    def need_refresh(self):
+        now = time.time()
+        if not self.loaded_ts or now - self.loaded_ts >= self.refresh_interval:
+            return True
+        if now - self.version_checked_ts >= self.version_check_interval:
+            self.version_checked_ts = now
+            return self.get_remote_version() != self.version
+        return False
+
+    def ensure_fresh(self):
+        invalidation_bus.ensure_started()
+        if not self.need_refresh():
+            return
+        # 其他线程刷新期间继续使用旧快照
+        if not self.lock.acquire(blocking=not self.loaded_ts):
+            return
+        try:
+            if self.need_refresh():
+                self.refresh()
+        finally:
+            self.lock.release()
+
+    def refresh(self):
+        version = self.get_remote_version()
+        by_accountid = {}
+        by_email = {}
+        staff_ids = set()
+        # 与原关键字搜索一致, 仅检索员工表
+        search_index = EmployeeSearchIndex()
+
+        projection = {'employee_id': 1, 'employee_name': 1, 'email': 1, 'dept_name': 1, 'status': 1, '_id': 0}
+        for item in Employee._get_collection().find({}, projection):
+            accountid = item['employee_id']
+            user = {
+                'id': accountid,
+                'accountid': accountid,
+                'name': item.get('employee_name'),
+                'email': item.get('email'),
+                'dept_name': item.get('dept_name'),
+            }
+            by_accountid[accountid] = user
+            by_email[self.email_prefix(user['email'])] = user
+            search_index.add(user)
+            # 与 Employee.staff_status_many 一致, 仅status为True视为在职
+            if item.get('status') is True:
+                staff_ids.add(accountid)
+
+        # 补充用户信息仅补全员工表中不存在的用户
+        projection = {'accountid': 1, 'name': 1, 'email': 1, '_id': 0}
+        for item in Employee._get_db()[self.supplement_collection].find({}, projection):
+            accountid = item['accountid']
+            if accountid in by_accountid:
+                continue
+            user = self.build_supplement_user(item)
+            by_accountid[accountid] = user
+            by_email.setdefault(self.email_prefix(user['email']), user)
+
+        self.by_accountid, self.by_email, self.staff_ids = by_accountid, by_email, frozenset(staff_ids)
+        self.search_index = search_index
+        self.version = version
+        self.loaded_ts = self.version_checked_ts = time.time()
+        logger.info(f'employee directory refreshed, {len(by_accountid)} users, version {version}')
+
+    def get_by_accountids(self, accountids: list) -> dict:
+        self.ensure_fresh()
+        by_accountid = self.by_accountid
+        return {accountid: by_accountid.get(accountid) or {} for accountid in accountids}
+
+    def get_by_emails(self, emails: list) -> dict:
+        self.ensure_fresh()
+        by_email = self.by_email
+        return {email: by_email.get(email) or {} for email in emails}
+
+    def is_staff_many(self, accountids: list) -> dict:
+        self.ensure_fresh()
+        staff_ids = self.staff_ids
+        return {accountid: accountid in staff_ids for accountid in accountids}
+
+    def search(self, keyword, limit=10) -> list:
+        self.ensure_fresh()
+        return self.search_index.search(keyword, limit=limit)
+
+
+employee_directory = EmployeeDirectory()
+invalidation_bus.register(EMPLOYEE_NAMESPACE, employee_directory.invalidate)
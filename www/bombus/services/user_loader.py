@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+请求级用户信息加载器
+
+列表页序列化时每一行的 *_render 都会单独查询用户信息, 查询次数随行数增长;
+UserLoader 在一次请求内维护 accountid/邮箱前缀 -> 用户信息 的映射,
+序列化前先收集整页需要的用户(prime), 统一批量查询(load), render 时直接读取.
+没有激活的加载器时(如脚本任务), 各 load_* 方法退化为原有的 UserService 查询.
+"""
+
+import re
+import threading
+from contextlib import contextmanager
+
+from .user_service import UserService
+
+_local = threading.local()
+
+USER_SPLIT_PATTERN = re.compile(r'[,;，；\s]+')
+
+
+class UserLoader(object):
+
+    def __init__(self):
+        self.by_accountid = {}
+        self.by_email = {}
+        self.pending_accountids = set()
+        self.pending_emails = set()
+        self.staff_status = {}
+
+    @classmethod
+    def split_users(cls, value) -> list:
+        """拆分字段值, 兼容列表及逗号、分号分隔的字符串"""
+        if not value:
+            return []
+        if isinstance(value, (list, tuple, set)):
+            users = []
+            for v in value:
+                users.extend(cls.split_users(v))
+            return users
+        return [u for u in USER_SPLIT_PATTERN.split(str(value)) if u]
+
+    def _add_accountid(self, accountid):
+        accountid = str(accountid).strip()
+        if accountid and accountid not in self.by_accountid:
+            self.pending_accountids.add(accountid)
+        return accountid
+
+    def _add_email(self, email):
+        email = UserService.get_email_prefix(email)
+        if email and email not in self.by_email:
+            self.pending_emails.add(email)
+        return email
+
+    def prime(self, values):
+        """登记待加载的用户, 纯数字视为accountid, 其余视为邮箱(前缀)"""
+        for user in self.split_users(values):
+            if user.isdigit():
+                self._add_accountid(user)
+            else:
+                self._add_email(user)
+
+    def _remember(self, info: dict):
+        """按id查到的用户同时登记邮箱映射, 反之亦然"""
+        if not info:
+            return
+        if info.get('accountid'):
+            self.by_accountid.setdefault(str(info['accountid']), info)
+        if info.get('email'):
+            self.by_email.setdefault(UserService.get_email_prefix(info['email']), info)
+
+    def load(self):
+        """批量查询全部待加载的用户, 查询失败的用户在本次请求内记为空"""
+        if self.pending_accountids:
+            accountids, self.pending_accountids = list(self.pending_accountids), set()
+            result = UserService.batch_get_user_by_accountid(accountids)
+            for accountid in accountids:
+                info = result.get(accountid) or {}
+                self.by_accountid[accountid] = info
+                self._remember(info)
+        self.pending_emails -= set(self.by_email)
+        if self.pending_emails:
+            emails, self.pending_emails = list(self.pending_emails), set()
+            result = UserService.batch_get_user_by_email(emails)
+            for email in emails:
+                info = result.get(email) or {}
+                self.by_email[email] = info
+                self._remember(info)
+
+    def load_staff_status(self):
+        """按需批量查询在职状态: 一次查询本次请求已登记的全部accountid"""
+        accountids = [_id for _id in self.by_accountid if _id not in self.staff_status]
+        if accountids:
+            self.staff_status.update(UserService.is_staff_many(accountids))
+
+    def get_by_accountid(self, accountid, status=None) -> dict:
+        """
+        status: True->仅在职; False->仅离职; None->全部, 与 UserService.get_user_by_accountid 一致
+        """
+        accountid = self._add_accountid(accountid)
+        self.load()
+        info = self.by_accountid.get(accountid) or {}
+        if info and status is not None:
+            self.load_staff_status()
+            if self.staff_status.get(accountid, False) != status:
+                return {}
+        return info
+
+    def get_by_email(self, email) -> dict:
+        email = self._add_email(email)
+        self.load()
+        return self.by_email.get(email) or {}
+
+    def get_many_by_accountid(self, accountids: list) -> dict:
+        accountids = [self._add_accountid(_id) for _id in accountids]
+        self.load()
+        return {_id: self.by_accountid.get(_id) or {} for _id in accountids if _id}
+
+    def get_many_by_email(self, emails: list) -> dict:
+        emails = [self._add_email(em) for em in emails]
+        self.load()
+        return {em: self.by_email.get(em) or {} for em in emails if em}
+
+
+def get_user_loader():
+    return getattr(_local, 'loader', None)
+
+
+@contextmanager
+def user_loader_scope():
+    """在当前线程(协程)内激活一个新的加载器, 退出时恢复"""
+    previous = get_user_loader()
+    _local.loader = UserLoader()
+    try:
+        yield _local.loader
+    finally:
+        _local.loader = previous
+
+
+def prime_users(instances):
+    """
+    预加载一批model实例需要渲染的用户, model通过 render_user_fields 声明存放用户的字段
+    """
+    loader = get_user_loader()
+    if loader is None:
+        return
+    for instance in instances:
+        for field in getattr(instance, 'render_user_fields', ()):
+            loader.prime(getattr(instance, field, None))
+    loader.load()
+
+
+def load_user_by_accountid(accountid, status=None) -> dict:
+    """status: True->仅在职; False->仅离职; None->全部"""
+    loader = get_user_loader()
+    if loader is not None:
+        return loader.get_by_accountid(accountid, status=status)
+    return UserService.get_user_by_accountid(accountid, status=status)
+
+
+def load_user_by_email(email) -> dict:
+    loader = get_user_loader()
+    if loader is not None:
+        return loader.get_by_email(email)
+    return UserService.get_user_by_email(email)
+
+
+def load_users_by_accountid(accountids: list) -> dict:
+    loader = get_user_loader()
+    if loader is not None:
+        return loader.get_many_by_accountid(accountids)
+    return UserService.batch_get_user_by_accountid(accountids)
+
+
+def load_users_by_email(emails: list) -> dict:
+    loader = get_user_loader()
+    if loader is not None:
+        return loader.get_many_by_email(emails)
+    return UserService.batch_get_user_by_email(emails)
+
+
+def load_user_name(email) -> str:
+    if not email:
+        return ''
+    try:
+        return load_user_by_email(email).get('name') or ''
+    except Exception:
+        return ''
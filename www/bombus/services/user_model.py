@@ -66,7 +66,7 @@ class Employee(Document):
             queryset = cls.objects.filter(email__in=email_list)
         if status is not None:
             queryset = queryset.filter(status=status)
-        for item in queryset.limit(10):
+        for item in queryset:
             result.append(item.to_dict())
         return result
 
@@ -93,11 +93,26 @@ class Employee(Document):
             is_staff = False
         return {'is_staff': is_staff}
 
+    @classmethod
+    def staff_status_many(cls, ids: str = '') -> dict:
+        """
+        批量查询在职状态
+        params ids: 英文逗号分割的用户id
+        """
+        id_list = list(filter(None, [x.strip() for x in ids.split(',')]))
+        if not id_list:
+            return {}
+        staff_ids = set(cls.objects.filter(
+            employee_id__in=id_list, status=True
+        ).values_list('employee_id'))
+        return {_id: _id in staff_ids for _id in id_list}
+
     @classmethod
     def _query(cls, method, params):
         method_map = {
             'search-by-accountids': cls.get_users,
             'is-staff': cls.staff_status,
+            'is-staff-many': cls.staff_status_many,
             'search-user': cls.search_user
         }
         func = method_map.get(method)
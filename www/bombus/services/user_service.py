@@ -17,21 +17,31 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
 
+import logging
+
 from django.conf import settings
 
-from core.lru import lru_cache_function
+from core.invalidation import invalidated_lru_cache, invalidation_bus
 from core.utils import split_large_collection
 
+from .user_cache import UserDirectoryCache
+from .user_directory import EMPLOYEE_NAMESPACE, employee_directory
 from .user_model import Employee
 
+logger = logging.getLogger(__name__)
+
 
 class UserService(object):
 
     EMAIL_SUFFIX = settings.EMAIL_SUFFIX
     BATCH_SIZE = 10
+    STAFF_BATCH_SIZE = 500
+
+    accountid_cache = UserDirectoryCache('accountid')
+    email_cache = UserDirectoryCache('email')
 
     @classmethod
-    @lru_cache_function(max_size=5000)
+    @invalidated_lru_cache([EMPLOYEE_NAMESPACE], max_size=5000)
     def _query(cls, method, params):
         try:
             result = Employee._query(method, params)
@@ -60,6 +70,43 @@ class UserService(object):
     def query_accountid(cls, accountid):
         return cls.get_user_by_accountid(accountid, status=True)
 
+    @staticmethod
+    def use_directory_snapshot():
+        return getattr(settings, 'UMS_DIRECTORY_MODE', 'query') == 'snapshot'
+
+    @classmethod
+    def _fetch_users(cls, field, values: list, key_func) -> dict:
+        """
+        分批查询用户, 查询不到的用户值为空字典; 查询异常时不返回该批次, 避免缓存错误结果;
+        员工表中不存在的用户与快照模式一致, 由补充用户信息补全
+        """
+        result = {}
+        for chunk in split_large_collection(values, cls.BATCH_SIZE):
+            try:
+                resp = Employee._query('search-by-accountids', {field: ','.join(chunk)})
+            except Exception:
+                logger.exception(f'query users by {field} fail')
+                continue
+            for value in chunk:
+                result[value] = {}
+            for r in resp:
+                result[key_func(r)] = r
+
+        missing = [value for value, info in result.items() if not info]
+        for chunk in split_large_collection(missing, cls.STAFF_BATCH_SIZE):
+            try:
+                resp = employee_directory.query_supplement_users(field, chunk)
+            except Exception:
+                logger.exception(f'query supplement users by {field} fail')
+                for value in chunk:
+                    result.pop(value, None)
+                continue
+            for r in resp:
+                key = key_func(r)
+                if key in result and not result[key]:
+                    result[key] = r
+        return result
+
     @classmethod
     def batch_get_user_by_accountid(cls, accountids: list) -> dict:
         result = {}
@@ -68,14 +115,18 @@ class UserService(object):
             return result
 
         accountids.sort()
+        if cls.use_directory_snapshot():
+            return employee_directory.get_by_accountids(accountids)
+
         for mid in accountids:
             result[mid] = {}
 
-        for ids in split_large_collection(accountids, cls.BATCH_SIZE):
-            ids_str = ','.join(ids)
-            resp = cls.query_service('search-by-accountids', {'ids': ids_str})
-            for r in resp:
-                result[r['accountid']] = r
+        cached, misses = cls.accountid_cache.get_many(accountids)
+        result.update(cached)
+        if misses:
+            fetched = cls._fetch_users('ids', misses, lambda r: r['accountid'])
+            cls.accountid_cache.set_many(fetched)
+            result.update(fetched)
         return result
 
     @classmethod
@@ -86,14 +137,18 @@ class UserService(object):
             return result
 
         emails.sort()
+        if cls.use_directory_snapshot():
+            return employee_directory.get_by_emails(emails)
+
         for em in emails:
             result[em] = {}
-        for ems in split_large_collection(emails, cls.BATCH_SIZE):
-            ems_str = ','.join(ems)
-            resp = cls.query_service('search-by-accountids', {'emails': ems_str})
-            for r in resp:
-                email = cls.get_email_prefix(r['email'])
-                result[email] = r
+
+        cached, misses = cls.email_cache.get_many(emails)
+        result.update(cached)
+        if misses:
+            fetched = cls._fetch_users('emails', misses, lambda r: cls.get_email_prefix(r['email']))
+            cls.email_cache.set_many(fetched)
+            result.update(fetched)
         return result
 
     @classmethod
@@ -121,10 +176,18 @@ class UserService(object):
         result = cls.batch_get_user_by_email([email])
         return result.get(email) or {}
 
+    @staticmethod
+    def use_search_index():
+        """需显式开启, 与数据库模糊查询的差异见 settings.UMS_SEARCH_MODE"""
+        return getattr(settings, 'UMS_SEARCH_MODE', 'query') == 'index'
+
     @classmethod
     def search_user(cls, email):
         """关键字查询用户"""
         name = cls.get_email_prefix(email)
+        if cls.use_search_index():
+            # 结果为快照内的共享对象, 返回副本供调用方修改
+            return [dict(user) for user in employee_directory.search(name)]
         result = cls.query_service('search-user', {'keyword': name})
         return result['users']
 
@@ -148,6 +211,43 @@ class UserService(object):
         result = cls.query_service('is-staff', {'id': str(accountid)})
         return bool(result and result.get('is_staff'))
 
+    @classmethod
+    def is_staff_many(cls, accountids: list, default=False) -> dict:
+        """
+        批量查询是否为内部员工, 查询异常的批次取 default
+        """
+        result = {}
+        accountids = sorted(set(filter(None, map(str, accountids))))
+        if cls.use_directory_snapshot():
+            try:
+                return employee_directory.is_staff_many(accountids)
+            except Exception:
+                logger.exception('query staff status from directory fail')
+                return dict.fromkeys(accountids, default)
+        for chunk in split_large_collection(accountids, cls.STAFF_BATCH_SIZE):
+            try:
+                result.update(Employee._query('is-staff-many', {'ids': ','.join(chunk)}))
+            except Exception:
+                logger.exception('query staff status fail')
+                result.update(dict.fromkeys(chunk, default))
+        return result
+
+    @classmethod
+    def invalidate_users(cls):
+        """
+        员工信息同步或变更后调用: 递增L2缓存代数, 并通知所有进程清空本地缓存、刷新员工目录快照
+        """
+        for cache in (cls.accountid_cache, cls.email_cache):
+            try:
+                cache.bump_generation()
+            except Exception:
+                logger.exception(f'bump {cache.namespace} user cache generation fail')
+        employee_directory.bump_version()
+
+
+invalidation_bus.register(EMPLOYEE_NAMESPACE, UserService.accountid_cache.invalidate)
+invalidation_bus.register(EMPLOYEE_NAMESPACE, UserService.email_cache.invalidate)
+
 
 if __name__ == '__main__':
     principal = UserService.get_user_by_accountid('123')
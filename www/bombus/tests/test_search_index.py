@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+EmployeeSearchIndex 与 Employee.search_user 数据库模糊查询的结果比对
+"""
+
+import unittest
+
+from django.conf import settings
+
+from bombus.services.user_directory import EmployeeSearchIndex
+
+
+def build_user(accountid, name, email_prefix):
+    return {
+        'id': accountid,
+        'accountid': accountid,
+        'name': name,
+        'email': f'{email_prefix}{settings.EMAIL_SUFFIX}',
+        'dept_name': '',
+    }
+
+
+USERS = [
+    build_user('1001', '张三', 'zhangsan'),
+    build_user('1002', '张三丰', 'zhangsanfeng'),
+    build_user('1003', '李四', 'lisi'),
+    build_user('1004', '王小明', 'xiaoming.wang'),
+    build_user('1005', '小明', 'xm'),
+    build_user('1006', 'Alice Zhang', 'alice'),
+    build_user('1007', '欧阳娜娜', 'ouyang_nana'),
+    build_user('1008', '张', 'zhang'),
+]
+
+
+def orm_search(users, keyword):
+    """与 Employee.search_user 相同: employee_name__contains 或 email__contains"""
+    return {u['accountid'] for u in users if keyword in u['name'] or keyword in u['email']}
+
+
+class EmployeeSearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = EmployeeSearchIndex(USERS)
+
+    def search(self, keyword, limit=100):
+        return [u['accountid'] for u in self.index.search(keyword, limit=limit)]
+
+    def test_same_as_orm_query(self):
+        # 小写关键字且不涉及邮箱域名时, 结果集合与数据库模糊查询一致
+        keywords = ['张', '张三', '三丰', '丰', '小明', '王小', '欧阳', '娜娜', '阳娜',
+                    'zhangsan', 'san', 'sanfeng', 'lisi', 'is', 'xiao', 'ming.w', '.wang', 'ouyang_',
+                    'xm', 'alice', 'nana', '不存在', 'zz']
+        for keyword in keywords:
+            with self.subTest(keyword=keyword):
+                self.assertEqual(set(self.search(keyword)), orm_search(USERS, keyword))
+
+    def test_rank(self):
+        # 完全匹配 > 前缀匹配 > 子串匹配, 同级按匹配文本长度、accountid
+        self.assertEqual(self.search('张三'), ['1001', '1002'])
+        self.assertEqual(self.search('张'), ['1008', '1001', '1002'])
+        self.assertEqual(self.search('小明'), ['1005', '1004'])
+        self.assertEqual(self.search('zhang'), ['1008', '1001', '1002', '1006'])
+
+    def test_limit(self):
+        self.assertEqual(self.search('zhang', limit=2), ['1008', '1001'])
+
+    def test_case_insensitive(self):
+        # 与数据库查询的差异: 不区分大小写
+        self.assertEqual(set(self.search('ALICE')), {'1006'})
+        self.assertEqual(orm_search(USERS, 'ALICE'), set())
+        self.assertEqual(set(self.search('zhang')), {'1001', '1002', '1006', '1008'})
+        self.assertEqual(orm_search(USERS, 'zhang'), {'1001', '1002', '1008'})
+
+    def test_email_domain_not_indexed(self):
+        # 与数据库查询的差异: 邮箱只索引前缀, 域名部分不参与匹配
+        domain = settings.EMAIL_SUFFIX.lstrip('@')
+        self.assertEqual(self.search(domain), [])
+        self.assertEqual(orm_search(USERS, domain), {u['accountid'] for u in USERS})
+
+    def test_blank_keyword(self):
+        self.assertEqual(self.search(''), [])
+        self.assertEqual(self.search('   '), [])
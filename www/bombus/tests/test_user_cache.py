@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+UserDirectoryCache 两级缓存的命中、未命中及代数失效
+"""
+
+import unittest
+from unittest import mock
+
+from bombus.services.user_cache import UserDirectoryCache
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.data = {}
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append('get')
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self.commands.append('mget')
+        return [self.data.get(key) for key in keys]
+
+    def setex(self, key, expire, value):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key) or 0) + 1)
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+
+class UserDirectoryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeRedis()
+        self.now = 1000.0
+        for target, value in (('bombus.services.user_cache.get_prefixed_client', lambda name: self.conn),
+                              ('bombus.services.user_cache.time.time', lambda: self.now),
+                              ('bombus.services.user_cache.invalidation_bus.ensure_started', lambda: None)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.cache = self.build_cache()
+
+    @staticmethod
+    def build_cache():
+        return UserDirectoryCache('accountid')
+
+    def test_miss_then_hit(self):
+        self.assertEqual(self.cache.get_many(['1', '2']), ({}, ['1', '2']))
+        self.cache.set_many({'1': {'name': 'a'}, '2': {}})
+        self.conn.commands.clear()
+        # L1命中, 不访问redis
+        self.assertEqual(self.cache.get_many(['1', '2']), ({'1': {'name': 'a'}, '2': {}}, []))
+        self.assertEqual(self.conn.commands, [])
+
+    def test_l2_shared_across_processes(self):
+        self.cache.set_many({'1': {'name': 'a'}})
+        other = self.build_cache()
+        self.assertEqual(other.get_many(['1', '3']), ({'1': {'name': 'a'}}, ['3']))
+        self.conn.commands.clear()
+        # 从L2读到的值写入L1
+        self.assertEqual(other.get_many(['1']), ({'1': {'name': 'a'}}, []))
+        self.assertEqual(self.conn.commands, [])
+
+    def test_bump_generation_without_notification(self):
+        self.cache.set_many({'1': {'name': 'a'}})
+        other = self.build_cache()
+        other.bump_generation()
+        # 检查间隔内仍使用本地代数
+        self.assertEqual(self.cache.get_many(['1']), ({'1': {'name': 'a'}}, []))
+        # 超过检查间隔后重新读取代数, L1及L2的旧条目均不再返回
+        self.now += UserDirectoryCache.generation_check_interval
+        self.assertEqual(self.cache.get_many(['1']), ({}, ['1']))
+        self.cache.set_many({'1': {'name': 'b'}})
+        self.assertEqual(self.build_cache().get_many(['1']), ({'1': {'name': 'b'}}, []))
+
+    def test_invalidate(self):
+        self.cache.set_many({'1': {'name': 'a'}})
+        self.cache.bump_generation()
+        self.cache.invalidate('model:Employee')
+        self.assertEqual(self.cache.get_many(['1']), ({}, ['1']))
+
+    def test_redis_unavailable(self):
+        self.cache.set_many({'1': {'name': 'a'}})
+        self.conn.mget = mock.Mock(side_effect=ConnectionError)
+        self.assertEqual(self.cache.get_many(['1', '2']), ({'1': {'name': 'a'}}, ['2']))
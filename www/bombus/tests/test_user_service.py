@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+按需查询(query)与员工目录快照(snapshot)两种模式返回相同的用户信息
+"""
+
+import unittest
+from unittest import mock
+
+from bombus.services.user_directory import EmployeeDirectory
+from bombus.services.user_model import Employee
+from bombus.services.user_service import UserService
+
+EMPLOYEES = [
+    {'employee_id': '1001', 'employee_name': '张三', 'email': 'zhangsan', 'dept_name': '安全部', 'status': True},
+    {'employee_id': '1002', 'employee_name': '李四', 'email': 'lisi', 'dept_name': '运维部', 'status': False},
+]
+SUPPLEMENTS = [
+    {'accountid': '2001', 'name': '外包王五', 'email': 'wangwu'},
+    # 员工表中已存在的用户以员工表为准
+    {'accountid': '1001', 'name': '张三(补充)', 'email': 'zhangsan2'},
+]
+
+
+class FakeCollection(object):
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection):
+        for doc in self.docs:
+            if all(doc.get(k) in v['$in'] for k, v in query.items()):
+                yield {k: doc[k] for k in projection if projection[k] and k in doc}
+
+
+def fake_employee_query(method, params):
+    """与 Employee.get_users 相同, 按accountid查询员工表"""
+    ids = params['ids'].split(',')
+    return [{
+        'id': e['employee_id'],
+        'accountid': e['employee_id'],
+        'name': e['employee_name'],
+        'email': e['email'],
+        'dept_name': e['dept_name'],
+    } for e in EMPLOYEES if e['employee_id'] in ids]
+
+
+class UserDirectoryModeTest(unittest.TestCase):
+
+    def setUp(self):
+        collections = {EmployeeDirectory.supplement_collection: FakeCollection(SUPPLEMENTS)}
+        for name, value in (('_query', fake_employee_query),
+                            ('_get_collection', lambda: FakeCollection(EMPLOYEES)),
+                            ('_get_db', lambda: collections)):
+            patcher = mock.patch.object(Employee, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def query_mode(self, accountids):
+        return UserService._fetch_users('ids', accountids, lambda r: r['accountid'])
+
+    def snapshot_mode(self, accountids):
+        directory = EmployeeDirectory()
+        with mock.patch.object(directory, 'get_remote_version', return_value='1'):
+            directory.refresh()
+        return {_id: directory.by_accountid.get(_id) or {} for _id in accountids}
+
+    def test_same_users(self):
+        accountids = ['1001', '1002', '2001', '9999']
+        result = self.query_mode(accountids)
+        self.assertEqual(result, self.snapshot_mode(accountids))
+        self.assertEqual(result['1001']['name'], '张三')
+        self.assertEqual(result['2001']['name'], '外包王五')
+        self.assertEqual(result['9999'], {})
+
+    def test_supplement_query_fail(self):
+        # 补充信息查询失败时不返回未补全的用户, 避免缓存错误的空结果
+        with mock.patch.object(EmployeeDirectory, 'query_supplement_users', side_effect=ConnectionError):
+            result = self.query_mode(['1001', '2001'])
+        self.assertEqual(set(result), {'1001'})
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+跨进程本地缓存失效通知
+
+写入方publish命名空间(与CacheVersion相同, 如 model:AuditSysModel), 各进程的后台线程订阅频道,
+调用本进程为该命名空间注册的失效回调; 断线重连后可能丢失通知, 重新订阅时清空全部已注册的本地缓存
+"""
+
+import functools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from core.lru import lru_cache_function
+from core.redis_conn import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidationBus(object):
+    channel = 'bombus:cache_invalidation'
+    reconnect_interval = 1
+    poll_timeout = 1.0
+
+    def __init__(self, redis_name):
+        self.redis_name = redis_name
+        self.handlers = defaultdict(list)
+        # 各命名空间的失效次数, 及断线重连(可能丢失通知)的次数, 供按实例缓存的属性比对
+        self.generations = defaultdict(int)
+        self.resets = 0
+        self.lock = threading.Lock()
+        self.pid = None
+        self.thread = None
+
+    @property
+    def conn(self):
+        return get_redis_client(self.redis_name)
+
+    @staticmethod
+    def get_sender():
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def register(self, namespace, callback):
+        """
+        callback(namespace): 命名空间失效时调用; 同时启动订阅线程,
+        fork出的子进程需在使用缓存前再调用 ensure_started
+        """
+        with self.lock:
+            self.handlers[namespace].append(callback)
+        self.ensure_started()
+
+    def get_tag(self, namespaces) -> tuple:
+        return (self.resets,) + tuple(self.generations[namespace] for namespace in namespaces)
+
+    def publish(self, *namespaces):
+        namespaces = sorted(set(filter(None, namespaces)))
+        if not namespaces:
+            return
+        # 本进程立即失效, 其他进程通过订阅失效
+        self.dispatch(namespaces)
+        message = json.dumps({'sender': self.get_sender(), 'namespaces': namespaces})
+        try:
+            self.conn.publish(self.channel, message)
+        except Exception:
+            logger.exception(f'publish invalidation of {namespaces} fail')
+
+    def dispatch(self, namespaces):
+        for namespace in namespaces:
+            self.generations[namespace] += 1
+            for callback in list(self.handlers.get(namespace, ())):
+                try:
+                    callback(namespace)
+                except Exception:
+                    logger.exception(f'invalidate {namespace} fail')
+
+    def handle_message(self, data):
+        try:
+            message = json.loads(data)
+        except Exception:
+            logger.exception(f'invalid invalidation message |:{data}:|')
+            return
+        if message.get('sender') == self.get_sender():
+            return
+        self.dispatch(message.get('namespaces') or [])
+
+    def ensure_started(self):
+        """
+        启动订阅线程; 按pid判断, fork出的子进程首次调用时重新启动
+        """
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.lock:
+            if self.pid == pid:
+                return
+            self.thread = threading.Thread(target=self.run, name='cache-invalidation', daemon=True)
+            self.thread.start()
+            self.pid = pid
+
+    def run(self):
+        subscribed_before = False
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                if subscribed_before:
+                    self.resets += 1
+                    self.dispatch(list(self.handlers))
+                subscribed_before = True
+                while True:
+                    message = pubsub.get_message(timeout=self.poll_timeout)
+                    if message and message['type'] == 'message':
+                        self.handle_message(message['data'])
+            except Exception:
+                logger.exception('cache invalidation subscriber fail, reconnecting')
+                time.sleep(self.reconnect_interval)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+
+invalidation_bus = InvalidationBus('task_has_log')
+
+
+def invalidated_lru_cache(namespaces, max_size=1024, expiration=15 * 60, bus=invalidation_bus):
+    """
+    进程内LRU缓存, 任一命名空间失效时清空
+    """
+    def wrapper(func):
+        cached = lru_cache_function(max_size=max_size, expiration=expiration, concurrent=True)(func)
+        for namespace in namespaces:
+            bus.register(namespace, lambda _: cached.cache.clear())
+
+        @functools.wraps(func)
+        def wrapped_func(*args, **kwargs):
+            bus.ensure_started()
+            return cached(*args, **kwargs)
+
+        wrapped_func.cache = cached.cache
+        return wrapped_func
+
+    return wrapper
+
+
+class invalidated_cached_property(object):
+    """
+    同 cached_property 按实例缓存属性值, 任一命名空间失效后下次访问重新计算;
+    用于在进程内长期存活的对象(如整晚复用的规则handler)
+    """
+
+    def __init__(self, namespaces, bus=invalidation_bus):
+        self.namespaces = tuple(namespaces)
+        self.bus = bus
+        self.func = None
+        self.name = None
+
+    def __call__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+        return self
+
+    def __set_name__(self, owner, name):
+        # 不能与属性同名, 否则实例字典会遮蔽描述符
+        self.name = f'_{name}_invalidated_cache'
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        self.bus.ensure_started()
+        tag = self.bus.get_tag(self.namespaces)
+        cached = instance.__dict__.get(self.name)
+        if cached is not None and cached[0] == tag:
+            return cached[1]
+        value = self.func(instance)
+        instance.__dict__[self.name] = (tag, value)
+        return value
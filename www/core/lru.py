@@ -17,11 +17,13 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
 
+import threading
 import time
 from collections import OrderedDict
+from contextlib import nullcontext
 
 
-def lru_cache_function(max_size=1024, expiration=15 * 60):
+def lru_cache_function(max_size=1024, expiration=15 * 60, concurrent=False):
     """
     >>> @lru_cache_function(3, 1)
     ... def f(x):
@@ -35,7 +37,7 @@ def lru_cache_function(max_size=1024, expiration=15 * 60):
     """
 
     def wrapper(func):
-        return LRUCachedFunction(func, LRUCacheDict(max_size, expiration))
+        return LRUCachedFunction(func, LRUCacheDict(max_size, expiration, concurrent=concurrent))
 
     return wrapper
 
@@ -47,8 +49,12 @@ class LRUCacheDict(object):
     >>> d['foo'] = 'bar'
     >>> d['foo']
     'bar'
+    >>> 'foo' in d
+    True
     >>> import time
     >>> time.sleep(4) # 4 seconds > 3 second cache expiry of d
+    >>> 'foo' in d
+    False
     >>> d['foo']
     Traceback (most recent call last):
         ...
@@ -61,27 +67,45 @@ class LRUCacheDict(object):
     Traceback (most recent call last):
         ...
     KeyError: 'a'
+    >>> d.stats()['evictions']
+    1
 
-    By default, this cache will only expire items whenever you poke it - all methods on
-    this class will result in a cleanup. If the thread_clear option is specified, a background
-    thread will clean it up every thread_clear_min_check seconds.
+    Get and set are O(1) amortized: values are kept in LRU order, expire times in insertion
+    order. Since every item lives for the same expiration, the front of the expire order is
+    always the next item to expire, so expired items are dropped lazily from the front
+    whenever an item is set, and checked individually when read.
 
     If this class must be used in a multithreaded environment, the option concurrent should be
-    set to true. Note that the cache will always be concurrent if a background cleanup thread
-    is used.
+    set to true.
     """
 
-    def __init__(self, max_size=1024, expiration=15 * 60):
+    def __init__(self, max_size=1024, expiration=15 * 60, concurrent=False):
         self.max_size = max_size
         self.expiration = expiration
 
-        self.__values = {}
+        self.__values = OrderedDict()
         self.__expire_times = OrderedDict()
-        self.__access_times = OrderedDict()
+        self.__lock = threading.RLock() if concurrent else nullcontext()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
     def size(self):
         return len(self.__values)
 
+    __len__ = size
+
+    def stats(self):
+        return {
+            'size': len(self.__values),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
     def clear(self):
         """
         Clears the dict.
@@ -96,12 +120,13 @@ class LRUCacheDict(object):
         ...
         KeyError: 'foo'
         """
-        self.__values.clear()
-        self.__expire_times.clear()
-        self.__access_times.clear()
+        with self.__lock:
+            self.__values.clear()
+            self.__expire_times.clear()
 
     def __contains__(self, key):
-        return key in self
+        with self.__lock:
+            return self.__is_alive(key, time.time())
 
     def has_key(self, key):
         """
@@ -122,54 +147,104 @@ class LRUCacheDict(object):
         ...
         KeyError: 'foo'
         """
-        return key in self.__values
+        return key in self
+
+    def __is_alive(self, key, now):
+        expire_time = self.__expire_times.get(key)
+        if expire_time is None:
+            return key in self.__values
+        return expire_time >= now
 
     def __setitem__(self, key, value):
-        t = int(time.time())
-        self.__delete__(key)
-        self.__values[key] = value
-        self.__access_times[key] = t
-        self.__expire_times[key] = t + self.expiration
-        self.cleanup()
+        now = time.time()
+        with self.__lock:
+            self.__values[key] = value
+            self.__values.move_to_end(key)
+            if self.expiration is not None:
+                self.__expire_times[key] = now + self.expiration
+                self.__expire_times.move_to_end(key)
+            self.__cleanup(now)
 
     def __getitem__(self, key):
-        del self.__access_times[key]
-        self.__access_times[key] = int(time.time())
-        self.cleanup()
-        return self.__values[key]
+        now = time.time()
+        with self.__lock:
+            try:
+                value = self.__values[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            expire_time = self.__expire_times.get(key)
+            if expire_time is not None and expire_time < now:
+                self.__delete__(key)
+                self.expirations += 1
+                self.misses += 1
+                raise KeyError(key)
+            self.__values.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
     def __delete__(self, key):
-        if key in self.__values:
-            del self.__values[key]
-            del self.__expire_times[key]
-            del self.__access_times[key]
+        self.__values.pop(key, None)
+        self.__expire_times.pop(key, None)
+
+    def __delitem__(self, key):
+        with self.__lock:
+            if key not in self.__values:
+                raise KeyError(key)
+            self.__delete__(key)
 
     def cleanup(self):
-        if self.expiration is None:
-            return None
-
-        key_need_deleted = []
-        for k, expire_time in self.__expire_times.items():
-            if expire_time < int(time.time()):
-                key_need_deleted.append(k)
-            else:
+        with self.__lock:
+            self.__cleanup(time.time())
+
+    def __cleanup(self, now):
+        # expire times are in insertion order, stop at the first alive item
+        expire_times = self.__expire_times
+        while expire_times:
+            key, expire_time = next(iter(expire_times.items()))
+            if expire_time >= now:
                 break
-
-        for key in key_need_deleted:
             self.__delete__(key)
+            self.expirations += 1
 
-        # If we have more than self.max_size items, delete the oldest
-        key_need_deleted = []
-        delete_size = len(self.__values) - self.max_size
-        for k in self.__access_times:
-            if delete_size > 0:
-                key_need_deleted.append(k)
-                delete_size -= 1
-            else:
-                break
+        # If we have more than self.max_size items, delete the least recently used
+        while len(self.__values) > self.max_size:
+            key, _ = self.__values.popitem(last=False)
+            self.__expire_times.pop(key, None)
+            self.evictions += 1
 
-        for key in key_need_deleted:
-            self.__delete__(key)
+
+_kwd_mark = object()
+_scalar_types = frozenset({str, int, float, bool, type(None), type})
+
+
+def make_key(args, kwargs):
+    """
+    Builds a cache key from call arguments without serializing them: scalars are kept
+    as is and flat dicts become tuples of their items. The key may still be unhashable
+    (e.g. a list argument), callers should fall back to repr_key on TypeError.
+
+    >>> make_key((int, 'search', {'ids': '1,2'}), {})
+    (<class 'int'>, 'search', (<class 'dict'>, ('ids', '1,2')))
+    """
+    if kwargs:
+        args += (_kwd_mark,) + tuple(kwargs.items())
+    key = []
+    for arg in args:
+        if type(arg) is dict:
+            arg = (dict,) + tuple(arg.items())
+        key.append(arg)
+    return tuple(key)
+
+
+def repr_key(args, kwargs):
+    return repr((args, kwargs))
 
 
 class LRUCachedFunction(object):
@@ -204,11 +279,21 @@ class LRUCachedFunction(object):
     >>> f(4) #No longer in cache - 4 is the least recently used, and there are at least 3 others items in cache [3,4,5,6].
     Calling f(4)
     4
+    >>> f({'a': 1})
+    Calling f({'a': 1})
+    {'a': 1}
+    >>> f({'a': 1})
+    {'a': 1}
+    >>> f([4])
+    Calling f([4])
+    [4]
+    >>> f([4])
+    [4]
 
     """
 
     def __init__(self, function, cache=None):
-        if cache:
+        if cache is not None:
             self.cache = cache
         else:
             self.cache = LRUCacheDict()
@@ -216,13 +301,20 @@ class LRUCachedFunction(object):
         self.__name__ = self.function.__name__
 
     def __call__(self, *args, **kwargs):
-        key = repr((args, kwargs)) + "#" + self.__name__  # In principle a python repr(...) should not return any # characters.
+        key = make_key(args, kwargs)
         try:
             return self.cache[key]
         except KeyError:
-            value = self.function(*args, **kwargs)
-            self.cache[key] = value
-            return value
+            pass
+        except TypeError:
+            key = repr_key(args, kwargs)
+            try:
+                return self.cache[key]
+            except KeyError:
+                pass
+        value = self.function(*args, **kwargs)
+        self.cache[key] = value
+        return value
 
 
 if __name__ == "__main__":
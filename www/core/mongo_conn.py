@@ -20,7 +20,7 @@
 from collections import defaultdict
 
 from django.conf import settings
-from mongoengine import connect
+from mongoengine import connect, disconnect
 
 NODE = 'ca'
 
@@ -29,7 +29,22 @@ NODE = 'ca'
 #####################
 
 mongo_cnfs = settings.MONGODB_CONF
-for node, cnf in settings.MONGODB_CONF.items():
-    db_name = cnf['default_db']
-    cnf_detail = cnf['conf']
-    connect(db=db_name, **cnf_detail)
+
+
+def connect_all():
+    for node, cnf in settings.MONGODB_CONF.items():
+        db_name = cnf['default_db']
+        cnf_detail = cnf['conf']
+        connect(db=db_name, **cnf_detail)
+
+
+def reconnect_all():
+    """
+    fork后子进程不能复用父进程的MongoClient, 需断开重连
+    """
+    for node, cnf in settings.MONGODB_CONF.items():
+        disconnect(alias=cnf['conf'].get('alias', 'default'))
+    connect_all()
+
+
+connect_all()
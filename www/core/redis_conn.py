@@ -19,69 +19,262 @@
 
 import redis
 from django.conf import settings
+from redis.client import Pipeline
+
+from core.util.cache_util import CacheVersion
 
 ##############
 # REDIS POOL #
 ##############
 
 conn_pool = {}
+# 不解码返回值的连接, 用于存取pickle等二进制数据
+binary_conn_pool = {}
+
+
+def _build_conn_conf(name, **extra):
+    conf = dict(settings.REDIS_CONF[name])
+    conf.update(settings.REDIS_CONN_DEFAULT_CONF)
+    conf.update(extra)
+    return conf
 
 
 def get_conn_pool():
     if not conn_pool:
-        for k, v in settings.REDIS_CONF.items():
-            v.update(settings.REDIS_CONN_DEFAULT_CONF.copy())
-            conn_pool[k] = redis.StrictRedis(**v)
+        for k in settings.REDIS_CONF:
+            conn_pool[k] = redis.StrictRedis(**_build_conn_conf(k))
     return conn_pool
 
 
+def get_binary_conn_pool():
+    if not binary_conn_pool:
+        for k in settings.REDIS_CONF:
+            binary_conn_pool[k] = redis.StrictRedis(**_build_conn_conf(k, decode_responses=False))
+    return binary_conn_pool
+
+
 def get_redis_client(name) -> redis.StrictRedis:
     return get_conn_pool()[name]
 
 
-class _RedisProxy:
-    """redis proxy add prefix automatically."""
+##################
+# PREFIXED REDIS #
+##################
+
+def _prefix_first(args, add):
+    return (args[0], add(args[1])) + args[2:]
+
+
+def _prefix_all(args, add):
+    return (args[0],) + tuple(map(add, args[1:]))
+
+
+def _prefix_all_but_last(args, add):
+    return (args[0],) + tuple(map(add, args[1:-1])) + args[-1:]
+
+
+def _prefix_first_two(args, add):
+    return (args[0], add(args[1]), add(args[2])) + args[3:]
+
+
+def _prefix_pairs(args, add):
+    return (args[0],) + tuple(add(v) if i % 2 == 0 else v for i, v in enumerate(args[1:]))
+
+
+def _prefix_second(args, add):
+    return args[:2] + (add(args[2]),) + args[3:]
+
+
+def _prefix_bitop(args, add):
+    return args[:2] + tuple(map(add, args[2:]))
+
+
+def _prefix_numkeys(args, add):
+    """EVAL/EVALSHA script numkeys key... arg..."""
+    numkeys = int(args[2])
+    return args[:3] + tuple(map(add, args[3:3 + numkeys])) + args[3 + numkeys:]
+
+
+def _prefix_store_numkeys(args, add):
+    """ZUNIONSTORE/ZINTERSTORE dest numkeys key..."""
+    numkeys = int(args[2])
+    return (args[0], add(args[1]), args[2]) + tuple(map(add, args[3:3 + numkeys])) + args[3 + numkeys:]
 
-    # add methods those are need to be hacked here
-    _hacked_methods = [
-        'set', 'get', 'setex', 'hget', 'hset', 'smembers',
-        'sadd', 'incr', 'delete', 'exists', 'mget', 'mset',
-        'sismember', 'expire',
-    ]
-    own_attrs = ['_client', '__prefix']
 
-    def __getattribute__(self, name):
-        if name in _RedisProxy.own_attrs:
-            return object.__getattribute__(self, name)
-        try:
-            attr = getattr(self._client, name)
-        except AttributeError:
-            return object.__getattribute__(self, name)
+def _prefix_streams(args, add):
+    """XREAD/XREADGROUP ... STREAMS key... id..."""
+    for i, v in enumerate(args):
+        if v in ('STREAMS', b'STREAMS', 'streams'):
+            keys_num = (len(args) - i - 1) // 2
+            return args[:i + 1] + tuple(map(add, args[i + 1:i + 1 + keys_num])) + args[i + 1 + keys_num:]
+    return args
 
-        if name in _RedisProxy._hacked_methods:
-            def newfunc(k, *args, **kwargs):
-                prefix = self.__prefix
-                k = prefix + ':' + k
-                result = attr(k, *args, **kwargs)
-                return result
-            return newfunc
 
-        return attr
+def _prefix_pattern(args, add):
+    """SCAN cursor [MATCH pattern] / KEYS pattern, 未指定MATCH时只扫描本前缀下的key"""
+    if args[0] == 'KEYS':
+        return _prefix_first(args, add)
+    args = list(args)
+    for i, v in enumerate(args):
+        if v in ('MATCH', b'MATCH') and i + 1 < len(args):
+            args[i + 1] = add(args[i + 1])
+            return tuple(args)
+    return tuple(args) + ('MATCH', add('*'))
 
-    def __init__(self, prefix):
-        self._client = redis.StrictRedis(**settings.REDIS_CONF[prefix])
-        self.__prefix = prefix
+
+def _prefix_sort(args, add):
+    """
+    SORT key [BY pattern] [LIMIT offset count] [GET pattern ...] [ASC|DESC] [ALPHA] [STORE dest];
+    BY/GET的pattern同样是key, nosort及#除外
+    """
+    args = list(args)
+    args[1] = add(args[1])
+    i = 2
+    while i < len(args):
+        option = args[i].decode() if isinstance(args[i], bytes) else str(args[i])
+        option = option.upper()
+        if option == 'LIMIT':
+            i += 3
+            continue
+        if option in ('BY', 'GET', 'STORE') and i + 1 < len(args):
+            value = args[i + 1]
+            plain = value.decode() if isinstance(value, bytes) else str(value)
+            if not (option == 'BY' and plain.lower() == 'nosort') and not (option == 'GET' and plain == '#'):
+                args[i + 1] = add(value)
+            i += 2
+            continue
+        i += 1
+    return tuple(args)
+
+
+_KEY_HANDLERS = {
+    'SCAN': _prefix_pattern,
+    'KEYS': _prefix_pattern,
+    'OBJECT': _prefix_second,
+    'BITOP': _prefix_bitop,
+    'EVAL': _prefix_numkeys,
+    'EVALSHA': _prefix_numkeys,
+    'ZUNIONSTORE': _prefix_store_numkeys,
+    'ZINTERSTORE': _prefix_store_numkeys,
+    'XREAD': _prefix_streams,
+    'XREADGROUP': _prefix_streams,
+    'MSET': _prefix_pairs,
+    'MSETNX': _prefix_pairs,
+    'SORT': _prefix_sort,
+    'SORT_RO': _prefix_sort,
+}
+_KEY_HANDLERS.update(dict.fromkeys([
+    'MGET', 'DEL', 'UNLINK', 'EXISTS', 'TOUCH', 'WATCH',
+    'SINTER', 'SUNION', 'SDIFF', 'SINTERSTORE', 'SUNIONSTORE', 'SDIFFSTORE',
+    'PFCOUNT', 'PFMERGE',
+], _prefix_all))
+_KEY_HANDLERS.update(dict.fromkeys([
+    'BLPOP', 'BRPOP', 'BZPOPMIN', 'BZPOPMAX',
+], _prefix_all_but_last))
+_KEY_HANDLERS.update(dict.fromkeys([
+    'RPOPLPUSH', 'BRPOPLPUSH', 'SMOVE', 'RENAME', 'RENAMENX',
+], _prefix_first_two))
+# 以下带key的多词命令只有一个key; 其余多词命令(SCRIPT LOAD, CLIENT LIST等)无key
+_KEY_HANDLERS.update(dict.fromkeys([
+    'MEMORY USAGE', 'XINFO STREAM', 'XINFO GROUPS', 'XINFO CONSUMERS',
+    'XGROUP CREATE', 'XGROUP DESTROY', 'XGROUP SETID', 'XGROUP DELCONSUMER',
+], _prefix_first))
+_NO_KEY_COMMANDS = {
+    'PING', 'ECHO', 'INFO', 'SELECT', 'DBSIZE', 'FLUSHDB', 'FLUSHALL', 'TIME', 'LASTSAVE',
+    'SAVE', 'BGSAVE', 'BGREWRITEAOF', 'MULTI', 'EXEC', 'DISCARD', 'UNWATCH', 'PUBLISH',
+    'RANDOMKEY', 'WAIT', 'SHUTDOWN', 'SLAVEOF', 'REPLICAOF', 'MONITOR', 'SWAPDB',
+}
+
+
+class PrefixedCommandsMixin:
+    """
+    按命令自动为key添加前缀: 单key命令默认处理第一个参数, 多key命令见 _KEY_HANDLERS;
+    SCAN/KEYS及阻塞弹出命令返回的key会去掉前缀
+    """
+    key_prefix = ''
+
+    def _add_prefix(self, key):
+        if isinstance(key, bytes):
+            return self.key_prefix.encode() + key
+        return f'{self.key_prefix}{key}'
+
+    def _strip_prefix(self, key):
+        prefix = self.key_prefix.encode() if isinstance(key, bytes) else self.key_prefix
+        return key[len(prefix):] if key.startswith(prefix) else key
+
+    def execute_command(self, *args, **options):
+        command = args[0]
+        handler = _KEY_HANDLERS.get(command)
+        if handler is not None:
+            args = handler(args, self._add_prefix)
+        elif len(args) > 1 and ' ' not in command and command not in _NO_KEY_COMMANDS:
+            args = (command, self._add_prefix(args[1])) + args[2:]
+        return super().execute_command(*args, **options)
+
+    def _wrap_response_callbacks(self, callbacks):
+        callbacks = callbacks.copy()
+        strip = self._strip_prefix
+
+        def chain(name, func):
+            origin = callbacks.get(name)
+            if origin is None:
+                callbacks[name] = lambda response, **options: func(response)
+            else:
+                callbacks[name] = lambda response, **options: func(origin(response, **options))
+
+        chain('SCAN', lambda r: (r[0], [strip(k) for k in r[1]]))
+        chain('KEYS', lambda r: [strip(k) for k in r])
+        for name in ('BLPOP', 'BRPOP', 'BZPOPMIN', 'BZPOPMAX'):
+            chain(name, lambda r: r and (strip(r[0]),) + tuple(r[1:]))
+        return callbacks
+
+
+class PrefixedPipeline(PrefixedCommandsMixin, Pipeline):
+    pass
+
+
+class PrefixedRedis(PrefixedCommandsMixin, redis.StrictRedis):
+    """
+    自动添加key前缀的redis客户端, 与get_conn_pool使用同一连接池; pipeline同样自动添加前缀
+    """
+
+    def __init__(self, prefix, **kwargs):
+        super().__init__(**kwargs)
+        self.prefix = prefix
+        self.key_prefix = f'{prefix}:'
+        self.response_callbacks = self._wrap_response_callbacks(self.response_callbacks)
 
     @classmethod
-    def get_client(cls, prefix=''):
-        return cls(prefix)
+    def from_client(cls, client, prefix):
+        return cls(prefix, connection_pool=client.connection_pool)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = PrefixedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.key_prefix = self.key_prefix
+        return pipe
 
     def __repr__(self):
-        return f'<cache_proxy: {self.__prefix}>'
+        return f'<cache_proxy: {self.prefix}>'
+
+
+prefixed_clients = {}
 
 
-_redis_proxy = _RedisProxy.get_client
+def get_prefixed_client(name, binary=False) -> PrefixedRedis:
+    """
+    获取以name为前缀的redis客户端
+    binary: 不解码返回值, 存取pickle等二进制数据时使用
+    """
+    client = prefixed_clients.get((name, binary))
+    if client is None:
+        pool = get_binary_conn_pool() if binary else get_conn_pool()
+        client = prefixed_clients[(name, binary)] = PrefixedRedis.from_client(pool[name], name)
+    return client
+
 
 # 缓存实例定义
-ums_cache = _redis_proxy('ums_cache_ca')
-has_log_cache = _redis_proxy('task_has_log')
+ums_cache = get_prefixed_client('ums_cache_ca', binary=True)
+has_log_cache = get_prefixed_client('task_has_log', binary=True)
+
+# 缓存命名空间版本号, 与缓存实例使用同一redis
+cache_version = CacheVersion(get_prefixed_client('task_has_log'))
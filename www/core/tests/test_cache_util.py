@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+CacheWrap 的单飞(single flight)、过期旧值及版本号失效
+"""
+
+import datetime
+import threading
+import time
+import unittest
+
+from core.util.cache_util import CacheVersion, CacheWrap
+
+
+class FakeRedis(object):
+    """仅实现 CacheWrap、CacheVersion 用到的命令, 不处理过期"""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, nx=False, ex=None):
+        with self.lock:
+            if nx and key in self.data:
+                return None
+            self.data[key] = value
+            return True
+
+    def setex(self, key, expire, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            self.data[key] = int(self.data.get(key) or 0) + amount
+            return self.data[key]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def incr(self, key, amount=1):
+        self.commands.append((key, amount))
+
+    def execute(self):
+        return [self.conn.incr(key, amount) for key, amount in self.commands]
+
+
+class CacheWrapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeRedis()
+        self.calls = []
+
+    def build(self, **kwargs):
+        kwargs.setdefault('time_range', 0)
+        return CacheWrap(self.conn, pre_fix='test', **kwargs)
+
+    def counted(self, cache_wrap, delay=0, fail=False):
+        @cache_wrap
+        def func(x):
+            self.calls.append(x)
+            if delay:
+                time.sleep(delay)
+            if fail:
+                raise ValueError('compute fail')
+            return f'{x}:{len(self.calls)}'
+        return func
+
+    def only_key(self):
+        keys = [k for k in self.conn.data if not k.endswith(':lock') and not k.startswith('cache_')]
+        self.assertEqual(len(keys), 1)
+        return keys[0]
+
+    def expire_entry(self, cache_wrap, key, value):
+        """写入已过新鲜期、仍在旧值可用期内的缓存"""
+        envelope = {cache_wrap.envelope_key: time.time() - 1, 'value': value}
+        self.conn.data[key] = cache_wrap.serializer.dumps(envelope)
+
+    def test_hit(self):
+        cache_wrap = self.build()
+        func = self.counted(cache_wrap)
+        self.assertEqual(func(1), '1:1')
+        self.assertEqual(func(1), '1:1')
+        self.assertEqual(func(2), '2:2')
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual((cache_wrap.hits, cache_wrap.miss), (1, 2))
+        self.assertFalse([k for k in self.conn.data if k.endswith(':lock')])
+
+    def test_single_flight(self):
+        func = self.counted(self.build(single_flight=True, lock_wait=5), delay=0.3)
+        barrier = threading.Barrier(8)
+        results = []
+
+        def worker():
+            barrier.wait()
+            results.append(func(1))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(results, ['1:1'] * 8)
+
+    def test_without_single_flight(self):
+        func = self.counted(self.build(), delay=0.2)
+        barrier = threading.Barrier(4)
+
+        def worker():
+            barrier.wait()
+            func(1)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.calls), 4)
+
+    def test_wait_timeout(self):
+        cache_wrap = self.build(single_flight=True, lock_wait=0.2)
+        func = self.counted(cache_wrap)
+        key = cache_wrap._get_cache_key((1,), {})
+        # 其他调用方持有锁且一直未写入, 等待超时后自行计算, 且不释放他人的锁
+        self.conn.data[f'{key}:lock'] = 'other'
+        start = time.time()
+        self.assertEqual(func(1), '1:1')
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(self.conn.data[f'{key}:lock'], 'other')
+
+    def test_stale_while_revalidate(self):
+        cache_wrap = self.build(stale_ttl=60)
+        func = self.counted(cache_wrap)
+        func(1)
+        key = self.only_key()
+        self.expire_entry(cache_wrap, key, 'old')
+
+        # 其他调用方正在刷新: 直接返回旧值
+        self.conn.data[f'{key}:lock'] = 'other'
+        self.assertEqual(func(1), 'old')
+        self.assertEqual(self.calls, [1])
+
+        # 拿到锁: 刷新并返回新值
+        del self.conn.data[f'{key}:lock']
+        self.assertEqual(func(1), '1:2')
+        self.assertEqual(func(1), '1:2')
+        self.assertEqual(self.calls, [1, 1])
+        self.assertNotIn(f'{key}:lock', self.conn.data)
+
+    def test_stale_on_revalidate_fail(self):
+        cache_wrap = self.build(stale_ttl=60)
+        self.counted(cache_wrap)(1)
+        key = self.only_key()
+        self.expire_entry(cache_wrap, key, 'old')
+        func = self.counted(cache_wrap, fail=True)
+        self.assertEqual(func(1), 'old')
+        self.assertNotIn(f'{key}:lock', self.conn.data)
+
+    def test_corrupt_entry_is_miss(self):
+        cache_wrap = self.build()
+        func = self.counted(cache_wrap)
+        func(1)
+        self.conn.data[self.only_key()] = b'not a cache envelope'
+        self.assertEqual(func(1), '1:2')
+
+    def test_json_serializer(self):
+        value = {'dt': datetime.datetime(2020, 10, 1, 8, 30), 'date': datetime.date(2020, 10, 1), 'ids': {1, 2}}
+
+        @self.build(serializer='json')
+        def func():
+            self.calls.append(1)
+            return value
+
+        self.assertEqual(func(), value)
+        self.assertEqual(func(), value)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_version_namespaces(self):
+        version_store = CacheVersion(self.conn)
+        func = self.counted(self.build(version_store=version_store, namespaces=lambda x: [f'item:{x}']))
+        self.assertEqual(func(1), '1:1')
+        self.assertEqual(func(2), '2:2')
+        version_store.bump('item:1')
+        self.assertEqual(func(1), '1:3')
+        self.assertEqual(func(2), '2:2')
+        self.assertEqual(func(1), '1:3')
+
+    def test_version_unavailable_bypass_cache(self):
+        version_store = CacheVersion(self.conn)
+        func = self.counted(self.build(version_store=version_store, namespaces=['item']))
+        self.conn.mget = None
+        func(1)
+        func(1)
+        self.assertEqual(self.calls, [1, 1])
+        self.assertFalse([k for k in self.conn.data if ':test:' in k])
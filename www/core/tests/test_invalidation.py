@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+失效总线的订阅线程启动、回调分发及按实例缓存的属性
+"""
+
+import unittest
+from unittest import mock
+
+from core.invalidation import InvalidationBus, invalidated_cached_property
+
+
+class InvalidationBusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = InvalidationBus('default')
+        # 不连接redis, 只记录订阅线程的启动
+        self.started = []
+        patcher = mock.patch.object(InvalidationBus, 'run', lambda bus: self.started.append(bus))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wait_threads(self):
+        if self.bus.thread is not None:
+            self.bus.thread.join()
+
+    def test_register_starts_subscriber(self):
+        self.bus.register('model:A', lambda ns: None)
+        self.bus.register('model:B', lambda ns: None)
+        self.wait_threads()
+        self.assertEqual(len(self.started), 1)
+
+    def test_restart_after_fork(self):
+        with mock.patch('core.invalidation.os.getpid', return_value=100):
+            self.bus.register('model:A', lambda ns: None)
+            self.bus.ensure_started()
+        self.wait_threads()
+        with mock.patch('core.invalidation.os.getpid', return_value=101):
+            self.bus.ensure_started()
+            self.bus.ensure_started()
+        self.wait_threads()
+        self.assertEqual(len(self.started), 2)
+
+    def test_dispatch(self):
+        calls = []
+        self.bus.register('model:A', calls.append)
+        self.bus.register('model:A', lambda ns: 1 / 0)
+        self.bus.register('model:B', calls.append)
+        with mock.patch.object(self.bus, 'get_sender', return_value='other'):
+            self.bus.handle_message('{"sender": "self", "namespaces": ["model:A"]}')
+        self.bus.handle_message(f'{{"sender": "{self.bus.get_sender()}", "namespaces": ["model:B"]}}')
+        self.bus.handle_message('not json')
+        self.assertEqual(calls, ['model:A'])
+        self.assertEqual(self.bus.get_tag(['model:A', 'model:B']), (0, 1, 0))
+
+
+class InvalidatedCachedPropertyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = InvalidationBus('default')
+        self.bus.pid = object()
+        self.bus.ensure_started = lambda: None
+        bus = self.bus
+
+        class Handler(object):
+            def __init__(self):
+                self.calls = 0
+
+            @invalidated_cached_property(['model:A'], bus=bus)
+            def value(self):
+                self.calls += 1
+                return self.calls
+
+        self.Handler = Handler
+
+    def test_cache_until_invalidated(self):
+        handler, other = self.Handler(), self.Handler()
+        self.assertEqual((handler.value, handler.value), (1, 1))
+        self.assertEqual(other.value, 1)
+        self.bus.dispatch(['model:B'])
+        self.assertEqual(handler.value, 1)
+        self.bus.dispatch(['model:A'])
+        self.assertEqual((handler.value, handler.value), (2, 2))
+        self.assertEqual(other.value, 2)
+
+    def test_reconnect_resets(self):
+        handler = self.Handler()
+        handler.value
+        self.bus.resets += 1
+        self.assertEqual(handler.value, 2)
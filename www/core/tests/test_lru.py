@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+LRUCacheDict 的淘汰、过期及统计
+"""
+
+import threading
+import unittest
+from unittest import mock
+
+from core.lru import LRUCachedFunction, LRUCacheDict
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheDictTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('core.lru.time.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_set(self):
+        d = LRUCacheDict(max_size=3, expiration=10)
+        d['a'] = 1
+        self.assertEqual(d['a'], 1)
+        self.assertIn('a', d)
+        self.assertEqual(d.get('b', 'default'), 'default')
+        with self.assertRaises(KeyError):
+            d['b']
+        del d['a']
+        self.assertNotIn('a', d)
+        with self.assertRaises(KeyError):
+            del d['a']
+
+    def test_evict_least_recently_used(self):
+        d = LRUCacheDict(max_size=3, expiration=10)
+        for key in 'abc':
+            d[key] = key
+        # 读取使a成为最近使用, 淘汰b
+        d['a']
+        d['d'] = 'd'
+        self.assertEqual(len(d), 3)
+        self.assertNotIn('b', d)
+        for key in 'acd':
+            self.assertIn(key, d)
+        # 覆盖写入同样刷新使用顺序
+        d['c'] = 'C'
+        d['e'] = 'e'
+        self.assertNotIn('a', d)
+        self.assertEqual(d['c'], 'C')
+        self.assertEqual(d.stats()['evictions'], 2)
+
+    def test_expire_on_read(self):
+        d = LRUCacheDict(max_size=3, expiration=10)
+        d['a'] = 1
+        self.clock.now += 10
+        self.assertEqual(d['a'], 1)
+        self.clock.now += 0.1
+        self.assertNotIn('a', d)
+        with self.assertRaises(KeyError):
+            d['a']
+        self.assertEqual(len(d), 0)
+        self.assertEqual(d.stats()['expirations'], 1)
+
+    def test_cleanup_on_set(self):
+        d = LRUCacheDict(max_size=10, expiration=10)
+        d['a'] = 1
+        d['b'] = 2
+        self.clock.now += 5
+        d['c'] = 3
+        # 过期时间按写入顺序清理, 覆盖写入的key移到队尾
+        d['a'] = 1
+        self.clock.now += 6
+        d['d'] = 4
+        self.assertEqual(len(d), 3)
+        self.assertNotIn('b', d)
+        self.assertIn('a', d)
+        self.clock.now += 11
+        d.cleanup()
+        self.assertEqual(len(d), 0)
+        self.assertEqual(d.stats()['expirations'], 4)
+
+    def test_no_expiration(self):
+        d = LRUCacheDict(max_size=2, expiration=None)
+        d['a'] = 1
+        self.clock.now += 10 ** 6
+        self.assertEqual(d['a'], 1)
+        d['b'] = 2
+        d['c'] = 3
+        self.assertNotIn('a', d)
+
+    def test_stats_and_clear(self):
+        d = LRUCacheDict(max_size=3, expiration=10)
+        d['a'] = 1
+        d['a']
+        d.get('b')
+        self.assertEqual(d.stats(), {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0, 'expirations': 0})
+        d.clear()
+        self.assertEqual(len(d), 0)
+        self.assertNotIn('a', d)
+
+    def test_concurrent(self):
+        d = LRUCacheDict(max_size=50, expiration=10, concurrent=True)
+        errors = []
+
+        def worker(offset):
+            try:
+                for i in range(2000):
+                    key = (offset + i) % 80
+                    d[key] = key
+                    d.get((key * 7) % 80)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i * 13,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(d), 50)
+
+
+class LRUCachedFunctionTest(unittest.TestCase):
+
+    def test_cache_by_arguments(self):
+        calls = []
+
+        def func(*args, **kwargs):
+            calls.append((args, kwargs))
+            return len(calls)
+
+        cached = LRUCachedFunction(func, LRUCacheDict(max_size=10, expiration=10))
+        self.assertEqual(cached('a', {'x': 1}), 1)
+        self.assertEqual(cached('a', {'x': 1}), 1)
+        self.assertEqual(cached('a', {'x': 2}), 2)
+        self.assertEqual(cached('a', x=1), 3)
+        self.assertEqual(cached('a', x=1), 3)
+        # 不可哈希的参数退化为repr作为key
+        self.assertEqual(cached(['a']), 4)
+        self.assertEqual(cached(['a']), 4)
+        self.assertEqual(len(calls), 4)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+#  Copyright (C) 2020  momosecurity
+#
+#  This file is part of Bombus.
+#
+#  Bombus is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Bombus is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+PrefixedRedis 按命令为key添加前缀
+"""
+
+import unittest
+from unittest import mock
+
+import redis
+
+from core.redis_conn import PrefixedRedis
+
+# (命令参数, 添加前缀后的参数)
+RAW_CASES = [
+    # 单key命令默认处理第一个参数
+    (('GET', 'k'), ('GET', 'p:k')),
+    (('HSET', 'h', 'f', 'v'), ('HSET', 'p:h', 'f', 'v')),
+    (('SCAN', 0, 'MATCH', 'u*', 'COUNT', 10), ('SCAN', 0, 'MATCH', 'p:u*', 'COUNT', 10)),
+    (('SCAN', 0), ('SCAN', 0, 'MATCH', 'p:*')),
+    (('KEYS', 'u*'), ('KEYS', 'p:u*')),
+    (('OBJECT', 'ENCODING', 'k'), ('OBJECT', 'ENCODING', 'p:k')),
+    (('BITOP', 'AND', 'd', 'a', 'b'), ('BITOP', 'AND', 'p:d', 'p:a', 'p:b')),
+    (('EVAL', 'script', 2, 'a', 'b', 'x'), ('EVAL', 'script', 2, 'p:a', 'p:b', 'x')),
+    (('EVALSHA', 'sha', 1, 'a', 'x', 'y'), ('EVALSHA', 'sha', 1, 'p:a', 'x', 'y')),
+    (('EVAL', 'script', 0, 'x'), ('EVAL', 'script', 0, 'x')),
+    (('ZUNIONSTORE', 'd', 2, 'a', 'b', 'WEIGHTS', 1, 2), ('ZUNIONSTORE', 'p:d', 2, 'p:a', 'p:b', 'WEIGHTS', 1, 2)),
+    (('ZINTERSTORE', 'd', 1, 'a'), ('ZINTERSTORE', 'p:d', 1, 'p:a')),
+    (('XREAD', 'COUNT', 1, 'STREAMS', 's1', 's2', '0', '0'), ('XREAD', 'COUNT', 1, 'STREAMS', 'p:s1', 'p:s2', '0', '0')),
+    (('XREADGROUP', 'GROUP', 'g', 'c', 'STREAMS', 's1', '>'), ('XREADGROUP', 'GROUP', 'g', 'c', 'STREAMS', 'p:s1', '>')),
+    (('MSET', 'a', 1, 'b', 2), ('MSET', 'p:a', 1, 'p:b', 2)),
+    (('MSETNX', 'a', 1), ('MSETNX', 'p:a', 1)),
+    (('SORT', 'k', 'BY', 'w_*', 'LIMIT', 0, 10, 'GET', '#', 'GET', 'o_*->f', 'DESC', 'ALPHA', 'STORE', 'd'),
+     ('SORT', 'p:k', 'BY', 'p:w_*', 'LIMIT', 0, 10, 'GET', '#', 'GET', 'p:o_*->f', 'DESC', 'ALPHA', 'STORE', 'p:d')),
+    (('SORT', 'k', 'BY', 'nosort', 'GET', 'o_*'), ('SORT', 'p:k', 'BY', 'nosort', 'GET', 'p:o_*')),
+    (('SORT_RO', 'k', 'by', 'w_*'), ('SORT_RO', 'p:k', 'by', 'p:w_*')),
+    (('BLPOP', 'a', 'b', 5), ('BLPOP', 'p:a', 'p:b', 5)),
+    (('BZPOPMIN', 'a', 0), ('BZPOPMIN', 'p:a', 0)),
+    (('RPOPLPUSH', 'a', 'b'), ('RPOPLPUSH', 'p:a', 'p:b')),
+    (('BRPOPLPUSH', 'a', 'b', 5), ('BRPOPLPUSH', 'p:a', 'p:b', 5)),
+    (('SMOVE', 'a', 'b', 'm'), ('SMOVE', 'p:a', 'p:b', 'm')),
+    (('RENAME', 'a', 'b'), ('RENAME', 'p:a', 'p:b')),
+    (('MEMORY USAGE', 'k'), ('MEMORY USAGE', 'p:k')),
+    (('XGROUP CREATE', 's', 'g', '0'), ('XGROUP CREATE', 'p:s', 'g', '0')),
+    (('XINFO STREAM', 's'), ('XINFO STREAM', 'p:s')),
+    # 无key命令
+    (('PUBLISH', 'ch', 'm'), ('PUBLISH', 'ch', 'm')),
+    (('INFO', 'memory'), ('INFO', 'memory')),
+    (('PING',), ('PING',)),
+    (('SCRIPT LOAD', 'script'), ('SCRIPT LOAD', 'script')),
+    (('CLIENT LIST',), ('CLIENT LIST',)),
+]
+RAW_CASES += [
+    ((command, 'a', 'b'), (command, 'p:a', 'p:b'))
+    for command in ('MGET', 'DEL', 'UNLINK', 'EXISTS', 'TOUCH', 'WATCH', 'SINTER', 'SUNION', 'SDIFF',
+                    'SINTERSTORE', 'SUNIONSTORE', 'SDIFFSTORE', 'PFCOUNT', 'PFMERGE')
+]
+
+# 通过redis-py的方法调用, 检查实际构造的参数
+METHOD_CASES = [
+    (lambda c: c.sort('k', by='w_*', get=['#', 'o_*'], store='d'),
+     ('SORT', 'p:k', b'BY', 'p:w_*', b'GET', '#', b'GET', 'p:o_*', b'STORE', 'p:d')),
+    (lambda c: c.eval('return 1', 2, 'a', 'b', 'x'), ('EVAL', 'return 1', 2, 'p:a', 'p:b', 'x')),
+    (lambda c: c.xreadgroup('g', 'c', {'s1': '>', 's2': '0'}, count=2),
+     ('XREADGROUP', b'GROUP', 'g', 'c', b'COUNT', '2', b'STREAMS', 'p:s1', 'p:s2', '>', '0')),
+    (lambda c: c.scan(0, match='u*'), ('SCAN', 0, b'MATCH', 'p:u*')),
+    (lambda c: c.publish('ch', 'm'), ('PUBLISH', 'ch', 'm')),
+    (lambda c: c.delete('a', 'b'), ('DEL', 'p:a', 'p:b')),
+    (lambda c: c.mset({'a': 1, 'b': 2}), ('MSET', 'p:a', 1, 'p:b', 2)),
+]
+
+
+def record_args(self, *args, **options):
+    return args
+
+
+class PrefixedRedisTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(redis.StrictRedis, 'execute_command', record_args)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = PrefixedRedis('p')
+
+    def test_raw_commands(self):
+        for args, expected in RAW_CASES:
+            with self.subTest(command=args[0]):
+                self.assertEqual(self.client.execute_command(*args), expected)
+
+    def test_client_methods(self):
+        for call, expected in METHOD_CASES:
+            with self.subTest(command=expected[0]):
+                self.assertEqual(call(self.client), expected)
+
+    def test_bytes_keys(self):
+        self.assertEqual(self.client.execute_command('GET', b'k'), ('GET', b'p:k'))
+        self.assertEqual(self.client.execute_command('SORT', b'k', b'GET', b'#', b'GET', b'o_*'),
+                         ('SORT', b'p:k', b'GET', b'#', b'GET', b'p:o_*'))
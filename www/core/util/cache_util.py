@@ -20,16 +20,136 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with Bombus.  If not, see <https://www.gnu.org/licenses/>.
 
+import datetime
 import functools
+import inspect
+import json
+import logging
 import pickle
 import random
+import time
+import uuid
 
 from core.util.hash_util import md5
 
+logger = logging.getLogger(__name__)
+
+
+class PickleSerializer(object):
+
+    @staticmethod
+    def dumps(value):
+        return pickle.dumps(value)
+
+    @staticmethod
+    def loads(value):
+        return pickle.loads(value)
+
+
+class JsonSerializer(object):
+    """
+    json序列化, 比pickle体积小、解析快; 通过类型标记还原 datetime/date/set,
+    tuple 会还原为 list
+    """
+
+    @staticmethod
+    def default(obj):
+        if isinstance(obj, datetime.datetime):
+            return {'__datetime__': obj.isoformat()}
+        if isinstance(obj, datetime.date):
+            return {'__date__': obj.isoformat()}
+        if isinstance(obj, (set, frozenset)):
+            return {'__set__': list(obj)}
+        raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+    @staticmethod
+    def object_hook(obj):
+        if len(obj) == 1:
+            if '__datetime__' in obj:
+                return datetime.datetime.fromisoformat(obj['__datetime__'])
+            if '__date__' in obj:
+                return datetime.date.fromisoformat(obj['__date__'])
+            if '__set__' in obj:
+                return set(obj['__set__'])
+        return obj
+
+    @classmethod
+    def dumps(cls, value):
+        return json.dumps(value, default=cls.default, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, value):
+        return json.loads(value, object_hook=cls.object_hook)
+
+
+serializer_map = {
+    'pickle': PickleSerializer,
+    'json': JsonSerializer,
+}
+
+
+class CacheVersion(object):
+    """
+    缓存命名空间版本号: 缓存key中带上相关命名空间(如 model:AuditSysModel、task:<id>)的版本号,
+    写入方修改数据后递增版本号, 旧版本的缓存不再被读取, 随过期时间自然淘汰
+    """
+    key_prefix = 'cache_version'
+
+    def __init__(self, cache_serve):
+        self.cache_serve = cache_serve
+
+    @staticmethod
+    def namespace(kind, ident=None):
+        if ident is None:
+            return kind
+        return f'{kind}:{ident}'
+
+    def _get_key(self, namespace):
+        return f'{self.key_prefix}:{namespace}'
+
+    def get_tag(self, namespaces):
+        """
+        return: 各命名空间版本号拼接的字符串, 查询失败返回None(调用方不应使用缓存)
+        """
+        if not namespaces:
+            return ''
+        try:
+            versions = self.cache_serve.mget([self._get_key(ns) for ns in namespaces])
+        except Exception:
+            logger.exception('get cache versions fail')
+            return None
+        return '.'.join(str(int(v or 0)) for v in versions)
+
+    def bump(self, *namespaces):
+        namespaces = set(filter(None, namespaces))
+        if not namespaces:
+            return
+        try:
+            pipe = self.cache_serve.pipeline(transaction=False)
+            for ns in sorted(namespaces):
+                pipe.incr(self._get_key(ns))
+            pipe.execute()
+        except Exception:
+            logger.exception(f'bump cache versions of {namespaces} fail')
+
 
 class CacheWrap(object):
+    """
+    缓存装饰器
+    single_flight: 缓存失效时只有拿到锁的调用方重新计算, 其余调用方等待结果(最多lock_wait秒, 超时自行计算);
+                   每次未命中多一次加锁请求, 默认关闭, 只在并发重算代价高的缓存上开启
+    stale_ttl: 过期后stale_ttl秒内仍返回旧值, 同时由拿到锁的一个调用方刷新
+    serializer: pickle / json, 或实现了dumps、loads的对象
+    命中/未命中次数每upload_interval秒累加到redis: cache_stats:{pre_fix}:hits/miss
+    version_store, namespaces: 见CacheVersion; namespaces为命名空间列表或以调用参数返回列表的函数
+    """
+    # 缓存值外层封装, 记录新鲜截止时间
+    envelope_key = '__cache_wrap__'
+    lock_poll_interval = 0.05
 
-    def __init__(self, cache_serve, pre_fix='', expire=3600, time_range=600, time_cache_key=None):
+    def __init__(self, cache_serve, pre_fix='', expire=3600, time_range=600, time_cache_key=None,
+                 serializer='pickle', single_flight=False, lock_timeout=10, lock_wait=3, stale_ttl=0,
+                 upload_interval=60, version_store=None, namespaces=None):
         assert expire > 0, 'expire must be bigger than 0'
         assert isinstance(pre_fix, str), 'pre_fix only accept string value'
 
@@ -40,6 +160,18 @@ class CacheWrap(object):
         self.miss = 0
         self.hits = 0
         self.time_cache_key=time_cache_key
+        self.serializer = serializer_map[serializer] if isinstance(serializer, str) else serializer
+        self.single_flight = single_flight
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+        self.stale_ttl = stale_ttl
+        self.upload_interval = upload_interval
+        self.uploaded_hits = 0
+        self.uploaded_miss = 0
+        self.uploaded_ts = time.time()
+        self.version_store = version_store
+        self.namespaces = namespaces
+        assert not namespaces or version_store, 'namespaces require version_store'
 
     @property
     def random_expire(self):
@@ -49,31 +181,88 @@ class CacheWrap(object):
         return expire
 
     def _set_cache(self, key, value):
-        value = pickle.dumps(value)
-        self.cache_serve.setex(key, self.random_expire, value)
+        expire = self.random_expire
+        envelope = {self.envelope_key: time.time() + expire, 'value': value}
+        self.cache_serve.setex(key, expire + self.stale_ttl, self.serializer.dumps(envelope))
 
-    def _get_cache(self, key):
-        _get = False
+    def _load_cache(self, key):
+        """
+        return: (是否命中, 是否新鲜, 缓存值)
+        """
         value = self.cache_serve.get(key)
-        if value:
-            try:
-                value = pickle.loads(value)
-                _get = True
-            except:
-                pass
+        if not value:
+            return False, False, None
+        try:
+            envelope = self.serializer.loads(value)
+            fresh_until = envelope[self.envelope_key]
+            return True, time.time() < fresh_until, envelope['value']
+        except Exception:
+            return False, False, None
 
+    def _get_cache(self, key):
+        _get, fresh, value = self._load_cache(key)
         if _get:
             self.hits += 1
         else:
             self.miss += 1
         self.upload_hit()
-        return _get, value
+        return _get, fresh, value
 
-    def upload_hit(self):
+    @property
+    def stats_key(self):
+        return f'cache_stats:{self.pre_fix or "default"}'
+
+    def upload_hit(self, force=False):
         """
         upload the miss/hit to cal the Statistics
         """
-        pass
+        now = time.time()
+        if not force and now - self.uploaded_ts < self.upload_interval:
+            return
+        self.uploaded_ts = now
+        hits, miss = self.hits - self.uploaded_hits, self.miss - self.uploaded_miss
+        if not hits and not miss:
+            return
+        try:
+            if hits:
+                self.cache_serve.incr(f'{self.stats_key}:hits', hits)
+            if miss:
+                self.cache_serve.incr(f'{self.stats_key}:miss', miss)
+            self.uploaded_hits += hits
+            self.uploaded_miss += miss
+        except Exception:
+            logger.exception(f'upload cache stats of {self.stats_key} fail')
+
+    def _acquire_lock(self, key):
+        token = uuid.uuid4().hex
+        try:
+            if self.cache_serve.set(f'{key}:lock', token, nx=True, ex=self.lock_timeout):
+                return token
+        except Exception:
+            logger.exception(f'acquire cache lock of {key} fail')
+            return token
+        return None
+
+    def _release_lock(self, key, token):
+        lock_key = f'{key}:lock'
+        try:
+            current = self.cache_serve.get(lock_key)
+            if isinstance(current, bytes):
+                current = current.decode()
+            # 计算超时锁已被他人持有时不能删除
+            if current == token:
+                self.cache_serve.delete(lock_key)
+        except Exception:
+            logger.exception(f'release cache lock of {key} fail')
+
+    def _wait_cache(self, key):
+        deadline = time.time() + self.lock_wait
+        while time.time() < deadline:
+            time.sleep(self.lock_poll_interval)
+            _get, fresh, value = self._load_cache(key)
+            if _get and fresh:
+                return True, value
+        return False, None
 
     def _get_cache_key(self, args, kwargs):
         time_key = ''
@@ -88,15 +277,179 @@ class CacheWrap(object):
         md5_str = md5(f'{t_args}:{t_kwargs}')
         return f'{time_key}:{self.pre_fix}:{md5_str}'
 
+    def _get_version_tag(self, args, kwargs):
+        """未配置命名空间返回空字符串, 版本号查询失败返回None"""
+        namespaces = self.namespaces
+        if callable(namespaces):
+            namespaces = namespaces(*args, **kwargs)
+        if not namespaces:
+            return ''
+        return self.version_store.get_tag(namespaces)
+
+    def _compute(self, key, func, args, kwargs):
+        value = func(*args, **kwargs)
+        self._set_cache(key, value)
+        return value
+
+    def _revalidate(self, key, stale_value, func, args, kwargs):
+        """旧值可用期间: 拿到锁的调用方刷新, 其余直接返回旧值; 刷新失败也返回旧值"""
+        token = self._acquire_lock(key)
+        if token is None:
+            return stale_value
+        try:
+            return self._compute(key, func, args, kwargs)
+        except Exception:
+            logger.exception(f'revalidate cache of {key} fail, use stale value')
+            return stale_value
+        finally:
+            self._release_lock(key, token)
+
+    def _single_flight(self, key, func, args, kwargs):
+        token = self._acquire_lock(key)
+        if token is None:
+            _get, value = self._wait_cache(key)
+            if _get:
+                return value
+            # 等待超时, 自行计算
+            return self._compute(key, func, args, kwargs)
+        try:
+            # 拿到锁前可能已被其他调用方写入
+            _get, fresh, value = self._load_cache(key)
+            if _get and fresh:
+                return value
+            return self._compute(key, func, args, kwargs)
+        finally:
+            self._release_lock(key, token)
+
     def __call__(self, func):
         @functools.wraps(func)
         def wrapped_func(*args, **kwargs):
+            version_tag = self._get_version_tag(args, kwargs)
+            if version_tag is None:
+                return func(*args, **kwargs)
             key = self._get_cache_key(args, kwargs)
-            _get, value = self._get_cache(key)
-            if _get:
+            if version_tag:
+                key = f'{key}:{version_tag}'
+            _get, fresh, value = self._get_cache(key)
+            if _get and fresh:
                 return value
-            value = func(*args, **kwargs)
-            self._set_cache(key, value)
-            return value
+            if _get:
+                return self._revalidate(key, value, func, args, kwargs)
+            if self.single_flight:
+                return self._single_flight(key, func, args, kwargs)
+            return self._compute(key, func, args, kwargs)
+
+        return wrapped_func
+
+
+class BatchCacheWrap(object):
+    """
+    按元素缓存的批量缓存装饰器, 被装饰函数形如 func(..., items, ...) -> {item: value}
+    调用时拆分items, MGET各元素的缓存, 仅对未命中的元素调用原函数并合并结果;
+    原函数结果中没有的元素以空标记缓存missing_expire秒, 合并时同样不返回
+    batch_arg: items对应的参数名; 其余参数的repr作为命名空间参与key, 须能区分不同调用
+    cache_serve: 需支持mget及pipeline
+    version_store, namespaces: 同CacheWrap
+    """
+
+    def __init__(self, cache_serve, batch_arg, pre_fix='', expire=3600, time_range=600,
+                 missing_expire=None, serializer='json', version_store=None, namespaces=None):
+        assert expire > 0, 'expire must be bigger than 0'
+        assert isinstance(pre_fix, str), 'pre_fix only accept string value'
+
+        self.cache_serve = cache_serve
+        self.batch_arg = batch_arg
+        self.pre_fix = pre_fix
+        self.expire = expire
+        self.time_range = time_range
+        self.missing_expire = missing_expire or expire
+        self.serializer = serializer_map[serializer] if isinstance(serializer, str) else serializer
+        self.miss = 0
+        self.hits = 0
+        self.version_store = version_store
+        self.namespaces = namespaces
+        assert not namespaces or version_store, 'namespaces require version_store'
+
+    def random_expire(self, expire):
+        if self.time_range:
+            expire += random.randint(0, self.time_range)
+        return expire
+
+    def _get_namespace(self, arguments, version_tag):
+        params = [(k, v) for k, v in arguments.items() if k != self.batch_arg]
+        return md5(f'{params!r}:{version_tag}')
+
+    def _get_cache_key(self, namespace, item):
+        return f'{self.pre_fix}:{namespace}:{item}'
+
+    def _get_many(self, namespace, items):
+        """
+        return: (命中的{item: value}, 未命中的items); 命中空标记的元素不在两者中
+        """
+        try:
+            values = self.cache_serve.mget([self._get_cache_key(namespace, item) for item in items])
+        except Exception:
+            logger.exception(f'mget batch cache of {self.pre_fix} fail')
+            return {}, list(items)
+
+        result = {}
+        misses = []
+        for item, value in zip(items, values):
+            if value is None:
+                misses.append(item)
+                continue
+            try:
+                # [value]表示有值, []表示原函数未返回该元素
+                loaded = self.serializer.loads(value)
+            except Exception:
+                misses.append(item)
+                continue
+            if loaded:
+                result[item] = loaded[0]
+        self.hits += len(items) - len(misses)
+        self.miss += len(misses)
+        return result, misses
+
+    def _set_many(self, namespace, items, result):
+        try:
+            pipe = self.cache_serve.pipeline(transaction=False)
+            for item in items:
+                if item in result:
+                    value, expire = [result[item]], self.expire
+                else:
+                    value, expire = [], self.missing_expire
+                pipe.setex(self._get_cache_key(namespace, item), self.random_expire(expire),
+                           self.serializer.dumps(value))
+            pipe.execute()
+        except Exception:
+            logger.exception(f'set batch cache of {self.pre_fix} fail')
+
+    def __call__(self, func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapped_func(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            items = list(dict.fromkeys(bound.arguments[self.batch_arg] or []))
+            if not items:
+                return func(*args, **kwargs)
+
+            version_tag = ''
+            if self.namespaces:
+                namespaces = self.namespaces
+                if callable(namespaces):
+                    namespaces = namespaces(*args, **kwargs)
+                version_tag = self.version_store.get_tag(namespaces)
+                if version_tag is None:
+                    return func(*args, **kwargs)
+            namespace = self._get_namespace(bound.arguments, version_tag)
+            result, misses = self._get_many(namespace, items)
+            if misses:
+                bound.arguments[self.batch_arg] = misses
+                fetched = func(*bound.args, **bound.kwargs)
+                self._set_many(namespace, misses, fetched)
+                result.update(fetched)
+            return result
 
         return wrapped_func
@@ -76,6 +76,7 @@ MIDDLEWARE = MIDDLEWARE_CLASSES = (
     'django.middleware.security.SecurityMiddleware',
     'ssologin.middleware.PermissionAuthenticateMiddleware',
     'bombus.middleware.ProjectAuditLogMiddleware',
+    'bombus.middleware.UserLoaderMiddleware',
     'audit.middleware.FastResponseMiddleware',
 )
 
@@ -124,6 +125,37 @@ REDIS_CONN_DEFAULT_CONF = {
 }
 
 
+##################
+# QUEUE SETTINGS #
+##################
+# 合规数据通道: list(Redis List) / stream(Redis Stream消费组)
+AUDIT_DATA_PROVIDER = 'list'
+# 按data_type分区的队列及消费权重, 未配置的类型写入原始队列
+AUDIT_QUEUE_WEIGHTS = {
+    'BgAccessLog': 8,
+    'UserRoleModifyLog': 4,
+    'RolePermissionModifyLog': 4,
+    'UserAccountData': 2,
+    'EmployeePositionChangeData': 2,
+    'UserRoleData': 1,
+    'RolePermissionData': 1,
+}
+# 上报限流: 积压条数或audit_redis内存(字节)超过高水位返回429, 均回落到低水位以下恢复;
+# 内存预算包含去重标记, 约为AUDIT_DEDUP_TTL内消费的消息数 * 100字节; memory_high_watermark为0时不按内存限流;
+# shed_data_types为空时对所有类型限流
+AUDIT_QUEUE_BACKPRESSURE = {
+    'high_watermark': 2000000,
+    'low_watermark': 1000000,
+    'memory_high_watermark': 4 * 1024 ** 3,
+    'memory_low_watermark': 3 * 1024 ** 3,
+    'retry_after': 60,
+    'shed_data_types': ['UserRoleData', 'RolePermissionData'],
+    'check_interval': 1,
+}
+# 消费端去重标记保留时长(秒), 0为关闭; 标记按小时分桶存入集合
+AUDIT_DEDUP_TTL = 6 * 3600
+
+
 #################
 # TIME SETTINGS #
 #################
@@ -221,6 +253,13 @@ AUDIT_USERS = ['40002', '40002']
 # 服务账号
 SERVICE_ACCOUNT = []
 
+# 用户信息查询方式: query(按需查询并缓存) / snapshot(内存员工目录快照)
+UMS_DIRECTORY_MODE = 'query'
+# 用户关键字搜索方式: query(数据库模糊查询) / index(内存子串索引, 随员工目录快照刷新)
+# index与query的差异: 不区分大小写; 邮箱只匹配邮箱前缀(不匹配域名部分); 按完全匹配>前缀匹配>子串匹配排序;
+# 每个进程首次搜索时加载全部员工信息到内存
+UMS_SEARCH_MODE = 'query'
+
 BG_ADMIN_ROLE_MAP = {
     'ca_bg': '管理员'
 }